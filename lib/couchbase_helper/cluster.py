@@ -1,6 +1,8 @@
 from tasks.future import Future
 from tasks.taskmanager import TaskManager
 from tasks.task import *
+import concurrent.futures
+import logger
 import types
 
 
@@ -10,11 +12,14 @@ This module is contains the top-level API's for scheduling and executing tasks.
 API provides a way to run task do syncronously and asynchronously.
 """
 
+log = logger.Logger.get_logger()
+
+
 class Cluster(object):
     """An API for interacting with Couchbase clusters"""
 
-    def __init__(self):
-        self.task_manager = TaskManager("Cluster_Thread")
+    def __init__(self, num_workers=1):
+        self.task_manager = TaskManager("Cluster_Thread", num_workers=num_workers)
         self.task_manager.start()
 
     def async_create_default_bucket(self, bucket_params):
@@ -196,6 +201,46 @@ class Cluster(object):
         self.task_manager.schedule(_task)
         return _task
 
+    def run_fts_queries_compare(self, fts_index, es_instance, query_indexes,
+                                es_index_name=None, n1ql_executor=None, concurrency=1):
+        """Synchronously runs ESRunQueryCompare tasks for query_indexes,
+        concurrency queries at a time
+
+        The tasks run on their own task manager and send their ES and N1QL
+        queries while the FTS query runs. FTS, ES and N1QL latency
+        percentiles are logged when all queries are done.
+
+        Returns:
+            A list of finished ESRunQueryCompare tasks, in query order"""
+        latencies = QueryLatencies()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * concurrency)
+        task_manager = TaskManager("Query_compare_thread", num_workers=concurrency)
+        task_manager.start()
+        tasks = []
+        try:
+            for query_index in query_indexes:
+                _task = ESRunQueryCompare(fts_index,
+                                          es_instance,
+                                          query_index=query_index,
+                                          es_index_name=es_index_name,
+                                          n1ql_executor=n1ql_executor,
+                                          executor=executor,
+                                          latencies=latencies)
+                task_manager.schedule(_task)
+                tasks.append(_task)
+            for _task in tasks:
+                try:
+                    _task.result()
+                except Exception:
+                    # the caller gets it from the task
+                    pass
+        finally:
+            task_manager.shutdown(force=True)
+            executor.shutdown(wait=False)
+        for line in latencies.summary():
+            log.info(line)
+        return tasks
+
     def async_rebalance(self, servers, to_add, to_remove, use_hostnames=False,
                         services=None, sleep_before_rebalance=None):
         """Asyncronously rebalances a cluster
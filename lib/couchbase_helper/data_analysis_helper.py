@@ -1,5 +1,6 @@
 import os, time, datetime
 import os.path
+import heapq
 import uuid
 from remote.remote_util import RemoteMachineShellConnection
 from lib.mc_bin_client import MemcachedClient
@@ -147,6 +148,8 @@ class DataAnalyzer(object):
             sourceMap: input 1 used for comparison
             targetMap: input 2 used for comparison
             The input is present in the format {bucket: {vbucket:[{key:value}]}}
+            or {bucket: spilled file} as returned by collect_data with spill_dir set,
+            spilled files are removed once compared
             comparisonMap: logical comparison definitions for key, values
 
             Returns:
@@ -165,9 +168,20 @@ class DataAnalyzer(object):
         for bucket in list(sourceMap.keys()):
             info1 = sourceMap[bucket]
             info2 = targetMap[bucket]
-            Result[bucket] = self.compare_data_maps(info1,info2,headerInfo,"key")
+            Result[bucket] = self.compare_datasets(info1,info2,headerInfo)
         return Result
 
+    def compare_datasets(self,info1,info2,headerInfo):
+        """ Helper method to compare two data maps, or the files they were spilled to """
+        if isinstance(info1,str) and isinstance(info2,str):
+            try:
+                return self.compare_sorted_data_files(info1,info2,headerInfo)
+            finally:
+                for path in (info1,info2):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return self.compare_data_maps(info1,info2,headerInfo,"key")
+
     def compare_per_node_dataset(self,headerInfo,sourceMap,targetMap,comparisonMap=None):
         """
             Method to compare data sets and given as input of two compare_maps
@@ -200,7 +214,7 @@ class DataAnalyzer(object):
             for node in list(sourceMap[bucket].keys()):
                 info1 = sourceMap[bucket][node]
                 info2 = targetMap[bucket][node]
-                Result[bucket][node] = self.compare_data_maps(info1,info2,headerInfo,"key")
+                Result[bucket][node] = self.compare_datasets(info1,info2,headerInfo)
         return Result
 
     def compare_stats_dataset(self,bucketmap1,bucketmap2,mainKey,comparisonMap=None):
@@ -347,21 +361,69 @@ class DataAnalyzer(object):
         updatedItemsMap = {}
         deletedItemsList = list(set(info1.keys()) - set(info2.keys()))
         addedItemsList = list(set(info2.keys()) - set(info1.keys()))
+        fields = headerInfo.split(",")
         for key in set(info1.keys()) & set(info2.keys()):
-            data1 = info1[key].split(",")
-            data2 = info2[key].split(",")
-            fields = headerInfo.split(",")
-            reason = {}
-            if len(data1) == len(data2):
-                for i in range(len(data1)):
-                    if comparisonMap != None and headerInfo[i] in list(comparisonMap.keys()):
-                        self.compare_values(data1[i],data2[i],fields[i],reason,comparisonMap[headerInfo[i]])
-                    elif data1[i] !=  data2[i]:
-                        reason[fields[i]] = "Expected {0} :: Actual {1}".format(data1[i],data2[i])
-            else:
-                reason["number of value mismatch"] = "Number of values mismatch :: Expected values {0} \n Actual values {1}".format(data1,data2)
+            reason = self.compare_rows(info1[key].split(","),info2[key].split(","),fields,comparisonMap)
             if len(reason) > 0:
                 updatedItemsMap[key] = reason
+        return self.comparison_result(deletedItemsList,addedItemsList,updatedItemsMap)
+
+    def compare_sorted_data_files(self,file1,file2,headerInfo,index=0,comparisonMap=None):
+        """
+            Merge-join version of compare_data_maps for two data maps spilled to disk
+            by CbtransferDataMap.spill, so neither of them has to be loaded into memory
+
+            Paramters:
+
+            file1: spilled data map used as input 1 for comparison
+            file2: spilled data map used as input 2 for comparison
+            headerInfo: field names of values in input (comma seperated list)
+            index: column of the document key in the rows
+            comparisonMap: logical comparison definitions for key, values
+
+            Returns:
+
+            Same result set as compare_data_maps
+        """
+        updatedItemsMap = {}
+        deletedItemsList = []
+        addedItemsList = []
+        fields = headerInfo.split(",")
+        with open(file1) as f1, open(file2) as f2:
+            row1 = f1.readline()
+            row2 = f2.readline()
+            while row1 or row2:
+                data1 = row1.split(",") if row1 else None
+                data2 = row2.split(",") if row2 else None
+                if data2 is None or (data1 is not None and data1[index] < data2[index]):
+                    deletedItemsList.append(data1[index])
+                    row1 = f1.readline()
+                elif data1 is None or data2[index] < data1[index]:
+                    addedItemsList.append(data2[index])
+                    row2 = f2.readline()
+                else:
+                    reason = self.compare_rows(data1,data2,fields,comparisonMap)
+                    if len(reason) > 0:
+                        updatedItemsMap[data1[index]] = reason
+                    row1 = f1.readline()
+                    row2 = f2.readline()
+        return self.comparison_result(deletedItemsList,addedItemsList,updatedItemsMap)
+
+    def compare_rows(self,data1,data2,fields,comparisonMap=None):
+        """ Helper method to compare the values of two rows of a dataset """
+        reason = {}
+        if len(data1) == len(data2):
+            for i in range(len(data1)):
+                if comparisonMap != None and fields[i] in comparisonMap:
+                    self.compare_values(data1[i],data2[i],fields[i],reason,comparisonMap[fields[i]])
+                elif data1[i] !=  data2[i]:
+                    reason[fields[i]] = "Expected {0} :: Actual {1}".format(data1[i],data2[i])
+        else:
+            reason["number of value mismatch"] = "Number of values mismatch :: Expected values {0} \n Actual values {1}".format(data1,data2)
+        return reason
+
+    def comparison_result(self,deletedItemsList,addedItemsList,updatedItemsMap):
+        """ Helper method to build the result of a dataset comparison """
         comparisonResult = {DELETED_ITEMS:deletedItemsList,ADD_ITEMS:addedItemsList,UPDATED_ITEMS:updatedItemsMap}
         logicalResult = {DELETED_ITEMS:(len(deletedItemsList) > 0),ADD_ITEMS:(len(addedItemsList) > 0),UPDATED_ITEMS:(len(updatedItemsMap) > 0)}
         return {LOGICAL_RESULT:logicalResult,RESULT:comparisonResult}
@@ -409,12 +471,75 @@ class DataAnalyzer(object):
         elif type == "string":
             return val
 
+class CbtransferDataMap(dict):
+    """ document key -> csv row map of a cbtransfer dump which also keeps the
+        revId of each row, so the row with the highest revId wins """
+
+    REV_ID_INDEX = 5
+
+    def __init__(self):
+        super(CbtransferDataMap, self).__init__()
+        self.revIds = {}
+
+    def add(self, key, revId, row, replace_equal=False):
+        prev_revId = self.revIds.get(key)
+        if prev_revId is None or prev_revId < revId or (replace_equal and prev_revId == revId):
+            self.revIds[key] = revId
+            self[key] = row
+
+    def merge(self, other):
+        """ union with the map of another node, on equal revIds the other
+            node wins as it did with dict.update """
+        for key, row in other.items():
+            self.add(key, other.revIds[key], row, replace_equal=True)
+
+    def spill(self, path, rev_ids=False):
+        """ write the rows sorted by key to path, for compare_sorted_data_files,
+            with rev_ids every row is prefixed by its revId for merge_spilled """
+        with open(path, 'w') as f:
+            for key in sorted(self):
+                row = self[key]
+                if not row.endswith("\n"):
+                    row += "\n"
+                if rev_ids:
+                    row = "{0},{1}".format(self.revIds[key], row)
+                f.write(row)
+        return path
+
+    @staticmethod
+    def merge_spilled(paths, path):
+        """ union of the maps spilled with rev_ids to paths, one per node, into
+            path like merge() would do in memory. The input files are removed. """
+        files = [open(p) for p in paths]
+        try:
+            def rows(node, f):
+                for line in f:
+                    revId, row = line.split(",", 1)
+                    yield row.split(",", 1)[0].rstrip("\n"), int(revId), node, row
+            # rows of a key come by revId and node, so the last one wins
+            with open(path, 'w') as out:
+                last = None
+                for key, revId, node, row in heapq.merge(*[rows(node, f) for node, f in enumerate(files)]):
+                    if last is not None and last[0] != key:
+                        out.write(last[3])
+                    last = (key, revId, node, row)
+                if last is not None:
+                    out.write(last[3])
+        finally:
+            for f in files:
+                f.close()
+            for p in paths:
+                os.remove(p)
+        return path
+
+
 class DataCollector(object):
     """ Helper Class to collect stats and data from clusters """
 
     def collect_data(self, servers, buckets, userId="Administrator", password="password",
                                              data_path = None, perNode = True,
-                                             getReplica = False, mode = "memory"):
+                                             getReplica = False, mode = "memory",
+                                             columns = None, spill_dir = None):
         """
             Method to extract all data information from memory or disk using cbtransfer
             The output is organized like { bucket :{ node { document-key : list of values }}}
@@ -427,6 +552,12 @@ class DataCollector(object):
             password: password of cb server
             data_path: data path on servers, if given we will do cbtransfer on files
             perNode: if set we organize data for each bucket per node basis else we take a union
+            columns: if set only these csv columns are kept next to the document key
+            spill_dir: if set the data maps of each node are written sorted to files in
+                       this directory as soon as they are parsed, so only the maps of one
+                       node are in memory, and the file names are returned instead of the
+                       maps. The files are removed by compare_all_dataset and
+                       compare_per_node_dataset.
 
             Returns:
 
@@ -438,8 +569,13 @@ class DataCollector(object):
         completeMap = {}
         for bucket in buckets:
             completeMap[bucket.name] = {}
+            if not perNode:
+                completeMap[bucket.name] = CbtransferDataMap()
         headerInfo = None
-        for server in servers:
+        parser = lambda dataInCSV: self.translateDataFromCSVToMap(0, dataInCSV, columns)
+        prefix = str(uuid.uuid1())
+        spilled = {}
+        for server_index, server in enumerate(servers):
             if  mode  ==  "disk" and data_path == None:
                 rest = RestConnection(server)
                 data_path = rest.get_data_path()
@@ -452,7 +588,8 @@ class DataCollector(object):
                                                       userId=userId,
                                                       password=password,
                                                       getReplica = getReplica,
-                                                      mode = mode)
+                                                      mode = mode,
+                                                      parser = parser)
             else:
                 remote_client = RemoteMachineShellConnection(server)
                 headerInfo,bucketMap = remote_client.get_data_map_using_cbtransfer(buckets,
@@ -460,14 +597,30 @@ class DataCollector(object):
                                                          userId=userId,
                                                          password=password,
                                                          getReplica = getReplica,
-                                                         mode = mode)
+                                                         mode = mode,
+                                                         parser = parser)
                 remote_client.disconnect()
             for bucket in list(bucketMap.keys()):
-                newMap = self.translateDataFromCSVToMap(0,bucketMap[bucket])
+                newMap = bucketMap.pop(bucket)
+                if spill_dir is not None:
+                    path = os.path.join(spill_dir, "{0}_{1}_{2}.csv".format(prefix, bucket, server_index))
+                    newMap = newMap.spill(path, rev_ids=not perNode)
+                    if not perNode:
+                        spilled.setdefault(bucket, []).append(newMap)
+                        continue
                 if perNode:
+                    replaced = completeMap[bucket].get(server.ip)
+                    if isinstance(replaced, str):
+                        # nodes of a cluster_run share the ip
+                        os.remove(replaced)
                     completeMap[bucket][server.ip] = newMap
                 else:
-                    completeMap[bucket].update(newMap)
+                    completeMap[bucket].merge(newMap)
+        headerInfo = self.project_header(headerInfo, 0, columns)
+        if spill_dir is not None and not perNode:
+            for bucket in list(completeMap.keys()):
+                path = os.path.join(spill_dir, "{0}_{1}.csv".format(prefix, bucket))
+                completeMap[bucket] = CbtransferDataMap.merge_spilled(spilled.get(bucket, []), path)
         return headerInfo,completeMap
 
     def collect_vbucket_stats(self, buckets, servers, collect_vbucket = True,
@@ -713,25 +866,49 @@ class DataCollector(object):
                     m["state"] = value
                     map_data[vb] = m
 
-    def translateDataFromCSVToMap(self,index,dataInCSV):
-        """ Helper method to translate cbtransfer per line data into key: value pairs"""
-        bucketMap = {}
-        revIdIndex = 5
+    def translateDataFromCSVToMap(self,index,dataInCSV,columns=None):
+        """
+            Helper method to translate cbtransfer per line data into key: value pairs
+
+            dataInCSV can be any iterable of lines, e.g. the open csv file, it is read
+            in one pass. If a key shows up more than once the row with the highest
+            revId is kept. If columns is given the rows only keep the key followed by
+            those columns, see project_header.
+        """
+        bucketMap = CbtransferDataMap()
+        revIds = bucketMap.revIds
+        revIdIndex = CbtransferDataMap.REV_ID_INDEX
         for value in dataInCSV:
             values = value.split(",")
-            if values[index] in list(bucketMap.keys()):
-                prev_revId =  int(bucketMap[values[index]][revIdIndex])
-                new_revId = int(values[revIdIndex])
-                if prev_revId < new_revId:
-                    bucketMap[values[index]] = value
-            else:
-                bucketMap[values[index]] = value
+            key = values[index]
+            try:
+                revId = int(values[revIdIndex])
+            except (ValueError, IndexError):
+                revId = -1
+            prev_revId = revIds.get(key)
+            if prev_revId is not None and prev_revId >= revId:
+                continue
+            if columns is not None:
+                value = ",".join([key] + [values[i].rstrip("\n") for i in columns if i != index]) + "\n"
+            revIds[key] = revId
+            bucketMap[key] = value
         return bucketMap
 
+    def project_header(self,headerInfo,index=0,columns=None):
+        """ Helper method to reduce the header to the columns kept by translateDataFromCSVToMap """
+        if columns is None or not headerInfo:
+            return headerInfo
+        fields = headerInfo.rstrip("\n").split(",")
+        return ",".join([fields[index]] + [fields[i] for i in columns if i != index]) + "\n"
+
     def get_local_data_map_using_cbtransfer(self, server, buckets, data_path=None,
                                                   userId="Administrator", password="password",
-                                                  getReplica=False, mode = "memory"):
-        """ Get Local CSV information :: method used when running simple tests only """
+                                                  getReplica=False, mode = "memory", parser=None):
+        """
+            Get Local CSV information :: method used when running simple tests only
+            If parser is given it is called with the open csv file instead of
+            returning the list of its lines
+        """
         temp_path = "/tmp/"
         replicaOption = ""
         prefix = str(uuid.uuid1())
@@ -772,7 +949,10 @@ class DataCollector(object):
                 headerInfo = ""
                 with open(dest_path) as f:
                     headerInfo = f.readline()
-                    content = f.readlines()
+                    if parser is None:
+                        content = f.readlines()
+                    else:
+                        content = parser(f)
                 bucketMap[bucket.name] = content
                 os.remove(dest_path)
         return headerInfo, bucketMap
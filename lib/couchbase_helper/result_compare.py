@@ -0,0 +1,62 @@
+from collections import Counter
+
+# rows of each side reported by default
+MAX_REPORTED_ROWS = 5
+
+
+def canonical(value, sort_lists=False, round_floats=False):
+    """
+        Returns a hashable form of a query result value, so that rows can be
+        compared as multisets. Dicts become sorted item tuples, integral
+        floats become ints and with sort_lists the order of nested arrays is
+        ignored. round_floats rounds floats to whole numbers the way the RQG
+        sql clients convert them.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(((k, canonical(v, sort_lists, round_floats)) for k, v in value.items()),
+                            key=lambda item: str(item[0])))
+    if isinstance(value, (list, tuple)):
+        items = [canonical(v, sort_lists, round_floats) for v in value]
+        if sort_lists:
+            # values of different types don't compare in python 3
+            items.sort(key=repr)
+        return ("__list__", tuple(items))
+    if isinstance(value, float):
+        if round_floats:
+            value = round(value, 0)
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def compare_results(actual, expected, limit=MAX_REPORTED_ROWS, sort_lists=False, round_floats=False):
+    """
+        Compares two query results as multisets of rows in linear time
+
+        Returns the rows of expected missing from actual and the rows of
+        actual which are not expected, at most limit of each (all of them if
+        limit is None). Both are empty if the results match. Only expected is
+        held as canonical rows, actual is streamed.
+    """
+    counts = Counter()
+    first = {}
+    for row in expected:
+        key = canonical(row, sort_lists, round_floats)
+        counts[key] += 1
+        first.setdefault(key, row)
+    extra = []
+    for row in actual:
+        key = canonical(row, sort_lists, round_floats)
+        if counts[key] > 0:
+            counts[key] -= 1
+        elif limit is None or len(extra) < limit:
+            extra.append(row)
+    missing = []
+    for key, count in counts.items():
+        if limit is not None and len(missing) >= limit:
+            break
+        if count > 0:
+            missing.extend([first[key]] * count)
+    if limit is not None:
+        missing = missing[:limit]
+    return missing, extra
@@ -1,4 +1,6 @@
 import copy
+import heapq
+from collections import Counter, defaultdict
 from .documentgenerator import  DocumentGenerator
 import re
 import datetime
@@ -11,12 +13,28 @@ from .data import COUNTRIES, COUNTRY_CODE, FIRST_NAMES, LAST_NAMES
 
 log = logger.Logger.get_logger()
 
+
+def _compile_clause(clause, name):
+    """Compiles a translated clause into a function of doc, so it is
+    parsed once per query instead of once per document"""
+    try:
+        code = compile("lambda doc: (%s)" % clause, "<%s clause>" % name, "eval")
+    except SyntaxError:
+        # fail on the first document, the way eval() of the clause did
+        return lambda doc: eval(clause)
+    return eval(code)
+
+
 class TuqGenerators(object):
 
-    def __init__(self, log, full_set):
+    def __init__(self, log, full_set, cache_results=False):
         self.log = log
         self.full_set = full_set
         self.query = None
+        # expected results per normalized query, only safe as long as the
+        # documents of full_set are not changed, see clear_result_cache()
+        self.cache_results = cache_results
+        self._result_cache = {}
         self.type_args = {}
         self.nests = self._all_nested_objects(full_set[0])
         self.type_args['str'] = [attr[0] for attr in full_set[0].items()
@@ -64,6 +82,14 @@ class TuqGenerators(object):
         return query
 
     def generate_expected_result(self, print_expected_result = True):
+        cache_key = None
+        if self.cache_results:
+            cache_key = (' '.join(self.query.split()), id(self.full_set), len(self.full_set))
+            if cache_key in self._result_cache:
+                result = copy.deepcopy(self._result_cache[cache_key])
+                if print_expected_result:
+                    log.info("Expected result (cached) is %s ..." % str(result[:15]))
+                return result
         try:
             self._create_alias_map()
             from_clause = self._format_from_clause()
@@ -79,10 +105,15 @@ class TuqGenerators(object):
             result = self._limit_and_offset(result)
             if print_expected_result:
                 log.info("Expected result is %s ..." % str(result[:15]))
+            if cache_key is not None:
+                self._result_cache[cache_key] = copy.deepcopy(result)
             return result
         finally:
             self._clear_current_query()
 
+    def clear_result_cache(self):
+        self._result_cache = {}
+
     def _all_nested_objects(self, d):
         def items():
             for key, value in list(d.items()):
@@ -326,28 +357,33 @@ class TuqGenerators(object):
                     select_clause = select_clause + '}'
 
         log.info("-->select_clause:{}; where_clause={}".format(select_clause, where_clause))
+        select = _compile_clause(select_clause, "select")
         if where_clause:
             where_clause = where_clause.replace('if  t  >  "', 'if  str(t)  >  "') # to fix the type error between int, str comparison
             log.info("-->where_clause={}".format(where_clause))
-            result = [eval(select_clause) for doc in self.full_set if eval(where_clause)]
+            where = _compile_clause(where_clause, "where")
+            result = [select(doc) for doc in self.full_set if where(doc)]
         else:
-            result = [eval(select_clause) for doc in self.full_set]
+            result = [select(doc) for doc in self.full_set]
         if self.distinct:
             result = [dict(y) for y in set(tuple(x.items()) for x in result)]
         if unnest_clause:
             unnest_attr = unnest_clause[5:-2]
+            unnest = _compile_clause(unnest_clause, "unnest")
             if unnest_attr in self.aliases:
+                # every row is a new dict built by the select clause, so
+                # shallow copies can't change full_set or the other rows
                 def res_generator():
                     for doc in result:
-                        doc_temp = copy.deepcopy(doc)
+                        doc_temp = dict(doc)
                         del doc_temp[unnest_attr]
-                        for item in eval(unnest_clause):
-                            doc_to_append = copy.deepcopy(doc_temp)
-                            doc_to_append[unnest_attr] = copy.deepcopy(item)
+                        for item in unnest(doc):
+                            doc_to_append = dict(doc_temp)
+                            doc_to_append[unnest_attr] = item
                             yield doc_to_append
                 result = list(res_generator())
             else:
-                result = [item for doc in result for item in eval(unnest_clause)]
+                result = [item for doc in result for item in unnest(doc)]
         if self._create_groups()[0]:
             result = self._group_results(result)
         if self.aggr_fns:
@@ -443,9 +479,17 @@ class TuqGenerators(object):
                                                          if params['field'] == att_name[1:-1]][0])
             if order_clause.find(',"') != -1:
                 order_clause = order_clause.replace(',"', '"')
-            key = lambda doc: eval(order_clause)
+            key = _compile_clause(order_clause, "order")
         try:
-            result = sorted(result, key=key, reverse=reverse)
+            top = self._get_top_count()
+            if key is not None and top is not None and top < len(result):
+                # same as sorted()[:top], LIMIT and OFFSET cut the rest anyway
+                if reverse:
+                    result = heapq.nlargest(top, result, key=key)
+                else:
+                    result = heapq.nsmallest(top, result, key=key)
+            else:
+                result = sorted(result, key=key, reverse=reverse)
         except:
             return result
         if self.attr_order_clause_greater_than_select and not self.parent_selected:
@@ -459,12 +503,26 @@ class TuqGenerators(object):
                         del doc['$gr1']
         return result
 
-    def _limit_and_offset(self, result):
+    def _get_limit_and_offset(self):
         limit_clause = offset_clause = None
         if self.query.find('LIMIT') != -1:
             limit_clause = re.sub(r'OFFSET.*', '', re.sub(r'.*LIMIT', '', self.query)).strip()
         if self.query.find('OFFSET') != -1:
             offset_clause = re.sub(r'.*OFFSET', '', self.query).strip()
+        return limit_clause, offset_clause
+
+    def _get_top_count(self):
+        """number of ordered results LIMIT and OFFSET keep, None for all"""
+        limit_clause, offset_clause = self._get_limit_and_offset()
+        if not limit_clause:
+            return None
+        try:
+            return int(limit_clause) + (int(offset_clause) if offset_clause else 0)
+        except ValueError:
+            return None
+
+    def _limit_and_offset(self, result):
+        limit_clause, offset_clause = self._get_limit_and_offset()
         if offset_clause:
             result = result[int(offset_clause):]
         if limit_clause:
@@ -472,6 +530,11 @@ class TuqGenerators(object):
         return result
 
     def _create_groups(self):
+        if self._groups is None:
+            self._groups = self._find_groups()
+        return self._groups
+
+    def _find_groups(self):
         if self.query.find('GROUP BY') == -1:
             return 0, None
         group_clause = re.sub(r'ORDER BY.*', '', re.sub(r'.*GROUP BY', '', self.query)).strip()
@@ -497,23 +560,26 @@ class TuqGenerators(object):
         attrs, groups = self._create_groups()
         for fn_name, params in self.aggr_fns.items():
             if fn_name == 'COUNT':
+                counts = Counter((doc[attrs[0]], doc[attrs[1]]) for doc in result)
                 result = [{attrs[0] : group[0], attrs[1] : group[1],
-                                params['alias'] : len([doc for doc in result
-                                if doc[attrs[0]]==group[0] and doc[attrs[1]]==group[1]])}
+                                params['alias'] : counts[group]}
                           for group in groups]
                 result = [doc for doc in result if doc[params['alias']] > 0]
             if fn_name == 'MIN':
+                values = defaultdict(list)
                 if isinstance(list(groups)[0], tuple):
+                    for doc in result:
+                        values[(doc[attrs[0]], doc[attrs[1]])].append(doc[params['field']])
                     result = [{attrs[0] : group[0], attrs[1] : group[1],
-                                    params['alias'] : min([doc[params['field']] for doc in result
-                                    if doc[attrs[0]]==group[0] and doc[attrs[1]]==group[1]])}
+                                    params['alias'] : min(values.get(group, []))}
                               for group in groups]
                 else:
                     if attrs[0] in iter(self.aliases.values()):
                         attrs[0] = self.get_alias_for(attrs[0]).replace(',', '')
+                    for doc in result:
+                        values[doc[attrs[0]]].append(doc[params['alias']])
                     result = [{attrs[0] : group,
-                                params['alias'] : min([doc[params['alias']] for doc in result
-                                if doc[attrs[0]]==group])}
+                                params['alias'] : min(values.get(group, []))}
                           for group in groups]
         else:
             result = [dict(y) for y in set(tuple(x.items()) for x in result)]
@@ -575,6 +641,7 @@ class TuqGenerators(object):
         self.aliases = {}
         self.attr_order_clause_greater_than_select = []
         self.parent_selected = False
+        self._groups = None
 
 class JsonGenerator:
 
@@ -10,6 +10,7 @@ import datetime
 import time
 from datetime import date
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_compare import compare_results
 from remote.remote_util import RemoteMachineShellConnection
 from membase.api.exception import CBQError, ReadDocumentException
 from membase.api.rest_client import RestConnection
@@ -111,9 +112,11 @@ class N1QLHelper():
         if len(actual_result) != len(expected_result):
             raise Exception("Results are incorrect.Actual num %s. Expected num: %s.\n" % (len(actual_result), len(expected_result)))
         msg = "The number of rows match but the results mismatch, please check"
-        diffs = DeepDiff(actual_result, expected_result, ignore_order=True)
-        if diffs:
-            self.log.info("-->actual vs expected diffs found:{}".format(diffs))
+        missing, extra = compare_results(actual_result, expected_result, limit=max(missing_count, extra_count),
+                                         sort_lists=True)
+        if missing or extra:
+            self.log.info("-->actual vs expected diffs found, missing items: {0}, extra items: {1}"
+                          .format(missing[:missing_count], extra[:extra_count]))
             raise Exception(msg)
 
     def _verify_results_rqg(self, subquery, aggregate=False, n1ql_result=[], sql_result=[], hints=["a1"], aggregate_pushdown=False):
@@ -134,16 +137,18 @@ class N1QLHelper():
             actual_result = []
         if check:
             actual_result = self._gen_dict(n1ql_result)
-
-        actual_result = sorted(actual_result)
-        expected_result = sorted(sql_result)
+        expected_result = sql_result
 
         if len(actual_result) != len(expected_result):
-            extra_msg = self._get_failure_message(expected_result, actual_result)
+            missing, extra = compare_results(actual_result, expected_result, round_floats=True, sort_lists=True)
+            extra_msg = self._get_failure_message(missing, extra)
             raise Exception("Results are incorrect. Actual num %s. Expected num: %s. :: %s \n" % (len(actual_result), len(expected_result), extra_msg))
 
         msg = "The number of rows match but the results mismatch, please check"
         if subquery:
+            # the subquery rows differ in shape, so they are paired up by key
+            actual_result = sorted(actual_result, key=lambda row: str(row.get('primary_key_id')))
+            expected_result = sorted(expected_result, key=lambda row: str(row.get('primary_key_id')))
             for x, y in zip(actual_result, expected_result):
                 if aggregate:
                     productId = x['ABC'][0]['$1']
@@ -162,16 +167,11 @@ class N1QLHelper():
                     extra_msg = self._get_failure_message(expected_result, actual_result)
                     raise Exception(msg+"\n "+extra_msg)
         else:
-            if self._sort_data(actual_result) != self._sort_data(expected_result):
-                extra_msg = self._get_failure_message(expected_result, actual_result)
+            missing, extra = compare_results(actual_result, expected_result, round_floats=True, sort_lists=True)
+            if missing or extra:
+                extra_msg = self._get_failure_message(missing, extra)
                 raise Exception(msg+"\n "+extra_msg)
 
-    def _sort_data(self, result):
-        new_data = []
-        for data in result:
-            new_data.append(sorted(data))
-        return new_data
-
     def _verify_results_crud_rqg(self, n1ql_result=[], sql_result=[], hints=["primary_key_id"]):
         new_n1ql_result = []
         for result in n1ql_result:
@@ -186,15 +186,15 @@ class N1QLHelper():
             actual_result = []
         if check:
             actual_result = self._gen_dict(n1ql_result)
-        actual_result = sorted(actual_result)
-        expected_result = sorted(sql_result)
+        expected_result = sql_result
 
+        missing, extra = compare_results(actual_result, expected_result, round_floats=True, sort_lists=True)
         if len(actual_result) != len(expected_result):
-            extra_msg = self._get_failure_message(expected_result, actual_result)
+            extra_msg = self._get_failure_message(missing, extra)
             raise Exception("Results are incorrect. Actual num %s. Expected num: %s.:: %s \n" % (len(actual_result), len(expected_result), extra_msg))
-        if not self._result_comparison_analysis(actual_result, expected_result):
+        if missing or extra:
             msg = "The number of rows match but the results mismatch, please check"
-            extra_msg = self._get_failure_message(expected_result, actual_result)
+            extra_msg = self._get_failure_message(missing, extra)
             raise Exception(msg+"\n "+extra_msg)
 
     def _get_failure_message(self, expected_result, actual_result):
@@ -209,29 +209,6 @@ class N1QLHelper():
         extra_msg = "mismatch in results :: expected :: {0}, actual :: {1} ".format(expected_result[0:len_expected_result], actual_result[0:len_actual_result])
         return extra_msg
 
-    def _result_comparison_analysis(self, expected_result, actual_result):
-        expected_map = {}
-        actual_map = {}
-        for data in expected_result:
-            primary=None
-            for key in list(data.keys()):
-                keys = key
-                if keys.encode('ascii') == "primary_key_id":
-                    primary = keys
-            expected_map[data[primary]] = data
-        for data in actual_result:
-            primary = None
-            for key in list(data.keys()):
-                keys = key
-                if keys.encode('ascii') == "primary_key_id":
-                    primary = keys
-            actual_map[data[primary]] = data
-        check = True
-        for key in list(expected_map.keys()):
-            if sorted(actual_map[key]) != sorted(expected_map[key]):
-                check= False
-        return check
-
     def _analyze_for_special_case_using_func(self, expected_result, actual_result):
         if expected_result is None:
             expected_result = []
@@ -303,15 +280,7 @@ class N1QLHelper():
             self.log.info(" example key {0}".format(different_values[0]))
 
     def check_missing_and_extra(self, actual, expected):
-        missing = []
-        extra = []
-        for item in actual:
-            if not (item in expected):
-                extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return compare_results(actual, expected, limit=None)
 
     def build_url(self, version):
         info = self.shell.extract_remote_info()
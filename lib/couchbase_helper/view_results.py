@@ -0,0 +1,173 @@
+import copy
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from .documentgenerator import DocumentGenerator
+
+# emitted rows of the last few (generator set, view) pairs, so that many
+# queries against the same view share one extraction and sort
+CACHE_SIZE = 4
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# DocumentGenerator formats the template and then applies these replacements
+# to the whole document before json.loads
+def _render(text):
+    return text.replace('\'', '"').replace('True', 'true').replace('False', 'false').replace('\\', '\\\\')
+
+
+class EmittedRows(object):
+    """
+        Rows a view emits for a set of documents, stored as columns sorted by
+        (key, id) so that range and key queries are binary searches
+
+        keys holds str keys as str, row_key() gives them back utf-8 encoded
+        the way GenerateExpectedViewResultsTask always returned them.
+    """
+
+    def __init__(self, ids, keys, values):
+        order = sorted(range(len(ids)), key=lambda i: (keys[i], ids[i]))
+        self.ids = [ids[i] for i in order]
+        self.keys = [keys[i] for i in order]
+        self.values = [values[i] for i in order] if values is not None else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row_key(self, i):
+        key = self.keys[i]
+        if isinstance(key, str):
+            return key.encode('utf-8')
+        return key
+
+    def column(self, column, selection):
+        if isinstance(selection, range) and selection.step == 1:
+            return column[selection.start:selection.stop]
+        return [column[i] for i in selection]
+
+
+def emitted_rows(doc_generators, emit_key, emit_value=None, type_filter=None):
+    """
+        Returns the EmittedRows of a map function that emits doc[emit_key]
+        (or the list of doc[k] for k in emit_key) and doc[emit_value] for the
+        documents that match type_filter
+
+        Fields of a DocumentGenerator that are rendered from a single template
+        argument are computed from the argument lists directly, other
+        generators are rendered and parsed document by document.
+    """
+    fields = list(emit_key) if isinstance(emit_key, list) else [emit_key]
+    if emit_value is not None:
+        fields.append(emit_value)
+    if type_filter:
+        fields.append(type_filter["filter_what"])
+    cache_key = _cache_key(doc_generators, emit_key, emit_value, type_filter)
+    if cache_key is not None:
+        with _cache_lock:
+            if cache_key in _cache:
+                _cache.move_to_end(cache_key)
+                return _cache[cache_key]
+    filter_re = None
+    if type_filter:
+        filter_re = re.compile(r'\A{0}.*'.format(type_filter["filter_expr"]))
+    ids, keys, values = [], [], []
+    for doc_gen in doc_generators:
+        gen_ids, columns = _generator_columns(doc_gen, fields)
+        mask = None
+        if filter_re is not None:
+            mask = [filter_re.match(v) is not None for v in columns[type_filter["filter_what"]]]
+        if isinstance(emit_key, list):
+            gen_keys = [list(key) for key in zip(*[columns[k] for k in emit_key])]
+        else:
+            gen_keys = columns[emit_key]
+        gen_values = columns[emit_value] if emit_value is not None else None
+        if mask is not None:
+            gen_ids = [v for v, m in zip(gen_ids, mask) if m]
+            gen_keys = [v for v, m in zip(gen_keys, mask) if m]
+            if gen_values is not None:
+                gen_values = [v for v, m in zip(gen_values, mask) if m]
+        ids.extend(gen_ids)
+        keys.extend(gen_keys)
+        if gen_values is not None:
+            values.extend(gen_values)
+    rows = EmittedRows(ids, keys, values if emit_value is not None else None)
+    if cache_key is not None:
+        with _cache_lock:
+            _cache[cache_key] = rows
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    return rows
+
+
+def _cache_key(doc_generators, emit_key, emit_value, type_filter):
+    gens = []
+    for doc_gen in doc_generators:
+        if type(doc_gen) is not DocumentGenerator or doc_gen.name == "random_keys":
+            return None
+        gens.append((doc_gen.name, doc_gen.template, repr(doc_gen.args), doc_gen.itr, doc_gen.end))
+    return (tuple(gens), repr(emit_key), emit_value,
+            repr(sorted(type_filter.items())) if type_filter else None)
+
+
+def _generator_columns(doc_gen, fields):
+    """ returns the ids and a column per field of the documents doc_gen
+        has left to generate """
+    if type(doc_gen) is DocumentGenerator and doc_gen.name != "random_keys":
+        arg_fields = _template_fields(doc_gen)
+        if arg_fields is not None and all(f in arg_fields for f in fields):
+            return _derived_columns(doc_gen, fields, arg_fields)
+    ids = []
+    columns = dict((f, []) for f in fields)
+    gen = copy.deepcopy(doc_gen)
+    while gen.has_next():
+        _id, val = next(gen)
+        val = json.loads(val)
+        ids.append(_id)
+        for f in fields:
+            columns[f].append(val[f])
+    return ids, columns
+
+
+def _template_fields(doc_gen):
+    """
+        Maps the top level fields of the template that are rendered from
+        exactly one argument to (argument index, quoted). Returns None if the
+        template can not be probed, e.g. because it uses format specs.
+    """
+    # a number is valid json both inside and outside of quotes
+    sentinels = [7301000000 + i for i in range(len(doc_gen.args))]
+    try:
+        doc = json.loads(_render(doc_gen.template.format(*sentinels)))
+    except (ValueError, IndexError, KeyError, TypeError, AttributeError):
+        return None
+    if not isinstance(doc, dict):
+        return None
+    arg_fields = {}
+    for field, value in doc.items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, int) and value in sentinels:
+            arg_fields[field] = (value - sentinels[0], False)
+        elif isinstance(value, str) and value.isdigit() and int(value) in sentinels:
+            arg_fields[field] = (int(value) - sentinels[0], True)
+    return arg_fields
+
+
+def _derived_columns(doc_gen, fields, arg_fields):
+    start, end = int(doc_gen.itr), int(doc_gen.end)
+    ids = [doc_gen.name + '-' + str(itr) for itr in range(start, end)]
+    columns = {}
+    for field in fields:
+        arg_index, quoted = arg_fields[field]
+        arg = doc_gen.args[arg_index]
+        stride = 1
+        for other in doc_gen.args[:arg_index]:
+            stride *= len(other)
+        # the parsed value of every element of the argument list
+        fmt = '"{0}"' if quoted else '{0}'
+        table = [json.loads(_render(fmt.format(value))) for value in arg]
+        size = len(table)
+        columns[field] = [table[(itr // stride) % size] for itr in range(start, end)]
+    return ids, columns
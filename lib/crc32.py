@@ -4,6 +4,8 @@
 # * src/usr.bin/cksum/crc32.c.
 # */
 
+import zlib
+
 
 crc32tab = [
   0x00000000, 0x77073096, 0xee0e612c, 0x990951ba,
@@ -72,7 +74,7 @@ crc32tab = [
   0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d]
 
 
-def crc32_hash(key):
+def _crc32_hash_py(key):
     crc = pow(2, 32) - 1
     #print("-->key {},{}".format(type(key),key))
     try:
@@ -83,3 +85,59 @@ def crc32_hash(key):
         #print("-->ch {},{}".format(type(ch), ch))
         crc = (crc >> 8) ^ crc32tab[int((crc ^ ord(ch)) & 0xff)]
     return ((~crc) >> 16) & 0x7fff
+
+
+def _hash_bytes(key):
+    # the table loop above hashes the low byte of every character
+    try:
+        key = key.decode()
+    except AttributeError:
+        pass
+    try:
+        return key.encode('latin-1')
+    except UnicodeEncodeError:
+        return bytes(ord(ch) & 0xff for ch in key)
+
+
+def crc32_hash(key):
+    """Returns bits 16-30 of the crc32 of key, computed by zlib.
+
+    Bit compatible with the table driven implementation: str keys are hashed
+    one character at a time using the low byte of each character, bytes are
+    decoded first."""
+    try:
+        data = _hash_bytes(key)
+    except AttributeError:
+        # neither str nor bytes, leave it to the python loop
+        return _crc32_hash_py(key)
+    return (zlib.crc32(data) >> 16) & 0x7fff
+
+
+def hash_values(values):
+    """Returns the crc32_hash of every value in values"""
+    crc = zlib.crc32
+    hashes = []
+    for value in values:
+        try:
+            data = _hash_bytes(value)
+        except AttributeError:
+            hashes.append(_crc32_hash_py(value))
+            continue
+        hashes.append((crc(data) >> 16) & 0x7fff)
+    return hashes
+
+
+def vbucket_id(key, num_vbuckets):
+    """Returns the vbucket of key the way the server maps it, from its utf-8
+    bytes. num_vbuckets must be a power of two."""
+    if isinstance(key, str):
+        key = key.encode()
+    return ((zlib.crc32(key) >> 16) & 0x7fff) & (num_vbuckets - 1)
+
+
+def vbuckets_for(keys, num_vbuckets):
+    """Returns the vbucket of every key in keys, see vbucket_id"""
+    crc = zlib.crc32
+    mask = num_vbuckets - 1
+    return [((crc(key.encode() if isinstance(key, str) else key) >> 16) & 0x7fff) & mask
+            for key in keys]
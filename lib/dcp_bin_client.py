@@ -6,6 +6,12 @@ import time
 
 MAX_SEQNO = 0xFFFFFFFFFFFFFFFF
 
+# connection buffer size DcpMultiStream negotiates with the producer
+DEFAULT_BUFFER_SIZE = 10 * 1024 * 1024
+
+# fraction of the connection buffer that is acked at once
+ACK_RATIO = 0.5
+
 
 class DcpClient(MemcachedClient):
     """ DcpClient implements dcp protocol using mc_bin_client as base
@@ -165,6 +171,23 @@ class DcpClient(MemcachedClient):
         generator = __generator(response)
         return DcpStream(generator, vbucket)
 
+    def stream_vbuckets(self, vbuckets, start_seqno=0, end_seqno=MAX_SEQNO,
+                        vb_uuid=0, takeover=0,
+                        buffer_size=DEFAULT_BUFFER_SIZE, callback=None,
+                        json=''):
+        """ streams a set of vbuckets over this connection.
+
+            start_seqno, end_seqno and vb_uuid are either one value for all
+            vbuckets or a dict keyed by vbucket. returns a DcpMultiStream,
+            iterate over it or call its run() method to receive mutations.
+
+            buffer_size = connection buffer size to negotiate with the
+                          producer, 0 disables flow control
+            callback = called by run() with every response """
+
+        return DcpMultiStream(self, vbuckets, start_seqno, end_seqno,
+                              vb_uuid, takeover, buffer_size, callback, json)
+
     def get_stream(self, vbucket):
         """ for use by external clients to get stream
             associated with a particular vbucket """
@@ -360,6 +383,255 @@ class DcpStream(object):
         return responses
 
 
+class DcpMultiStream(object):
+    """ DcpMultiStream streams a set of vbuckets over one DcpClient connection
+
+        All stream requests are sent at once and the messages of every
+        stream are read from the one socket and demultiplexed by opaque.
+        With flow control the received bytes are acked once the consumer
+        took the messages and ACK_RATIO of the buffer is used, so a slow
+        consumer throttles the producer instead of piling up messages.
+
+        Iterating yields stream request responses, snapshot markers,
+        mutations, deletions, expirations, system events and stream ends
+        until every stream ended, failed or the connection timed out.
+        progress and stats() report per vbucket seqnos and throughput. """
+
+    def __init__(self, client, vbuckets, start_seqno=0, end_seqno=MAX_SEQNO,
+                 vb_uuid=0, takeover=0, buffer_size=DEFAULT_BUFFER_SIZE,
+                 callback=None, json=''):
+
+        self.client = client
+        self.callback = callback
+        self.buffer_size = buffer_size
+        self.ack_threshold = int(buffer_size * ACK_RATIO)
+        self.unacked_bytes = 0
+        self.acked_bytes = 0
+        self.timed_out = False
+        self.failover_logs = {}
+
+        # stream request ops.  key = opaque, val = StreamRequest
+        self.streams = {}
+
+        # key = vbucket, val = dict of seqnos, counters and status
+        self.progress = {}
+
+        # vbuckets whose streams did not end yet
+        self.active = set()
+
+        # bytes of the last message handed to the consumer, not yet acked
+        self._delivered_bytes = 0
+
+        if buffer_size:
+            response = client.flow_control(buffer_size)
+            assert response and response['status'] == 0, \
+                "ERROR: flow control not accepted: %s" % response
+
+        self.start_time = time.time()
+        self.end_time = None
+
+        def _value(value, vbucket):
+            if isinstance(value, dict):
+                return value.get(vbucket, 0)
+            return value
+
+        buf = bytearray()
+        for vbucket in vbuckets:
+            op = StreamRequest(vbucket,
+                               takeover,
+                               _value(start_seqno, vbucket),
+                               _value(end_seqno, vbucket),
+                               _value(vb_uuid, vbucket),
+                               delete_times=client.delete_times,
+                               collections=client.collections,
+                               json=json)
+            self.streams[op.opaque] = op
+            self.active.add(vbucket)
+            self.progress[vbucket] = {'start_seqno': op.start_seqno,
+                                      'end_seqno': op.end_seqno,
+                                      'last_seqno': op.start_seqno,
+                                      'mutations': 0,
+                                      'deletions': 0,
+                                      'expirations': 0,
+                                      'bytes': 0,
+                                      'status': None,
+                                      'rollback': None,
+                                      'ended': False,
+                                      'end_time': None}
+            client.vbucketId = vbucket
+            client._appendCmd(buf, op.opcode, op.key, op.value, op.opaque,
+                              op.extras)
+        client._sendBuffer(buf)
+
+    def __iter__(self):
+        while True:
+            response = self.next_response()
+            if response is None:
+                return
+            yield response
+
+    def run(self, callback=None):
+        """ hands every response to callback and returns stats() """
+
+        callback = callback or self.callback
+        assert callback is not None, "ERROR: run() needs a callback"
+        for response in self:
+            callback(response)
+        return self.stats()
+
+    def stop(self):
+        """ stop iterating, the streams stay open on the connection """
+        self.active.clear()
+        self._finish()
+
+    def next_response(self):
+        """ returns the next response of any stream or None once all
+            streams ended """
+
+        client = self.client
+        while self.active:
+            self._consumed(self._delivered_bytes)
+            self._delivered_bytes = 0
+
+            try:
+                opcode, status, opaque, cas, keylen, extlen, dtype, body, \
+                    frameextralen = client._recvMsg()
+            except EOFError as ex:
+                if 'Timeout' in str(ex):
+                    self.timed_out = True
+                else:
+                    client.dead = True
+                self.active.clear()
+                break
+
+            if client._opcode_dump:
+                print('Opcode Dump - Receive:', str(hex(opcode)),
+                      client.opcode_lookup(opcode))
+
+            op = self.streams.get(opaque)
+            if op is None:
+                self._other_message(opcode, status, opaque, cas, keylen,
+                                    extlen, dtype, body, frameextralen)
+                continue
+
+            response = op.formated_response(opcode, keylen, extlen, dtype,
+                                            status, cas, body, opaque,
+                                            frameextralen)
+            vbucket = op.vbucket
+            progress = self.progress[vbucket]
+
+            if opcode == CMD_STREAM_REQ:
+                # a response, the header carries a status instead of vbucket
+                response['vbucket'] = vbucket
+                progress['status'] = response['status']
+                if response['status'] == 0:
+                    self.failover_logs[vbucket] = response['failover_log']
+                else:
+                    progress['rollback'] = response.get('rollback')
+                    self._ended(vbucket)
+                return response
+
+            nbytes = MIN_RECV_PACKET + len(body)
+            self._delivered_bytes = nbytes
+            progress['bytes'] += nbytes
+
+            if opcode in (CMD_MUTATION, CMD_DELETION, CMD_EXPIRATION):
+                assert response['by_seqno'] > progress['last_seqno'], \
+                    "ERROR: Out of order response on vbucket %s: %s" \
+                    % (vbucket, response)
+                progress['last_seqno'] = response['by_seqno']
+                if opcode == CMD_MUTATION:
+                    progress['mutations'] += 1
+                elif opcode == CMD_DELETION:
+                    progress['deletions'] += 1
+                else:
+                    progress['expirations'] += 1
+
+            elif opcode == CMD_STREAM_END:
+                self._ended(vbucket)
+
+            return response
+
+        self._finish()
+        return None
+
+    def _other_message(self, opcode, status, opaque, cas, keylen, extlen,
+                       dtype, body, frameextralen):
+        """ handles a message that does not belong to one of the streams,
+            the same way DcpClient.recv_op does """
+
+        client = self.client
+        cached_op = client.ops.get(opaque)
+        if cached_op:
+            response = cached_op.formated_response(opcode, keylen, extlen,
+                                                   dtype, status, cas, body,
+                                                   opaque, frameextralen)
+            cached_op.queue.put(response)
+        elif opcode == CMD_STREAM_REQ:
+            client.ack_stream_req(opaque)
+        elif opcode == CMD_UPR_NOOP:
+            client.ack_dcp_noop_req(opaque)
+
+    def _ended(self, vbucket):
+        progress = self.progress[vbucket]
+        progress['ended'] = True
+        progress['end_time'] = time.time()
+        self.active.discard(vbucket)
+
+    def _consumed(self, nbytes):
+        """ acks the bytes of delivered messages once enough add up """
+
+        if not self.buffer_size or not nbytes:
+            return
+        self.unacked_bytes += nbytes
+        if self.unacked_bytes >= self.ack_threshold:
+            self._ack()
+
+    def _ack(self):
+        # the producer does not respond to buffer acks
+        self.client.send_op(Ack(self.unacked_bytes))
+        self.acked_bytes += self.unacked_bytes
+        self.unacked_bytes = 0
+
+    def _finish(self):
+        if self.end_time is not None:
+            return
+        if self.buffer_size:
+            self.unacked_bytes += self._delivered_bytes
+            self._delivered_bytes = 0
+            if self.unacked_bytes and not self.client.dead:
+                self._ack()
+        self.end_time = time.time()
+
+    def stats(self):
+        """ returns totals, throughput and per vbucket progress """
+
+        end_time = self.end_time or time.time()
+        elapsed = max(end_time - self.start_time, 1e-9)
+        vbuckets = {}
+        items = 0
+        nbytes = 0
+        for vbucket, progress in self.progress.items():
+            vb_items = progress['mutations'] + progress['deletions'] + \
+                progress['expirations']
+            vb_elapsed = max((progress['end_time'] or end_time) -
+                             self.start_time, 1e-9)
+            vbuckets[vbucket] = dict(progress,
+                                     items_per_sec=vb_items / vb_elapsed)
+            items += vb_items
+            nbytes += progress['bytes']
+        return {'vbuckets': vbuckets,
+                'items': items,
+                'bytes': nbytes,
+                'acked_bytes': self.acked_bytes,
+                'elapsed': elapsed,
+                'items_per_sec': items / elapsed,
+                'bytes_per_sec': nbytes / elapsed,
+                'ended': sorted(vb for vb, p in self.progress.items()
+                                if p['ended']),
+                'timed_out': self.timed_out}
+
+
 class Operation(object):
     """ Operation Class generically represents any dcp operation providing
         default values for attributes common to each operation """
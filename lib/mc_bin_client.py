@@ -11,12 +11,10 @@ import hmac
 import json
 import random
 import re
-import select
 import socket
 import struct
 import sys
 import time
-import zlib
 
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, ALT_REQ_MAGIC_BYTE, ALT_RES_MAGIC_BYTE, ALT_RES_PKT_FMT
 from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET, REQ_PKT_SD_EXTRAS, SUBDOC_FLAGS_MKDIR_P
@@ -25,6 +23,7 @@ from memcacheConstants import TOUCH_PKT_FMT, GAT_PKT_FMT, GETL_PKT_FMT, REQ_PKT_
 from memcacheConstants import COMPACT_DB_PKT_FMT
 import memcacheConstants
 import logger
+import crc32
 def decodeCollectionID(key):
     # A leb128 varint encodes the CID
     data = array.array('B', key)
@@ -60,6 +59,9 @@ class MemcachedError(exceptions.Exception):
     def __repr__(self):
         return "<MemcachedError #%d ``%s''>" % (self.status, self.msg)
 
+# size of the receive buffer, responses larger than that grow it temporarily
+RECV_BUFFER_SIZE = 256 * 1024
+
 class MemcachedClient(object):
     """Simple memcached client."""
 
@@ -81,17 +83,25 @@ class MemcachedClient(object):
         self.collections_supported = False
 
     def _createConn(self):
+        # receive buffer shared by all responses, see _fillRecvBuffer
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rview = memoryview(self._rbuf)
+        self._rpos = 0
+        self._rend = 0
         try:
             # IPv4
             self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            return self.s.connect_ex((self.host, self.port))
+            rv = self.s.connect_ex((self.host, self.port))
         except:
             # IPv6
             self.host = self.host.replace('[', '').replace(']', '')
             self.s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
             self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            return self.s.connect_ex((self.host, self.port, 0, 0))
+            rv = self.s.connect_ex((self.host, self.port, 0, 0))
+        # sends and receives time out instead of select()ing every packet
+        self.s.settimeout(self.timeout)
+        return rv
 
     def reconnect(self):
         self.s.close()
@@ -108,99 +118,107 @@ class MemcachedClient(object):
         self._sendMsg(cmd, key, val, opaque, extraHeader=extraHeader, cas=cas,
                       vbucketId=self.vbucketId, collection=collection, extended_meta_data=extended_meta_data, extraHeaderLength=extraHeaderLength)
 
+    def _appendCmd(self, buf, cmd, key, val, opaque, extraHeader='', cas=0, collection=None):
+        """Like _sendCmd, but appends the packet to buf for _sendBuffer"""
+        self._appendMsg(buf, cmd, key, val, opaque, extraHeader=extraHeader, cas=cas,
+                        vbucketId=self.vbucketId, collection=collection)
+
     def _sendMsg(self, cmd, key, val, opaque, extraHeader='', cas=0,
                  dtype=0, vbucketId=0,
                  fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE, collection=None, extended_meta_data='', extraHeaderLength=None):
+        buf = bytearray()
+        self._appendMsg(buf, cmd, key, val, opaque, extraHeader=extraHeader, cas=cas,
+                        dtype=dtype, vbucketId=vbucketId, fmt=fmt, magic=magic, collection=collection,
+                        extended_meta_data=extended_meta_data, extraHeaderLength=extraHeaderLength)
+        self._sendBuffer(buf)
+
+    def _appendMsg(self, buf, cmd, key, val, opaque, extraHeader='', cas=0,
+                   dtype=0, vbucketId=0,
+                   fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE, collection=None, extended_meta_data='', extraHeaderLength=None):
+        """Encodes a request packet at the end of the bytearray buf"""
         if collection:
             key = self._encodeCollectionId(key, collection)
+        if isinstance(key, str):
+            key = key.encode()
+        if isinstance(extraHeader, str):
+            extraHeader = extraHeader.encode()
+        if isinstance(val, str):
+            val = val.encode()
+        if isinstance(extended_meta_data, str):
+            extended_meta_data = extended_meta_data.encode()
         # a little bit unfortunate but the delWithMeta command expects the extra data length to be the
         # overall packet length (28 in that case) so we need a facility to support that
         if extraHeaderLength is None:
             extraHeaderLength = len(extraHeader)
 
-        msg = struct.pack(fmt, magic,
+        buf += struct.pack(fmt, magic,
             cmd, len(key), extraHeaderLength, dtype, vbucketId,
                 len(key) + len(extraHeader) + len(val) + len(extended_meta_data), opaque, cas)
-        #self.log.info("--->unpack msg:magic,cmd,keylen,extralen/valelen/extlen,opaque,cas={}".format(struct.unpack(fmt,msg)))
-        _, w, _ = select.select([], [self.s], [], self.timeout)
-        if w:
-            #self.log.info("--->_send:{},{},{},{},{}".format(type(msg),type(extraHeader),type(key),type(val),type(extended_meta_data)))
-            #self.log.info("--->_send:{},{},{},{},{}".format(msg,extraHeader,key,val,extended_meta_data))
-            try:
-              key = key.encode()
-            except AttributeError:
-              pass
-
-            try:
-              extraHeader = extraHeader.encode()
-            except AttributeError:
-              pass
+        buf += extraHeader
+        buf += key
+        buf += val
+        buf += extended_meta_data
 
-            try:
-              val = val.encode()
-            except AttributeError:
-              pass
-
-            try:
-              extended_meta_data = extended_meta_data.encode()
-            except AttributeError:
-              pass
-
-            #self.log.info("--->sending..{}".format(msg+extraHeader+key+val+extended_meta_data))
-            self.s.send(msg+extraHeader+key+val+extended_meta_data)
-        else:
+    def _sendBuffer(self, buf):
+        """Writes all the packets in buf with a single sendall"""
+        try:
+            self.s.sendall(buf)
+        except socket.timeout:
             raise exceptions.EOFError("Timeout waiting for socket send. from {0}".format(self.host))
 
-
-
-
-    def _recvMsg(self):
-        response = b""
-        while len(response) < MIN_RECV_PACKET:
-            r, _, _ = select.select([self.s], [], [], self.timeout)
-            if r:
-                data = self.s.recv(MIN_RECV_PACKET - len(response))
-                if data == '':
-                    raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
-                response += data
+    def _fillRecvBuffer(self, nbytes):
+        """Makes sure at least nbytes received bytes are buffered at _rpos.
+
+        Reads whatever the socket has available, so a batch of responses
+        usually takes a single recv_into."""
+        buffered = self._rend - self._rpos
+        if buffered >= nbytes:
+            return
+        if self._rpos + nbytes > len(self._rbuf):
+            if nbytes > len(self._rbuf):
+                # a body larger than the buffer, grow it for this response
+                rbuf = bytearray(nbytes)
+                rbuf[:buffered] = self._rview[self._rpos:self._rend]
+                self._rbuf = rbuf
+                self._rview = memoryview(rbuf)
             else:
+                self._rbuf[:buffered] = self._rbuf[self._rpos:self._rend]
+            self._rpos = 0
+            self._rend = buffered
+        while self._rend - self._rpos < nbytes:
+            try:
+                received = self.s.recv_into(self._rview[self._rend:])
+            except socket.timeout:
                 raise exceptions.EOFError("Timeout waiting for socket recv. from {0}".format(self.host))
+            if received == 0:
+                raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
+            self._rend += received
 
-        #self.log.info("-->_recvMsg response={}".format(response))
-        #self.log.info("-->_recvMsg response={},{},MIN_RECV_PACKET={}".format(str(response),len(response),MIN_RECV_PACKET))
-        assert len(response) == MIN_RECV_PACKET
+    def _recvMsg(self):
+        self._fillRecvBuffer(MIN_RECV_PACKET)
 
         # Peek at the magic so we can support alternative-framing
-        magic = struct.unpack(b">B", response[0:1])[0]
+        magic = self._rbuf[self._rpos]
         assert (magic in (RES_MAGIC_BYTE, REQ_MAGIC_BYTE, ALT_RES_MAGIC_BYTE, ALT_REQ_MAGIC_BYTE)), "Got magic: 0x%x" % magic
 
-        cmd = 0
         frameextralen = 0
-        keylen = 0
-        extralen = 0
-        dtype = 0
-        errcode = 0
-        remaining = 0
-        opaque = 0
-        cas = 0
         if magic == ALT_RES_MAGIC_BYTE or magic == ALT_REQ_MAGIC_BYTE:
             magic, cmd, frameextralen, keylen, extralen, dtype, errcode, remaining, opaque, cas = \
-                struct.unpack(ALT_RES_PKT_FMT, response)
+                struct.unpack_from(ALT_RES_PKT_FMT, self._rbuf, self._rpos)
         else:
             magic, cmd, keylen, extralen, dtype, errcode, remaining, opaque, cas = \
-                struct.unpack(RES_PKT_FMT, response[0:MIN_RECV_PACKET])
-
-        rv = b""
-        while remaining > 0:
-            r, _, _ = select.select([self.s], [], [], self.timeout)
-            if r:
-                data = self.s.recv(remaining)
-                if data == '':
-                    raise exceptions.EOFError("Got empty data (remote died?). from {0}".format(self.host))
-                rv += data
-                remaining -= len(data)
-            else:
-                raise exceptions.EOFError("Timeout waiting for socket recv. from {0}".format(self.host))
+                struct.unpack_from(RES_PKT_FMT, self._rbuf, self._rpos)
+        self._rpos += MIN_RECV_PACKET
+
+        self._fillRecvBuffer(remaining)
+        rv = bytes(self._rview[self._rpos:self._rpos + remaining])
+        self._rpos += remaining
+        if self._rpos == self._rend:
+            self._rpos = self._rend = 0
+            if len(self._rbuf) > RECV_BUFFER_SIZE:
+                # drop the buffer grown for a large body
+                self._rbuf = bytearray(RECV_BUFFER_SIZE)
+                self._rview = memoryview(self._rbuf)
 
         return cmd, errcode, opaque, cas, keylen, extralen, dtype, rv, frameextralen
 
@@ -572,17 +590,58 @@ class MemcachedClient(object):
         else:
             extras = ''
         opaque, cas, data = self._doCmd(memcacheConstants.CMD_GET_META, key, '', extras, collection=collection)
-        deleted = struct.unpack('>I', data[0:4])[0]
-        flags = struct.unpack('>I', data[4:8])[0]
-        exp = struct.unpack('>I', data[8:12])[0]
-        seqno = struct.unpack('>Q', data[12:20])[0]
+        return self.__parseMeta(data, cas, request_extended_meta_data)
 
+    def __parseMeta(self, data, cas, request_extended_meta_data=False):
+        deleted, flags, exp, seqno = struct.unpack_from('>IIIQ', data)
         if request_extended_meta_data:
             conflict_res = struct.unpack('>B', data[20:21])[0]
             return (deleted, flags, exp, seqno, cas, conflict_res)
         else:
             return (deleted, flags, exp, seqno, cas)
 
+    def getMetaMulti(self, keys, vbucket= -1, collection=None):
+        """Get the metadata of the given keys with pipelined quiet get_meta.
+
+        Returns a dict of the keys the server has (deleted ones included) to
+        (deleted, flags, exp, seqno, cas), missing keys are left out. An
+        error response is raised once all the responses are read."""
+        collection = self.collection_name(collection)
+
+        opaqued = dict(enumerate(keys))
+        terminal = len(opaqued) + 10
+        buf = bytearray()
+        vbs = set()
+        for k, v in opaqued.items():
+            self._set_vbucket(v, vbucket, collection=collection)
+            vbs.add(self.vbucketId)
+            self._appendCmd(buf, memcacheConstants.CMD_GETQ_META, v, '', k, collection=collection)
+
+        for vb in vbs:
+            self.vbucketId = vb
+            self._appendCmd(buf, memcacheConstants.CMD_NOOP, '', '', terminal)
+        self._sendBuffer(buf)
+
+        rv = {}
+        error = None
+        for vb in vbs:
+            self.vbucketId = vb
+            done = False
+            while not done:
+                try:
+                    opaque, cas, data = self._handleSingleResponse(None)
+                except MemcachedError as e:
+                    # keep reading up to the noop so the connection stays usable
+                    error = error or e
+                    continue
+                if opaque != terminal:
+                    rv[opaqued[opaque]] = self.__parseMeta(data, cas)
+                else:
+                    done = True
+        if error is not None:
+            raise error
+        return rv
+
 
     def get_adjusted_time(self, vbucket, collection=None):
         """Get the value for a given key within the memcached server."""
@@ -722,16 +781,18 @@ class MemcachedClient(object):
 
         opaqued = dict(enumerate(keys))
         terminal = len(opaqued) + 10
-        # Send all of the keys in quiet
+        # Send all of the keys in quiet, in one write
+        buf = bytearray()
         vbs = set()
         for k, v in opaqued.items():
             self._set_vbucket(v, vbucket, collection=collection)
             vbs.add(self.vbucketId)
-            self._sendCmd(memcacheConstants.CMD_GETQ, v, '', k, collection=collection)
+            self._appendCmd(buf, memcacheConstants.CMD_GETQ, v, '', k, collection=collection)
 
         for vb in vbs:
             self.vbucketId = vb
-            self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
+            self._appendCmd(buf, memcacheConstants.CMD_NOOP, '', '', terminal)
+        self._sendBuffer(buf)
 
         # Handle the response
         rv = {}
@@ -762,16 +823,18 @@ class MemcachedClient(object):
         terminal = len(opaqued) + 10
         extra = struct.pack(SET_PKT_FMT, flags, exp)
 
-        # Send all of the keys in quiet
+        # Send all of the keys in quiet, in one write
+        buf = bytearray()
         vbs = set()
         for opaque, kv in opaqued.items():
             self._set_vbucket(kv[0], vbucket, collection=collection)
             vbs.add(self.vbucketId)
-            self._sendCmd(memcacheConstants.CMD_SETQ, kv[0], kv[1], opaque, extra, collection=collection)
+            self._appendCmd(buf, memcacheConstants.CMD_SETQ, kv[0], kv[1], opaque, extra, collection=collection)
 
         for vb in vbs:
             self.vbucketId = vb
-            self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
+            self._appendCmd(buf, memcacheConstants.CMD_NOOP, '', '', terminal)
+        self._sendBuffer(buf)
 
         # Handle the response
         failed = []
@@ -934,7 +997,7 @@ class MemcachedClient(object):
 
     def _set_vbucket(self, key, vbucket= -1, collection=None):
         if vbucket < 0:
-            self.vbucketId = (((zlib.crc32(key.encode())) >> 16) & 0x7fff) & (self.vbucket_count - 1)
+            self.vbucketId = crc32.vbucket_id(key, self.vbucket_count)
         else:
             self.vbucketId = vbucket
 
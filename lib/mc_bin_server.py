@@ -23,6 +23,12 @@ from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, EXTRA_HDR_FMTS
 VERSION = "1.0"
 
 
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
 class BaseBackend(object):
     """Higher-level backend (processes commands and stuff)."""
 
@@ -31,7 +37,10 @@ class BaseBackend(object):
     CMDS = {
         memcacheConstants.CMD_GET: 'handle_get',
         memcacheConstants.CMD_GETQ: 'handle_getq',
+        memcacheConstants.CMD_GET_META: 'handle_get_meta',
+        memcacheConstants.CMD_GETQ_META: 'handle_getq_meta',
         memcacheConstants.CMD_SET: 'handle_set',
+        memcacheConstants.CMD_SETQ: 'handle_setq',
         memcacheConstants.CMD_ADD: 'handle_add',
         memcacheConstants.CMD_REPLACE: 'handle_replace',
         memcacheConstants.CMD_DELETE: 'handle_delete',
@@ -105,6 +114,8 @@ class DictBackend(BaseBackend):
     def __init__(self):
         super(DictBackend, self).__init__()
         self.storage = {}
+        self.seqnos = {}
+        self.seqno = 0
         self.held_keys = {}
         self.challenge = ''.join(random.sample(string.ascii_letters
                                                + string.digits, 32))
@@ -125,7 +136,7 @@ class DictBackend(BaseBackend):
         val = self.__lookup(key)
         if val:
             rv = 0, id(val), struct.pack(
-                memcacheConstants.GET_RES_FMT, val[0]) + str(val[2])
+                memcacheConstants.GET_RES_FMT, val[0]) + _to_bytes(val[2])
         else:
             rv = self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
         return rv
@@ -139,6 +150,12 @@ class DictBackend(BaseBackend):
             return self.__handle_unconditional_set(cmd, hdrs, key, data)
         return self._withCAS(key, cas, f)
 
+    def handle_setq(self, cmd, hdrs, key, cas, data):
+        rv = self.handle_set(cmd, hdrs, key, cas, data)
+        if rv[0] == 0:
+            rv = None
+        return rv
+
     def handle_getq(self, cmd, hdrs, key, cas, data):
         rv = self.handle_get(cmd, hdrs, key, cas, data)
         if rv[0] == memcacheConstants.ERR_NOT_FOUND:
@@ -146,12 +163,29 @@ class DictBackend(BaseBackend):
             rv = None
         return rv
 
+    def handle_get_meta(self, cmd, hdrs, key, cas, data):
+        val = self.__lookup(key)
+        if val:
+            # not deleted, flags, expiry and the seqno of the last set
+            rv = 0, id(val), struct.pack('>IIIQ', 0, val[0], 0, self.seqnos.get(key, 0))
+        else:
+            rv = self._error(memcacheConstants.ERR_NOT_FOUND, 'Not found')
+        return rv
+
+    def handle_getq_meta(self, cmd, hdrs, key, cas, data):
+        rv = self.handle_get_meta(cmd, hdrs, key, cas, data)
+        if rv[0] == memcacheConstants.ERR_NOT_FOUND:
+            rv = None
+        return rv
+
     def __handle_unconditional_set(self, cmd, hdrs, key, data):
         exp = hdrs[1]
         # If it's going to expire soon, tell it to wait a while.
         if not exp:
             exp = float(2 ** 31)
         self.storage[key] = (hdrs[0], time.time() + exp, data)
+        self.seqno += 1
+        self.seqnos[key] = self.seqno
         print("Stored", self.storage[key], "in", key)
         if key in self.held_keys:
             del self.held_keys[key]
@@ -260,9 +294,9 @@ class DictBackend(BaseBackend):
         return 0, 0, 'PLAIN CRAM-MD5'
 
     def handle_sasl_step(self, cmd, hdrs, key, cas, data):
-        assert key == 'CRAM-MD5'
+        assert key == b'CRAM-MD5'
 
-        u, resp = data.split(' ', 1)
+        u, resp = data.decode().split(' ', 1)
         expected = hmac.HMAC('testpass', self.challenge).hexdigest()
 
         if u == 'testuser' and resp == expected:
@@ -273,7 +307,7 @@ class DictBackend(BaseBackend):
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
     def _handle_sasl_auth_plain(self, data):
-        foruser, user, passwd = data.split("\0")
+        foruser, user, passwd = data.decode().split("\0")
         if user == 'testuser' and passwd == 'testpass':
             print("Successful plain auth")
             return 0, 0, "OK"
@@ -282,12 +316,12 @@ class DictBackend(BaseBackend):
             return self._error(memcacheConstants.ERR_AUTH, 'Auth error.')
 
     def _handle_sasl_auth_cram_md5(self, data):
-        assert data == ''
+        assert data == b''
         print("Issuing %s as a CRAM-MD5 challenge." % self.challenge)
         return memcacheConstants.ERR_AUTH_CONTINUE, 0, self.challenge
 
     def handle_sasl_auth(self, cmd, hdrs, key, cas, data):
-        mech = key
+        mech = key.decode()
 
         if mech == 'PLAIN':
             return self._handle_sasl_auth_plain(data)
@@ -304,12 +338,12 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
     # Receive buffer size
     BUFFER_SIZE = 4096
 
-    def __init__(self, channel, backend, wbuf=""):
+    def __init__(self, channel, backend, wbuf=b""):
         asyncore.dispatcher.__init__(self, channel)
         self.log_info("New bin connection from %s" % str(self.addr))
         self.backend = backend
         self.wbuf = wbuf
-        self.rbuf = ""
+        self.rbuf = b""
 
     def __hasEnoughBytes(self):
         rv = False
@@ -338,7 +372,7 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
             # Remove this request from the read buffer
             self.rbuf = self.rbuf[MIN_RECV_PACKET + remaining:]
             # Process the command
-            cmdVal = self.processCommand(cmd, keylen, vb, extralen, cas, data)
+            cmdVal = self.processCommand(cmd, keylen, vb, cas, data)
             # Queue the response to the client if applicable.
             if cmdVal:
                 try:
@@ -347,6 +381,7 @@ class MemcachedBinaryChannel(asyncore.dispatcher):
                     print("Got", cmdVal)
                     raise
                 dtype = 0
+                response = _to_bytes(response)
                 extralen = memcacheConstants.EXTRA_HDR_SIZES.get(cmd, 0)
                 self.wbuf += struct.pack(RES_PKT_FMT,
                                          RES_MAGIC_BYTE, cmd, keylen,
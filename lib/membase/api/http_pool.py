@@ -0,0 +1,235 @@
+import atexit
+import bisect
+import collections
+import os
+import select
+import socket
+import threading
+import time
+import urllib.parse
+
+from . import httplib2
+import logger
+
+log = logger.Logger.get_logger()
+
+# keep-alive connections kept idle per (scheme, host, port)
+DEFAULT_MAX_PER_HOST = 8
+
+# upper bounds (in ms) of the latency histogram buckets, the last bucket
+# collects everything slower
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class RequestMetrics(object):
+    """Per endpoint request count, latency histogram and bytes counters
+
+    An endpoint is the method, host:port and path of a request, the query
+    string is dropped so polling the same api is accounted once."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def __call__(self, method, uri, status, latency, bytes_sent, bytes_received):
+        parts = urllib.parse.urlsplit(uri)
+        endpoint = "{0} {1}{2}".format(method, parts.netloc, parts.path)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, latency * 1000)
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "count": 0, "errors": 0, "latency_total": 0.0, "latency_max": 0.0,
+                    "bytes_sent": 0, "bytes_received": 0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            stats["count"] += 1
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+            stats["histogram"][bucket] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(stats, histogram=list(stats["histogram"]))
+                    for endpoint, stats in self.endpoints.items()}
+
+    def summary(self):
+        lines = []
+        stats = self.snapshot()
+        for endpoint in sorted(stats, key=lambda e: -stats[e]["count"]):
+            s = stats[endpoint]
+            lines.append("{0}: count {1}, errors {2}, avg {3:.1f} ms, max {4:.1f} ms, "
+                         "sent {5} bytes, received {6} bytes, histogram {7}"
+                         .format(endpoint, s["count"], s["errors"],
+                                 s["latency_total"] * 1000 / s["count"], s["latency_max"] * 1000,
+                                 s["bytes_sent"], s["bytes_received"], s["histogram"]))
+        return lines
+
+    def log_summary(self):
+        if self.endpoints:
+            log.info("rest api calls per endpoint, histogram buckets are <= {0} ms and above"
+                     .format(LATENCY_BUCKETS_MS))
+            for line in self.summary():
+                log.info(line)
+
+
+class HttpConnectionPool(object):
+    """Process wide pool of keep-alive httplib2.Http objects
+
+    Every Http object is checked out by one thread for the duration of a
+    request and given back afterwards, so task threads can share the pool.
+    At most max_per_host idle objects are kept per (scheme, host, port);
+    extra ones are closed when they are given back. Idle sockets the server
+    has closed are dropped on checkout and a request which fails on a reused
+    socket because the peer went away is retried once on a new connection.
+    A forked child starts with an empty pool, it must not read the
+    responses meant for its parent.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(collections.deque)
+        self._hooks = []
+        self.metrics = None
+        self._pid = os.getpid()
+
+    def request(self, uri, method="GET", body=None, headers=None, timeout=None):
+        key = self._key(uri)
+        http, reused = self._checkout(key, timeout)
+        start = time.time()
+        response = None
+        content = b''
+        try:
+            try:
+                response, content = http.request(uri, method, body, headers)
+            except socket.timeout:
+                raise
+            except ConnectionError:
+                if not reused:
+                    raise
+                # the server closed the keep-alive connection while it was idle
+                self._close(http)
+                http = self._new_http(timeout)
+                response, content = http.request(uri, method, body, headers)
+        except Exception:
+            self._close(http)
+            raise
+        finally:
+            if self._hooks:
+                self._call_hooks(method, uri, response, time.time() - start, body, content)
+        self._checkin(key, http)
+        return response, content
+
+    def add_hook(self, hook):
+        """hook is called after every request with (method, uri, status,
+        latency, bytes_sent, bytes_received), status is None if the request
+        failed without a response"""
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def enable_metrics(self):
+        with self._lock:
+            if self.metrics is None:
+                self.metrics = RequestMetrics()
+                self._hooks.append(self.metrics)
+                atexit.register(self.metrics.log_summary)
+            return self.metrics
+
+    def _check_pid(self):
+        # the idle sockets of the parent are dropped, not closed, they
+        # are still in use on its side
+        if self._pid != os.getpid():
+            self._idle = collections.defaultdict(collections.deque)
+            self._pid = os.getpid()
+
+    def reset(self):
+        """forgets the idle connections without closing them, for a child
+        process right after the fork"""
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(collections.deque)
+        self._pid = os.getpid()
+
+    def clear(self):
+        with self._lock:
+            self._check_pid()
+            idle = [http for https in self._idle.values() for http in https]
+            self._idle.clear()
+        for http in idle:
+            self._close(http)
+
+    def _key(self, uri):
+        parts = urllib.parse.urlsplit(uri)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return parts.scheme, parts.hostname, port
+
+    def _new_http(self, timeout):
+        return httplib2.Http(timeout=timeout)
+
+    def _checkout(self, key, timeout):
+        while True:
+            with self._lock:
+                self._check_pid()
+                idle = self._idle.get(key)
+                http = idle.pop() if idle else None
+            if http is None:
+                return self._new_http(timeout), False
+            if self._alive(http):
+                http.timeout = timeout
+                for conn in http.connections.values():
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                return http, True
+            self._close(http)
+
+    def _checkin(self, key, http):
+        with self._lock:
+            self._check_pid()
+            idle = self._idle[key]
+            if len(idle) < self.max_per_host:
+                idle.append(http)
+                return
+        self._close(http)
+
+    def _alive(self, http):
+        """an idle keep-alive socket must not be readable, if it is the
+        server either closed it or sent something we can't make sense of"""
+        socks = [conn.sock for conn in http.connections.values() if conn.sock is not None]
+        if not socks:
+            return False
+        try:
+            readable, _, _ = select.select(socks, [], [], 0)
+        except (ValueError, OSError):
+            return False
+        return not readable
+
+    def _close(self, http):
+        for conn in http.connections.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        http.connections.clear()
+
+    def _call_hooks(self, method, uri, response, latency, body, content):
+        status = int(response.status) if response is not None else None
+        sent = len(body) if body else 0
+        received = len(content) if content else 0
+        for hook in list(self._hooks):
+            try:
+                hook(method, uri, status, latency, sent, received)
+            except Exception as e:
+                log.warn("http pool metrics hook {0} failed: {1}".format(hook, e))
+
+
+POOL = HttpConnectionPool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=POOL.reset)
@@ -2,6 +2,7 @@ import base64
 import json
 import urllib.request, urllib.parse, urllib.error
 from . import httplib2
+from .http_pool import POOL as HTTP_POOL
 import logger
 import traceback
 import socket
@@ -9,7 +10,7 @@ import time
 import re
 import uuid
 from copy import deepcopy
-from threading import Thread
+from threading import Thread, Lock
 from TestInput import TestInputSingleton
 from TestInput import TestInputServer
 from testconstants import MIN_KV_QUOTA, INDEX_QUOTA, FTS_QUOTA, CBAS_QUOTA
@@ -21,7 +22,7 @@ try:
 except ImportError:
     from lib.couchbase_helper.document import DesignDocument, View
 
-from memcached.helper.kvstore import KVStore
+from memcached.helper.kvstore import KVStore, CompactKVStore
 from .exception import ServerAlreadyJoinedException, ServerUnavailableException, InvalidArgumentException
 from membase.api.exception import BucketCreationException, ServerSelfJoinException, ClusterRemoteException, \
     RebalanceFailedException, FailoverFailedException, DesignDocCreationException, QueryViewException, \
@@ -29,6 +30,35 @@ from membase.api.exception import BucketCreationException, ServerSelfJoinExcepti
     BucketFlushFailed, CBRecoveryFailedException, XDCRException, SetRecoveryTypeFailed, BucketCompactionException
 log = logger.Logger.get_logger()
 
+# couchApiBase of the nodes RestConnection has already bootstrapped, keyed by
+# (baseUrl, username, password) and stored with the time it was fetched, so
+# connecting to a known node does not need a nodes/self round trip
+BOOTSTRAP_CACHE_TTL = 300
+_bootstrap_cache = {}
+_bootstrap_lock = Lock()
+_bootstrap_stats = {"saved": 0, "fetched": 0}
+
+
+def invalidate_bootstrap_cache(base_url=None):
+    """forget the cached couchApiBase of base_url, or of all nodes"""
+    with _bootstrap_lock:
+        if base_url is None:
+            _bootstrap_cache.clear()
+        else:
+            for key in [key for key in _bootstrap_cache if key[0] == base_url]:
+                del _bootstrap_cache[key]
+
+
+def bootstrap_cache_stats(reset=False):
+    """returns how many nodes/self bootstraps were fetched and how many
+    were saved by the cache, optionally resetting the counters"""
+    with _bootstrap_lock:
+        stats = dict(_bootstrap_stats)
+        if reset:
+            _bootstrap_stats["saved"] = 0
+            _bootstrap_stats["fetched"] = 0
+    return stats
+
 # helper library methods built on top of RestConnection interface
 
 class RestHelper(object):
@@ -221,6 +251,9 @@ class RestHelper(object):
         return vbuckets_servers
 
 class RestConnection(object):
+    # set when capiBaseUrl was taken from the bootstrap cache
+    _capi_from_cache = False
+
     def __new__(cls, serverInfo={}):
         # allow port to determine
         # behavior of restconnection
@@ -309,6 +342,8 @@ class RestConnection(object):
                 new_services=fts-kv-index-n1ql """
             self.services_node_init = self.input.param("new_services", None)
             self.debug_logs = self.input.param("debug-logs", False)
+            if self.input.param("rest_metrics", False):
+                HTTP_POOL.enable_metrics()
         self.baseUrl = "http://{0}:{1}/".format(self.ip, self.port)
         self.fts_baseUrl = "http://{0}:{1}/".format(self.ip, self.fts_port)
         self.index_baseUrl = "http://{0}:{1}/".format(self.ip, self.index_port)
@@ -335,6 +370,35 @@ class RestConnection(object):
             elif "cbas" in self.services:
                 self.cbas_base_url = "http://{0}:{1}".format(self.ip, 8095)
 
+        ttl = BOOTSTRAP_CACHE_TTL
+        if self.input is not None:
+            ttl = self.input.param("rest_bootstrap_ttl", BOOTSTRAP_CACHE_TTL)
+        key = (self.baseUrl, self.username, self.password)
+        with _bootstrap_lock:
+            cached = _bootstrap_cache.get(key)
+            if cached is not None and time.time() - cached[1] < ttl:
+                _bootstrap_stats["saved"] += 1
+                self.capiBaseUrl = cached[0]
+                self._capi_from_cache = True
+                return
+        self.capiBaseUrl = self._bootstrap_capi_base_url()
+        with _bootstrap_lock:
+            _bootstrap_stats["fetched"] += 1
+            # the couchBase fallback is also used when nodes/self failed,
+            # so only cache a couchApiBase the node reported
+            if ttl > 0 and self.capiBaseUrl != self.baseUrl + "/couchBase":
+                _bootstrap_cache[key] = (self.capiBaseUrl, time.time())
+
+    def _refresh_capi_base_url(self):
+        """bootstraps again after a request to a cached couchApiBase failed,
+        returns the old base url"""
+        old_capi_base_url = self.capiBaseUrl
+        self._capi_from_cache = False
+        invalidate_bootstrap_cache(self.baseUrl)
+        self.capiBaseUrl = self._bootstrap_capi_base_url()
+        return old_capi_base_url
+
+    def _bootstrap_capi_base_url(self):
         # for Node is unknown to this cluster error
         for iteration in range(5):
             #log.info("--> api baseurl is {},{},{}".format(type(self.baseUrl),type('nodes/selfr'),self.baseUrl + 'nodes/self'))
@@ -355,18 +419,16 @@ class RestConnection(object):
         # determine the real couchApiBase for cluster_run
         # couchApiBase appeared in version 2.*
         if not http_res or http_res["version"][0:2] == "1.":
-            self.capiBaseUrl = self.baseUrl + "/couchBase"
+            return self.baseUrl + "/couchBase"
         else:
             for iteration in range(5):
                 if "couchApiBase" not in list(http_res.keys()):
                     if self.is_cluster_mixed():
-                        self.capiBaseUrl = self.baseUrl + "/couchBase"
-                        return
+                        return self.baseUrl + "/couchBase"
                     time.sleep(0.2)
                     http_res, success = self.init_http_request(self.baseUrl + 'nodes/self')
                 else:
-                    self.capiBaseUrl = http_res["couchApiBase"]
-                    return
+                    return http_res["couchApiBase"]
             raise ServerUnavailableException("couchApiBase doesn't exist in nodes/self: %s " % http_res)
 
     def sasl_streaming_rq(self, bucket, timeout=120):
@@ -374,6 +436,7 @@ class RestConnection(object):
         if isinstance(bucket, Bucket):
             api = self.baseUrl + 'pools/default/bucketsStreaming/{0}'.format(bucket.name)
         try:
+            # the stream holds the connection until timeout, keep it out of HTTP_POOL
             httplib2.Http(timeout=timeout).request(api, 'GET', '',
                                                    headers=self._create_capi_headers())
         except Exception as ex:
@@ -466,6 +529,7 @@ class RestConnection(object):
 
         api = "%snode/controller/rename" % (self.baseUrl)
         status, content, header = self._http_request(api, 'POST', params)
+        invalidate_bootstrap_cache()
         return status, content
 
     def active_tasks(self):
@@ -861,8 +925,8 @@ class RestConnection(object):
                         log.info("--->Start calling httplib2.Http({}).request({},{},{},{})".format(timeout,api,headers,method,params))
                 except AttributeError:
                     pass
-                response, content = httplib2.Http(timeout=timeout).request(api, method,
-                                                                           params, headers)
+                response, content = HTTP_POOL.request(api, method, params, headers,
+                                                      timeout=timeout)
                 try:
                     if TestInputSingleton.input.param("debug.api.calls", False):
                         log.info(
@@ -903,6 +967,10 @@ class RestConnection(object):
                 if time.time() > end_time:
                     log.error("Tried ta connect {0} times".format(count))
                     raise ServerUnavailableException(ip=self.ip)
+            if self._capi_from_cache and api.startswith(self.capiBaseUrl):
+                # couchApiBase came from the bootstrap cache and may be stale
+                old_capi_base_url = self._refresh_capi_base_url()
+                api = self.capiBaseUrl + api[len(old_capi_base_url):]
             time.sleep(3)
             count += 1
 
@@ -915,6 +983,7 @@ class RestConnection(object):
         log.info('settings/web params on {0}:{1}:{2}'.format(self.ip, self.port, params))
         status, content, header = self._http_request(api, 'POST', params)
         log.info("--> status:{}".format(status))
+        invalidate_bootstrap_cache()
         return status
 
     def init_node(self):
@@ -1440,6 +1509,7 @@ class RestConnection(object):
                                    'user': user,
                                    'password': password})
         status, content, header = self._http_request(api, 'POST', params)
+        invalidate_bootstrap_cache()
         if status:
             log.info('ejectNode successful')
         else:
@@ -1453,6 +1523,7 @@ class RestConnection(object):
 
     def force_eject_node(self):
         self.diag_eval("gen_server:cast(ns_cluster, leave).")
+        invalidate_bootstrap_cache()
         self.check_delay_restart_coucbase_server()
 
     """ when we do reset couchbase server by force reject, couchbase server will not
@@ -1466,7 +1537,7 @@ class RestConnection(object):
         count_cbserver_up = 0
         while break_out < 60 and count_cbserver_up < 2:
             try:
-                response, content = httplib2.Http(timeout=120).request(api, 'GET', '', headers)
+                response, content = HTTP_POOL.request(api, 'GET', '', headers, timeout=120)
                 if response['status'] in ['200', '201', '202'] and count_cbserver_up == 0:
                     log.info("couchbase server is up but down soon.")
                     time.sleep(1)
@@ -1492,6 +1563,7 @@ class RestConnection(object):
             api = self.baseUrl + 'controller/startGracefulFailover'
         params = urllib.parse.urlencode({'otpNode': otpNode})
         status, content, header = self._http_request(api, 'POST', params)
+        invalidate_bootstrap_cache()
         if status:
             log.info('fail_over node {0} successful'.format(otpNode))
         else:
@@ -1525,6 +1597,7 @@ class RestConnection(object):
         api = self.baseUrl + 'controller/reAddNode'
         params = urllib.parse.urlencode({'otpNode': otpNode})
         status, content, header = self._http_request(api, 'POST', params)
+        invalidate_bootstrap_cache()
         if status:
             log.info('add_back_node {0} successful'.format(otpNode))
         else:
@@ -1552,6 +1625,7 @@ class RestConnection(object):
         params = urllib.parse.urlencode(params)
         api = self.baseUrl + "controller/rebalance"
         status, content, header = self._http_request(api, 'POST', params)
+        invalidate_bootstrap_cache()
         if status:
             log.info('rebalance operation started')
         else:
@@ -4895,7 +4969,10 @@ class Bucket(object):
         self.saslPassword = saslPassword
         self.authType = ""
         self.bucket_size = bucket_size
-        self.kvs = {1:KVStore()}
+        if TestInputSingleton.input and TestInputSingleton.input.param("compact_kvstore", False):
+            self.kvs = {1:CompactKVStore()}
+        else:
+            self.kvs = {1:KVStore()}
         self.authType = authType
         self.master_id = master_id
         self.eviction_policy = eviction_policy
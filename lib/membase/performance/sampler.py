@@ -0,0 +1,112 @@
+import os
+import tempfile
+import time
+
+REMOTE_SAMPLER_PATH = "/tmp/testrunner_stats_sampler.sh"
+
+# prints, in one exec, the time and uptime of the node, the cpu line of /proc/stat,
+# sectors read/written and io ticks of the sd? disks and /proc/<pid>/stat
+# of the first process named or running with each of the names, the way
+# RemoteMachineHelper.is_process_running finds them. The names go to awk
+# in the environment so that the sampler never matches itself.
+SAMPLER_SCRIPT = r"""#!/bin/sh
+PNAMES="{pnames}"
+echo "time $(date +%s.%N)"
+echo "uptime $(cut -d ' ' -f 1 /proc/uptime)"
+grep '^cpu ' /proc/stat
+awk '$3 ~ /^sd.$/ {{print "disk", $6, $10, $13}}' /proc/diskstats
+ps -Ao pid,comm,args | PNAMES="$PNAMES" awk '
+BEGIN {{n = split(ENVIRON["PNAMES"], names, " ")}}
+NR > 1 {{
+    args = $3
+    for (j = 4; j <= NF; j++) args = args " " $j
+    for (i = 1; i <= n; i++)
+        if (!(i in pids) && ($2 == names[i] || index(args, names[i])))
+            pids[i] = $1
+}}
+END {{for (i = 1; i <= n; i++) if (i in pids) print names[i], pids[i]}}' |
+while read pname pid; do
+    stat=$(cat /proc/$pid/stat 2>/dev/null) && echo "proc $pname $pid $stat"
+done
+"""
+
+
+class RemoteSampler(object):
+    """Samples the process, io and cpu counters of a node with one exec
+
+    install() pushes a sampler script to the node once, every sample() runs
+    it and parses its output into
+
+        {"time": time on the node,
+         "procs": {pname: (pid, /proc/<pid>/stat line)},
+         "io": (kB_read, kB_wrtn, %util) or None,
+         "cpu": (%iowait, %idle) or None}
+
+    kB_read and kB_wrtn are totals since boot like the ones of iostat -dk,
+    %util (the average of the disks), %iowait and %idle are over the time
+    since the previous sample, or since boot for the first one.
+    """
+
+    def __init__(self, shell, pnames, path=REMOTE_SAMPLER_PATH):
+        self.shell = shell
+        self.pnames = pnames
+        self.path = path
+        self._cpu = None
+        self._io_ticks = (0.0, 0)
+
+    def install(self):
+        fd, local_path = tempfile.mkstemp(suffix=".sh")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(SAMPLER_SCRIPT.format(pnames=" ".join(self.pnames)))
+            self.shell.copy_file_local_to_remote(local_path, self.path)
+        finally:
+            os.remove(local_path)
+        output, error = self.shell.execute_command("sh {0} > /dev/null && echo ok".format(self.path),
+                                                   debug=False)
+        if output != ["ok"]:
+            raise Exception("stats sampler does not run on {0}: {1}".format(self.shell.ip, error))
+
+    def sample(self):
+        output, error = self.shell.execute_command("sh {0}".format(self.path), debug=False)
+        sample = {"time": time.time(), "procs": {}, "io": None, "cpu": None}
+        disks = []
+        uptime = None
+        for line in output:
+            kind, _, rest = line.partition(" ")
+            if kind == "time":
+                try:
+                    sample["time"] = float(rest)
+                except ValueError:
+                    # a date without %N, the local time is close enough
+                    pass
+            elif kind == "uptime":
+                uptime = float(rest)
+            elif kind == "cpu":
+                sample["cpu"] = self._cpu_usage([int(v) for v in rest.split()])
+            elif kind == "disk":
+                disks.append([int(v) for v in rest.split()])
+            elif kind == "proc":
+                pname, pid, stat = rest.split(" ", 2)
+                sample["procs"][pname] = (pid, stat)
+        if disks and uptime is not None:
+            sample["io"] = self._io_usage(disks, uptime)
+        return sample
+
+    def _cpu_usage(self, ticks):
+        # user nice system idle iowait irq softirq steal, guest time is in user
+        ticks = ticks[:8]
+        previous, self._cpu = self._cpu or [0] * len(ticks), ticks
+        delta = [now - before for now, before in zip(ticks, previous)]
+        total = float(sum(delta)) or 1.0
+        return "{0:.2f}".format(100 * delta[4] / total), "{0:.2f}".format(100 * delta[3] / total)
+
+    def _io_usage(self, disks, uptime):
+        # sectors are 512 bytes whatever the disk, io ticks are ms the disk was busy
+        kB_read = sum(disk[0] for disk in disks) // 2
+        kB_wrtn = sum(disk[1] for disk in disks) // 2
+        io_ticks = sum(disk[2] for disk in disks)
+        (previous_uptime, previous_ticks), self._io_ticks = self._io_ticks, (uptime, io_ticks)
+        elapsed_ms = 1000 * (uptime - previous_uptime) or 1.0
+        util = 100 * (io_ticks - previous_ticks) / elapsed_ms / len(disks)
+        return str(kB_read), str(kB_wrtn), "{0:.2f}".format(util)
@@ -1,9 +1,11 @@
 import json
+import os
 import re
 from threading import Thread
 import time
 import gzip
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import logging.config
 from uuid import uuid4
@@ -12,11 +14,24 @@ from itertools import cycle
 from lib.membase.api.exception import SetViewInfoNotFound, ServerUnavailableException
 from lib.membase.api.rest_client import RestConnection
 from lib.memcached.helper.data_helper import MemcachedClientHelper, VBucketAwareMemcached
+from lib.membase.performance.sampler import RemoteSampler
+from lib.membase.performance.timeseries import TimeSeriesStore
 from lib.remote.remote_util import RemoteMachineShellConnection, RemoteMachineHelper
+from TestInput import TestInputSingleton
 
 
 RETRIES = 10
 
+PROC_STAT_FIELDS = (
+    'pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr',
+    'tpgid', 'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt',
+    'utime', 'stime', 'cutime', 'cstime', 'priority ' 'nice',
+    'num_threads', 'itrealvalue', 'starttime', 'vsize', 'rss',
+    'rsslim', 'startcode', 'endcode', 'startstack', 'kstkesp',
+    'kstkeip', 'signal', 'blocked ', 'sigignore', 'sigcatch', 'wchan',
+    'nswap', 'cnswap', 'exit_signal', 'processor', 'rt_priority',
+    'policy', 'delayacct_blkio_ticks', 'guest_time', 'cguest_time')
+
 logging.config.fileConfig('mcsoda.logging.conf')
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 log = logging.getLogger()
@@ -58,9 +73,14 @@ class StatsCollector(object):
         self.active_mergers = 0
 
     def start(self, nodes, bucket, pnames, name, client_id='',
-              collect_server_stats=True, ddoc=None, clusters=None):
+              collect_server_stats=True, ddoc=None, clusters=None,
+              remote_sampler=True):
         """This function starts collecting stats from all nodes with the given
-        interval"""
+        interval
+
+        With remote_sampler the system and io stats of a node come from one
+        exec of a sampler script per interval (see sampled_stats), otherwise
+        from a few ssh commands per process and node."""
         self._task = {"state": "running", "threads": [], "name": name,
                       "time": time.time(), "ops": [], "totalops": [],
                       "ops-temp": [], "latency": {}, "data_size_stats": []}
@@ -70,17 +90,23 @@ class StatsCollector(object):
         self.client_id = str(client_id)
         self.nodes = nodes
         self.bucket = bucket
+        self.series = TimeSeriesStore(self._series_dir(name))
 
         if collect_server_stats:
             self._task["threads"].append(
                 Thread(target=self.membase_stats, name="membase")
             )
-            self._task["threads"].append(
-                Thread(target=self.system_stats, name="system", args=(pnames, ))
-            )
-            self._task["threads"].append(
-                Thread(target=self.iostats, name="iostats")
-            )
+            if remote_sampler:
+                self._task["threads"].append(
+                    Thread(target=self.sampled_stats, name="system", args=(pnames, ))
+                )
+            else:
+                self._task["threads"].append(
+                    Thread(target=self.system_stats, name="system", args=(pnames, ))
+                )
+                self._task["threads"].append(
+                    Thread(target=self.iostats, name="iostats")
+                )
             self._task["threads"].append(
                 Thread(target=self.ns_server_stats, name="ns_server")
             )
@@ -114,6 +140,13 @@ class StatsCollector(object):
             # Start atop
             self.start_atop()
 
+    def _series_dir(self, name):
+        """server stats samples are spilled under the logs folder of the test"""
+        logs_folder = TestInputSingleton.input.param("logs_folder", "/tmp") \
+            if TestInputSingleton.input else "/tmp"
+        return os.path.join(logs_folder, "stats-{0}-{1}".format(
+            re.sub(r'[^\w.-]', '_', name), int(self._task["time"])))
+
     def stop(self):
         self.stop_atop()
         self._task["state"] = "stopped"
@@ -186,9 +219,9 @@ class StatsCollector(object):
         obj = {
             "buildinfo": self._task.get("buildstats", {}),
             "machineinfo": self._task.get("machinestats", {}),
-            "membasestats": self._task.get("membasestats", []),
-            "systemstats": self._task.get("systemstats", []),
-            "iostats": self._task.get("iostats", []),
+            "membasestats": self._mb_stats["snapshots"] or self._series_samples("membasestats"),
+            "systemstats": self._series_samples("systemstats"),
+            "iostats": self._series_samples("iostats"),
             "name": name,
             "totalops": self._task["totalops"],
             "ops": self._task["ops"],
@@ -200,8 +233,8 @@ class StatsCollector(object):
             "indexer_info": self._task.get("indexer_info", []),
             "xdcr_lag": self._task.get("xdcr_lag", []),
             "rebalance_progress": self._task.get("rebalance_progress", []),
-            "timings": self._task.get("timings", []),
-            "dispatcher": self._task.get("dispatcher", []),
+            "timings": self._series_samples("timings"),
+            "dispatcher": self._series_samples("dispatcher"),
             "bucket-size": self._task.get("bucket_size", []),
             "data-size": self._task.get("data_size_stats", []),
             "latency-set-histogram": self._task["latency"].get("latency-set-histogram", []),
@@ -247,10 +280,15 @@ class StatsCollector(object):
                 phase = '.loop'
             name = str(self.client_id) + phase
 
-        file = gzip.open("{0}.json.gz".format(name), 'wb')
+        file = gzip.open("{0}.json.gz".format(name), 'wt')
         file.write(json.dumps(obj))
         file.close()
 
+    def _series_samples(self, group):
+        if not hasattr(self, "series"):
+            return []
+        return list(self.series.samples(group))
+
     def get_bucket_size(self, interval=60):
         self._task["bucket_size"] = []
         retries = 0
@@ -393,17 +431,7 @@ class StatsCollector(object):
 
     def _extract_proc_info(self, shell, pid):
         output, error = shell.execute_command("cat /proc/{0}/stat".format(pid))
-        fields = (
-            'pid', 'comm', 'state', 'ppid', 'pgrp', 'session', 'tty_nr',
-            'tpgid', 'flags', 'minflt', 'cminflt', 'majflt', 'cmajflt',
-            'utime', 'stime', 'cutime', 'cstime', 'priority ' 'nice',
-            'num_threads', 'itrealvalue', 'starttime', 'vsize', 'rss',
-            'rsslim', 'startcode', 'endcode', 'startstack', 'kstkesp',
-            'kstkeip', 'signal', 'blocked ', 'sigignore', 'sigcatch', 'wchan',
-            'nswap', 'cnswap', 'exit_signal', 'processor', 'rt_priority',
-            'policy', 'delayacct_blkio_ticks', 'guest_time', 'cguest_time')
-
-        return {} if error else dict(list(zip(fields, output[0].split(' '))))
+        return {} if error else dict(list(zip(PROC_STAT_FIELDS, output[0].split(' '))))
 
     def _extract_io_info(self, shell):
         """
@@ -439,8 +467,6 @@ class StatsCollector(object):
                 shells.append(RemoteMachineShellConnection(node))
             except Exception as error:
                 log.error(error)
-        d = {"snapshots": []}
-        #        "pname":"x","pid":"y","snapshots":[{"time":time,"value":value}]
 
         start_time = str(self._task["time"])
         while not self._aborted():
@@ -457,11 +483,11 @@ class StatsCollector(object):
                         value["name"] = pname
                         value["id"] = obj.pid
                         value["unique_id"] = unique_id
-                        value["time"] = current_time
                         value["ip"] = node.ip
-                        d["snapshots"].append(value)
+                        self.series.add("systemstats", "{0}-{1}".format(node.ip, pname),
+                                        value, current_time)
                 i += 1
-        self._task["systemstats"] = d["snapshots"]
+        self.series.flush()
         log.info("finished system_stats")
 
     def iostats(self, interval=10):
@@ -472,8 +498,6 @@ class StatsCollector(object):
             except Exception as error:
                 log.error(error)
 
-        self._task["iostats"] = []
-
         log.info("started capturing io stats")
 
         while not self._aborted():
@@ -486,15 +510,68 @@ class StatsCollector(object):
                 except (ValueError, TypeError, IndexError):
                     continue
                 if kB_read and kB_wrtn:
-                    self._task["iostats"].append({"time": time.time(),
-                                                 "ip": shell.ip,
-                                                 "read": kB_read,
-                                                 "write": kB_wrtn,
-                                                 "util": util,
-                                                 "iowait": iowait,
-                                                 "idle": idle})
+                    self.series.add("iostats", shell.ip, {"ip": shell.ip,
+                                                          "read": kB_read,
+                                                          "write": kB_wrtn,
+                                                          "util": util,
+                                                          "iowait": iowait,
+                                                          "idle": idle})
+        self.series.flush()
         log.info("finished capturing io stats")
 
+    def sampled_stats(self, pnames, interval=10):
+        """system_stats and iostats from a RemoteSampler per node
+
+        All nodes are sampled at once every interval, each with one exec,
+        and the samples carry the time on the node."""
+        samplers = []
+        for node in self.nodes:
+            try:
+                sampler = RemoteSampler(RemoteMachineShellConnection(node), pnames)
+                sampler.install()
+                samplers.append((node, sampler))
+            except Exception as error:
+                log.error(error)
+        if not samplers:
+            return
+
+        start_time = str(self._task["time"])
+        log.info("started sampling system and io stats of {0} nodes".format(len(samplers)))
+        with ThreadPoolExecutor(max_workers=len(samplers)) as executor:
+            next_time = time.time() + interval
+            while not self._aborted():
+                time.sleep(max(0, next_time - time.time()))
+                # a slow round delays the next one instead of bunching them up
+                next_time = max(next_time + interval, time.time())
+                futures = [(node, executor.submit(sampler.sample)) for node, sampler in samplers]
+                for node, future in futures:
+                    try:
+                        sample = future.result()
+                    except Exception as error:
+                        log.error("unable to sample {0}: {1}".format(node.ip, error))
+                        continue
+                    unique_id = node.ip + '-' + start_time
+                    for pname, (pid, stat) in sample["procs"].items():
+                        value = dict(list(zip(PROC_STAT_FIELDS, stat.split(' '))))
+                        value["name"] = pname
+                        value["id"] = pid
+                        value["unique_id"] = unique_id
+                        value["ip"] = node.ip
+                        self.series.add("systemstats", "{0}-{1}".format(node.ip, pname),
+                                        value, sample["time"])
+                    if sample["io"] and sample["cpu"]:
+                        kB_read, kB_wrtn, util = sample["io"]
+                        iowait, idle = sample["cpu"]
+                        self.series.add("iostats", node.ip, {"ip": node.ip,
+                                                             "read": kB_read,
+                                                             "write": kB_wrtn,
+                                                             "util": util,
+                                                             "iowait": iowait,
+                                                             "idle": idle},
+                                        sample["time"])
+        self.series.flush()
+        log.info("finished sampling system and io stats")
+
     def capture_mb_snapshot(self, node):
         """Capture membase stats snapshot manually"""
         log.info("capturing memcache stats snapshot for {0}".format(node.ip))
@@ -526,17 +603,14 @@ class StatsCollector(object):
                 mcs.append(mc)
             except Exception as error:
                 log.error(error)
-        self._task["membasestats"] = []
-        self._task["timings"] = []
-        self._task["dispatcher"] = []
-        data = dict()
-        for mc in mcs:
-            data[mc.host] = {"snapshots": [], "timings": [], "dispatcher": []}
+        latest_timings = dict()
+        start_time = str(self._task["time"])
 
         while not self._aborted():
             time.sleep(interval)
             log.info("collecting membase stats")
             for mc in mcs:
+                unique_id = mc.host + '-' + start_time
                 for rerty in range(RETRIES):
                     try:
                         stats = mc.stats()
@@ -548,47 +622,30 @@ class StatsCollector(object):
                         break
                 else:
                     stats = {}
-                data[mc.host]["snapshots"].append(stats)
+                stats["unique_id"] = unique_id
+                stats["ip"] = mc.host
+                self.series.add("membasestats", mc.host, stats)
 
                 for arg in ("timings", "dispatcher"):
                     try:
                         stats = mc.stats(arg)
-                        data[mc.host][arg].append(stats)
                     except EOFError as e:
                         log.error("unable to get {0} stats {1}: {2}"
                                   .format(arg, mc.host, e))
+                        continue
+                    if arg == "timings":
+                        latest_timings[mc.host] = dict(stats)
+                    stats["unique_id"] = unique_id
+                    stats["ip"] = mc.host
+                    self.series.add(arg, mc.host, stats)
 
         for host in (mc.host for mc in mcs):
-            unique_id = host + '-' + str(self._task["time"])
-            current_time = time.time()
-
-            if self._mb_stats["snapshots"]:  # use manually captured stats
-                self._task["membasestats"] = self._mb_stats["snapshots"]
-            else:  # use periodically captured stats
-                for snapshot in data[host]["snapshots"]:
-                    snapshot["unique_id"] = unique_id
-                    snapshot["time"] = current_time
-                    snapshot["ip"] = host
-                    self._task["membasestats"].append(snapshot)
-
-            for timing in data[host]["timings"]:
-                timing["unique_id"] = unique_id
-                timing["time"] = current_time
-                timing["ip"] = host
-                self._task["timings"].append(timing)
-
-            for dispatcher in data[host]["dispatcher"]:
-                dispatcher["unique_id"] = unique_id
-                dispatcher["time"] = current_time
-                dispatcher["ip"] = host
-                self._task["dispatcher"].append(dispatcher)
-
-            if data[host]["timings"]:
+            if host in latest_timings:
                 log.info("dumping disk timing stats: {0}".format(host))
-                latests_timings = data[host]["timings"][-1]
-                for key, value in sorted(latests_timings.items()):
+                for key, value in sorted(latest_timings[host].items()):
                     if key.startswith("disk"):
                         print("{0:50s}: {1}".format(key, value))
+        self.series.flush()
 
         log.info("finished membase_stats")
 
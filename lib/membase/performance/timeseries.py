@@ -0,0 +1,223 @@
+import array
+import glob
+import gzip
+import os
+import pickle
+import re
+import threading
+import time
+
+# samples of a series buffered before they are written as a chunk
+DEFAULT_CHUNK_SAMPLES = 60
+# seconds a buffered sample may wait for its chunk to be written
+DEFAULT_FLUSH_INTERVAL = 600
+
+# how a value is kept in its column, ints and floats (also the ones given
+# as strings, like all memcached stats) go to a float64 array, other values
+# are kept aside and only when they change
+ABSENT, INT, FLOAT, INT_STR, FLOAT_STR, OTHER, SAME_OTHER = range(7)
+
+# integers a float64 holds exactly
+MAX_EXACT_INT = 2 ** 53
+
+
+def _encode(value):
+    """returns the kind of value and its number"""
+    if isinstance(value, bool):
+        return OTHER, 0.0
+    if isinstance(value, int):
+        if -MAX_EXACT_INT < value < MAX_EXACT_INT:
+            return INT, float(value)
+    elif isinstance(value, float):
+        return FLOAT, value
+    elif isinstance(value, str):
+        try:
+            number = int(value)
+            if -MAX_EXACT_INT < number < MAX_EXACT_INT and str(number) == value:
+                return INT_STR, float(number)
+        except ValueError:
+            try:
+                number = float(value)
+                if repr(number) == value:
+                    return FLOAT_STR, number
+            except ValueError:
+                pass
+    return OTHER, 0.0
+
+
+_DECODERS = {INT: int,
+             FLOAT: float,
+             INT_STR: lambda number: str(int(number)),
+             FLOAT_STR: repr}
+
+
+class _Column(object):
+
+    def __init__(self, rows):
+        self.kinds = bytearray(rows)
+        self.values = array.array('d', bytes(8 * rows))
+        self.others = {}
+        self.last_other = None
+
+    def append(self, value):
+        kind, number = _encode(value)
+        if kind == OTHER:
+            if len(self.others) and value == self.last_other:
+                kind = SAME_OTHER
+            else:
+                self.others[len(self.kinds)] = value
+                self.last_other = value
+        self.kinds.append(kind)
+        self.values.append(number)
+
+    def append_absent(self):
+        self.kinds.append(ABSENT)
+        self.values.append(0.0)
+
+
+class _Chunk(object):
+    """samples of one series not written yet"""
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.columns = {}
+        self.started = time.time()
+
+    def add(self, timestamp, sample, intern):
+        rows = len(self.times)
+        seen = set()
+        for name, value in sample.items():
+            stat_id = intern(name)
+            column = self.columns.get(stat_id)
+            if column is None:
+                column = self.columns[stat_id] = _Column(rows)
+            column.append(value)
+            seen.add(stat_id)
+        for stat_id, column in self.columns.items():
+            if stat_id not in seen:
+                column.append_absent()
+        self.times.append(timestamp)
+
+    def __len__(self):
+        return len(self.times)
+
+
+class TimeSeriesStore(object):
+    """Stats samples kept as typed columns and spilled to compressed chunks
+
+    A sample is a dict of stat name to value taken on a source (a node, or a
+    process on a node) at some time, samples of the same group and source
+    make a series. Stat names are interned and every stat of a series is a
+    column of float64 values with a byte telling how to give the value back,
+    so a sample costs about 9 bytes per stat instead of a dict entry.
+
+    Every chunk_samples samples, or flush_interval seconds, the buffered
+    samples of a series are written as a gzip'ed chunk under directory, so
+    memory stays flat over long runs and a crash loses only the samples of
+    the last chunk. samples() reads the chunks back, decoding only the stats
+    it is asked for; a new store on the directory of a crashed run reads the
+    chunks that made it to disk.
+    """
+
+    def __init__(self, directory, chunk_samples=DEFAULT_CHUNK_SAMPLES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.directory = directory
+        self.chunk_samples = chunk_samples
+        self.flush_interval = flush_interval
+        self._names = {}
+        self._name_list = []
+        self._chunks = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _intern(self, name):
+        stat_id = self._names.get(name)
+        if stat_id is None:
+            stat_id = self._names[name] = len(self._name_list)
+            self._name_list.append(name)
+        return stat_id
+
+    def add(self, group, source, sample, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            chunk = self._chunks.get((group, source))
+            if chunk is None:
+                chunk = self._chunks[(group, source)] = _Chunk()
+            chunk.add(timestamp, sample, self._intern)
+            if len(chunk) >= self.chunk_samples or \
+                    time.time() - chunk.started >= self.flush_interval:
+                self._write(group, source)
+
+    def flush(self):
+        """writes every buffered sample"""
+        with self._lock:
+            for group, source in list(self._chunks.keys()):
+                self._write(group, source)
+
+    def _path(self, group, name, seq):
+        return os.path.join(self.directory, group, "{0}.{1}.chunk.gz".format(name, seq))
+
+    @staticmethod
+    def _file_name(source):
+        return re.sub(r'[^\w.-]', '_', source)
+
+    def _write(self, group, source):
+        chunk = self._chunks.pop((group, source))
+        seq = self._written.get((group, source), 0)
+        self._written[(group, source)] = seq + 1
+        columns = dict((self._name_list[stat_id], (bytes(column.kinds), column.values.tobytes(), column.others))
+                       for stat_id, column in chunk.columns.items())
+        path = self._path(group, self._file_name(source), "{0:06d}".format(seq))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # written aside and renamed so a crash never leaves half a chunk
+        with gzip.open(path + ".tmp", "wb", compresslevel=1) as f:
+            pickle.dump({"group": group, "source": source, "times": chunk.times.tobytes(),
+                         "columns": columns}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+
+    def samples(self, group, stats=None, source=None):
+        """
+            yields the samples of a group, or of one source of the group, as
+            dicts with the sample time under "time", series by series
+
+            stats is a predicate on the stat names to decode, all of them by
+            default. Buffered samples are written first.
+        """
+        self.flush()
+        pattern = self._path(group, "*" if source is None else self._file_name(source), "[0-9]" * 6)
+        for path in sorted(glob.glob(pattern)):
+            with gzip.open(path, "rb") as f:
+                chunk = pickle.load(f)
+            times = array.array('d')
+            times.frombytes(chunk["times"])
+            rows = [{} for _ in times]
+            for name, (kinds, values_bytes, others) in chunk["columns"].items():
+                if stats is not None and not stats(name):
+                    continue
+                values = array.array('d')
+                values.frombytes(values_bytes)
+                decode = _DECODERS.get(kinds[0]) if kinds else None
+                if decode is not None and kinds.count(kinds[0]) == len(kinds):
+                    # the usual column, a number in every sample
+                    for row, number in zip(rows, values):
+                        row[name] = decode(number)
+                    continue
+                other = None
+                for row, kind in enumerate(kinds):
+                    if kind == ABSENT:
+                        continue
+                    if kind == OTHER:
+                        other = others[row]
+                        rows[row][name] = other
+                    elif kind == SAME_OTHER:
+                        rows[row][name] = other
+                    else:
+                        rows[row][name] = _DECODERS[kind](values[row])
+            for row, timestamp in zip(rows, times):
+                # the sample time wins over a stat of the same name
+                row["time"] = timestamp
+                yield row
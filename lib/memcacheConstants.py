@@ -340,6 +340,7 @@ assert struct.calcsize(REQ_PKT_FMT) == struct.calcsize(RES_PKT_FMT)
 
 EXTRA_HDR_FMTS = {
     CMD_SET: SET_PKT_FMT,
+    CMD_SETQ: SET_PKT_FMT,
     CMD_ADD: SET_PKT_FMT,
     CMD_REPLACE: SET_PKT_FMT,
     CMD_INCR: INCRDECR_PKT_FMT,
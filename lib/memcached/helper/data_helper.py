@@ -9,7 +9,6 @@ import uuid
 from TestInput import TestInputServer
 from TestInput import TestInputSingleton
 import logger
-import zlib
 import crc32
 import hashlib
 import threading
@@ -1246,6 +1245,32 @@ class VBucketAwareMemcached(object):
             return keys_vals
 
 
+    def getMetaMulti(self, keys_lst, pause_sec=1, timeout_sec=5, collection=None):
+        """
+        returns {key: (deleted, flags, expiration, seqno, cas)} for the keys
+        found on their active vbuckets, the get_meta requests are pipelined
+        per server
+        """
+        keys_meta = {}
+        for server_str, keys in list(self._get_server_keys_dic(keys_lst).items()):
+            keys_meta.update(self._getMetaMulti_from_mc(self.memcacheds[server_str], keys, pause_sec,
+                                                        timeout_sec, collection=collection))
+        return keys_meta
+
+    def _getMetaMulti_from_mc(self, memcached_client, keys, pause, timeout, collection=None):
+        try:
+            return memcached_client.getMetaMulti(keys, collection=collection)
+        except MemcachedError as error:
+            if error.status not in [ERR_NOT_MY_VBUCKET, ERR_EINVAL] or timeout <= 0:
+                raise error
+        except (EOFError, socket.error) as error:
+            if timeout <= 0:
+                raise error
+        # the vbuckets moved or the node went away, regroup the keys on the new map
+        time.sleep(pause)
+        self.reset_vbuckets(self.rest, self._get_vBucket_ids(keys))
+        return self.getMetaMulti(keys, pause, timeout - pause, collection=collection)
+
     def _getMulti_from_mc(self, memcached_client, keys, pause, timeout, rec_caller_fn, collection=None):
         try:
             return memcached_client.getMulti(keys, collection=collection)
@@ -1289,11 +1314,11 @@ class VBucketAwareMemcached(object):
         return server_keys
 
     def _get_vBucket_ids(self, keys, collection=None):
-        return {self._get_vBucket_id(key) for key in keys}
+        return set(crc32.vbuckets_for(keys, len(self.vBucketMap)))
 
 
     def _get_vBucket_id(self, key, collection=None):
-        return (zlib.crc32(key.encode()) >> 16) & (len(self.vBucketMap) - 1)
+        return crc32.vbucket_id(key, len(self.vBucketMap))
 
 
     def delete(self, key, collection=None):
@@ -3,6 +3,28 @@ import random
 import zlib
 import time
 import copy
+import array
+import re
+import collections
+import concurrent.futures
+
+import logger
+
+log = logger.Logger.get_logger()
+
+# threads merge_from() runs the partitions on
+DEFAULT_MERGE_WORKERS = 4
+
+
+def compile_key_filter(filter_exp):
+    """
+    returns a predicate matching the keys an xdcr filter expression lets
+    through, either a key regex or an advanced filter on META().id
+    """
+    if "META().id" in filter_exp:
+        filter_exp = filter_exp.split('\'')[1]
+    return re.compile(str(filter_exp)).search
+
 
 class KVStore(object):
     def __init__(self, num_locks=1000):
@@ -104,16 +126,123 @@ class KVStore(object):
 
         for itr in range(self.num_locks):
 
+            # nothing to merge, do not bother taking the lock
+            partition = partitions[itr]['partition']
+            if not partition.has_valid_keys() and not partition.has_deleted_keys():
+                continue
+
             # lock
             self.cache[itr]["lock"].acquire()
 
             # merge
-            partition = partitions[itr]['partition']
             self.cache[itr]["partition"].merge(partition)
 
             # release
             self.cache[itr]["lock"].release()
 
+    def merge_from(self, other, key_filter=None, lww=False, workers=DEFAULT_MERGE_WORKERS):
+        """
+        merges the keys of another KVStore into this one the way xdcr
+        replicates them from other to this store
+
+        Valid keys of other which match key_filter and are not deleted here
+        are set, keys deleted in other and not deleted here are deleted. With
+        lww a key is left as it is if it changed here after it did in other.
+        Every partition of other is copied under its lock and applied under
+        the locks of the partitions of this store, one lock held at a time.
+
+        arguments:
+            key_filter -- predicate on the key or a filter expression
+                          (see compile_key_filter)
+
+        returns the number of keys matched, set, deleted and skipped by lww
+        """
+        if isinstance(key_filter, str):
+            key_filter = compile_key_filter(key_filter)
+        counts = collections.Counter()
+        counts_lock = threading.Lock()
+        progress = {"done": 0, "step": max(other.num_locks // 10, 1)}
+
+        def merge_partition(itr):
+            partition_counts = self._merge_partition(other, itr, key_filter, lww)
+            with counts_lock:
+                counts.update(partition_counts)
+                progress["done"] += 1
+                if progress["done"] % progress["step"] == 0:
+                    log.info("merged {0}/{1} partitions, {2} keys set, {3} deleted"
+                             .format(progress["done"], other.num_locks, counts["set"], counts["deleted"]))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() re-raises the errors of the partitions
+            list(executor.map(merge_partition, range(other.num_locks)))
+        return {name: counts[name] for name in ("matched", "set", "deleted", "skipped")}
+
+    def _merge_partition(self, other, itr, key_filter, lww):
+        with other.cache[itr]["lock"]:
+            partition = other.cache[itr]["partition"]
+            valid = [(key, partition.get_key(key), partition.get_timestamp(key))
+                     for key in partition.valid_key_set() if key_filter is None or key_filter(key)]
+            deleted = [(key, partition.get_timestamp(key)) for key in partition.deleted_key_set()]
+        counts = collections.Counter(matched=len(valid))
+        valid_groups = self._group_by_partition([item[0] for item in valid])
+        deleted_groups = self._group_by_partition([item[0] for item in deleted])
+        valid = dict((item[0], item) for item in valid)
+        deleted = dict(deleted)
+        for own_itr in set(valid_groups) | set(deleted_groups):
+            with self.cache[own_itr]["lock"]:
+                own = self.cache[own_itr]["partition"]
+                own_deleted = set(own.deleted_key_set())
+                for key in valid_groups.get(own_itr, ()):
+                    if key in own_deleted:
+                        continue
+                    _, item, timestamp = valid[key]
+                    if lww and timestamp < own.get_timestamp(key):
+                        counts["skipped"] += 1
+                        continue
+                    own.set(key, item["value"], item["expires"], item["flag"])
+                    counts["set"] += 1
+                for key in deleted_groups.get(own_itr, ()):
+                    if key in own_deleted:
+                        continue
+                    if lww and deleted[key] < own.get_timestamp(key):
+                        counts["skipped"] += 1
+                        continue
+                    own.delete(key)
+                    counts["deleted"] += 1
+        return counts
+
+    def set_many(self, key_val, exp=0, flag=0, bucket="default", collection=None):
+        """
+        stores a batch of key/values taking each partition lock once
+
+        arguments:
+            key_val -- dict of key to value
+        """
+        for itr, keys in list(self._group_by_partition(key_val, bucket, collection).items()):
+            self.cache[itr]["lock"].acquire()
+            try:
+                self.cache[itr]["partition"].set_many(
+                    [(key, key_val[key]) for key in keys], exp, flag)
+            finally:
+                self.cache[itr]["lock"].release()
+
+    def delete_many(self, keys, bucket="default", collection=None):
+        """
+        marks a batch of keys as deleted taking each partition lock once
+        """
+        for itr, part_keys in list(self._group_by_partition(keys, bucket, collection).items()):
+            self.cache[itr]["lock"].acquire()
+            try:
+                self.cache[itr]["partition"].delete_many(part_keys)
+            finally:
+                self.cache[itr]["lock"].release()
+
+    def _group_by_partition(self, keys, bucket="default", collection=None):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._hash(key, bucket, collection), []).append(key)
+        return groups
+
     def __len__(self):
         return sum([len(self.cache[itr]["partition"]) for itr in range(self.num_locks)])
 
@@ -129,13 +258,12 @@ class Partition(object):
         self.__valid = {}
         self.__deleted = {}
         self.__timestamp = {}
-        self.__expired_keys = []
+        self.__expired_keys = set()
 
     def set(self, key, value, exp=0, flag=0):
         if key in self.__deleted:
             del self.__deleted[key]
-        if key in self.__expired_keys:
-            self.__expired_keys.remove(key)
+        self.__expired_keys.discard(key)
         if exp != 0:
             exp = (time.time() + exp)
         self.__valid[key] = {"value": value,
@@ -149,6 +277,14 @@ class Partition(object):
             self.__timestamp[key] = time.time()
             del self.__valid[key]
 
+    def set_many(self, items, exp=0, flag=0):
+        for key, value in items:
+            self.set(key, value, exp, flag)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
     def get_timestamp(self, key):
         return self.__timestamp.get(key, 0)
 
@@ -197,7 +333,7 @@ class Partition(object):
     def expired_key_set(self):
         valid_keys = copy.copy(list(self.__valid.keys()))
         [self.__expire_key(key) for key in valid_keys]
-        return self.__expired_keys
+        return list(self.__expired_keys)
 
     def merge(self, partition):
         """
@@ -212,14 +348,11 @@ class Partition(object):
         self.__valid.update(valid_items)
 
         # make sure key no longer marked as deleted
-        deleted_keys = set(valid_items.keys()) & set(self.__deleted.keys())
-        for key in deleted_keys:
-            del self.__deleted[key]
+        for key in valid_items:
+            self.__deleted.pop(key, None)
 
         # make sure key no longer marked as expired
-        expired_keys = set(valid_items.keys()) & set(self.__expired_keys)
-        for key in expired_keys:
-            self.__expired_keys.remove(key)
+        self.__expired_keys.difference_update(valid_items)
 
         # update timestamps
         self.__timestamp.update(partition.__timestamp)
@@ -234,7 +367,7 @@ class Partition(object):
         if key in self.__valid:
             if self.__valid[key]["expires"] != 0 and self.__valid[key]["expires"] < time.time():
                 self.__deleted[key] = self.__valid[key]["value"]
-                self.__expired_keys.append(key)
+                self.__expired_keys.add(key)
                 del self.__valid[key]
 
     def expired(self, key):
@@ -254,3 +387,268 @@ class Partition(object):
 
     def __hash__(self):
         return self.part_id.__hash__()
+
+
+class CompactKVStore(KVStore):
+    """
+    KVStore with the same interface, backed by CompactPartition objects.
+
+    Meant for large loads with only_store_hash=True where the per-key
+    dicts of Partition cost more memory than the docs themselves.
+    """
+
+    def reset(self):
+        self.cache = {}
+        for itr in range(self.num_locks):
+            self.cache[itr] = {"lock": threading.Lock(),
+                               "partition": CompactPartition(itr)}
+
+
+class CompactPartition(object):
+    """
+    Partition keeping its bookkeeping in packed columns.
+
+    Every key is interned to a doc index on first use. The value (usually
+    the crc32 of the doc) and the expiry, flag and timestamp of the key are
+    stored at that index in typed arrays and deletion in a byte array.
+    Values that are not a crc are kept aside in a dict.
+    """
+
+    NO_CRC = -1
+
+    def __init__(self, part_id):
+        self.part_id = part_id
+        self._index = {}
+        self._keys = []
+        self._crc = array.array('l')
+        self._raw = {}
+        self._expires = array.array('d')
+        self._flag = array.array('L')
+        self._timestamp = array.array('d')
+        self._deleted = bytearray()
+        self._num_deleted = 0
+        # indexes of valid keys with a ttl, and keys which expired
+        self._expiring = set()
+        self._expired_keys = set()
+
+    def _slot(self, key):
+        slot = self._index.get(key)
+        if slot is None:
+            slot = len(self._keys)
+            self._index[key] = slot
+            self._keys.append(key)
+            self._crc.append(self.NO_CRC)
+            self._expires.append(0)
+            self._flag.append(0)
+            self._timestamp.append(0)
+            self._deleted.append(1)
+            self._num_deleted += 1
+        return slot
+
+    def _store(self, slot, key, value, exp, flag, now):
+        if self._deleted[slot]:
+            self._deleted[slot] = 0
+            self._num_deleted -= 1
+            self._expired_keys.discard(key)
+        if self._is_crc(value):
+            self._crc[slot] = int(value)
+            self._raw.pop(slot, None)
+        else:
+            self._crc[slot] = self.NO_CRC
+            self._raw[slot] = value
+        if exp != 0:
+            self._expires[slot] = now + exp
+            self._expiring.add(slot)
+        else:
+            self._expires[slot] = 0
+            self._expiring.discard(slot)
+        self._flag[slot] = flag
+        self._timestamp[slot] = now
+
+    @staticmethod
+    def _is_crc(value):
+        # only canonical decimal strings round trip through the crc column
+        return isinstance(value, str) and value.isdigit() and len(value) < 10 \
+            and (value[0] != "0" or value == "0")
+
+    def _value(self, slot):
+        crc = self._crc[slot]
+        if crc == self.NO_CRC:
+            return self._raw.get(slot)
+        return str(crc)
+
+    def _valid_slot(self, key):
+        slot = self._index.get(key)
+        if slot is None:
+            return None
+        self.__expire_slot(slot)
+        if self._deleted[slot]:
+            return None
+        return slot
+
+    def set(self, key, value, exp=0, flag=0):
+        self._store(self._slot(key), key, value, exp, flag, time.time())
+
+    def set_many(self, items, exp=0, flag=0):
+        now = time.time()
+        expires = now + exp if exp != 0 else 0
+        index, deleted, crcs = self._index, self._deleted, self._crc
+        for key, value in items:
+            slot = index.get(key)
+            if slot is None:
+                slot = self._slot(key)
+            if deleted[slot]:
+                deleted[slot] = 0
+                self._num_deleted -= 1
+                self._expired_keys.discard(key)
+            if self._is_crc(value):
+                crcs[slot] = int(value)
+                if slot in self._raw:
+                    del self._raw[slot]
+            else:
+                crcs[slot] = self.NO_CRC
+                self._raw[slot] = value
+            self._expires[slot] = expires
+            if exp != 0:
+                self._expiring.add(slot)
+            elif self._expiring:
+                self._expiring.discard(slot)
+            self._flag[slot] = flag
+            self._timestamp[slot] = now
+
+    def delete(self, key):
+        slot = self._index.get(key)
+        if slot is not None and not self._deleted[slot]:
+            self._deleted[slot] = 1
+            self._num_deleted += 1
+            self._expiring.discard(slot)
+            self._timestamp[slot] = time.time()
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def get_timestamp(self, key):
+        slot = self._index.get(key)
+        if slot is None:
+            return 0
+        return self._timestamp[slot]
+
+    def get_key(self, key):
+        slot = self._index.get(key)
+        if slot is None or self._deleted[slot]:
+            return None
+        return {"value": self._value(slot),
+                "expires": self._expires[slot],
+                "flag": self._flag[slot]}
+
+    def get_valid(self, key):
+        slot = self._valid_slot(key)
+        if slot is None:
+            return None
+        return self._value(slot)
+
+    def get_deleted(self, key):
+        slot = self._index.get(key)
+        if slot is None:
+            return None
+        self.__expire_slot(slot)
+        if not self._deleted[slot]:
+            return None
+        return self._value(slot)
+
+    def get_random_valid_key(self):
+        try:
+            return random.choice(self.valid_key_set())
+        except IndexError:
+            return None
+
+    def get_random_deleted_key(self):
+        try:
+            return random.choice(self.deleted_key_set())
+        except IndexError:
+            return None
+
+    def get_flag(self, key):
+        slot = self._valid_slot(key)
+        if slot is None:
+            return None
+        return self._flag[slot]
+
+    def valid_key_set(self):
+        self.__expire_all()
+        return [key for key, deleted in zip(self._keys, self._deleted) if not deleted]
+
+    def deleted_key_set(self):
+        self.__expire_all()
+        return [key for key, deleted in zip(self._keys, self._deleted) if deleted]
+
+    def expired_key_set(self):
+        self.__expire_all()
+        return list(self._expired_keys)
+
+    def merge(self, partition):
+        """
+        merges a partition with self, costs O(len(partition))
+
+        arguments:
+            partition -- type CompactPartition or Partition
+        """
+        if isinstance(partition, CompactPartition):
+            for key, slot in list(partition._index.items()):
+                if partition._deleted[slot]:
+                    own_slot = self._index.get(key)
+                    if own_slot is not None:
+                        self._timestamp[own_slot] = partition._timestamp[slot]
+                    continue
+                own_slot = self._slot(key)
+                self._store(own_slot, key, partition._value(slot), 0,
+                            partition._flag[slot], partition._timestamp[slot])
+                self._expires[own_slot] = partition._expires[slot]
+                if partition._expires[slot] != 0:
+                    self._expiring.add(own_slot)
+        else:
+            for key in partition.valid_key_set():
+                item = partition.get_key(key)
+                own_slot = self._slot(key)
+                self._store(own_slot, key, item["value"], 0, item["flag"],
+                            partition.get_timestamp(key))
+                self._expires[own_slot] = item["expires"]
+                if item["expires"] != 0:
+                    self._expiring.add(own_slot)
+
+    def has_valid_keys(self):
+        return len(self._keys) > self._num_deleted
+
+    def has_deleted_keys(self):
+        return self._num_deleted > 0
+
+    def __expire_slot(self, slot):
+        if slot in self._expiring and self._expires[slot] < time.time():
+            self._expiring.discard(slot)
+            self._deleted[slot] = 1
+            self._num_deleted += 1
+            self._expired_keys.add(self._keys[slot])
+
+    def __expire_all(self):
+        for slot in list(self._expiring):
+            self.__expire_slot(slot)
+
+    def expired(self, key):
+        slot = self._index.get(key)
+        if slot is None:
+            raise Exception("Key: %s is not a valid key" % key)
+        self.__expire_slot(slot)
+        return key in self._expired_keys
+
+    def __len__(self):
+        self.__expire_all()
+        return len(self._keys) - self._num_deleted
+
+    def __eq__(self, other):
+        if isinstance(other, CompactPartition):
+            return self.part_id == other.part_id
+        return False
+
+    def __hash__(self):
+        return self.part_id.__hash__()
@@ -1,18 +1,23 @@
 #!/usr/bin/env python
 import re
 import sys
+import copy
 import math
+import array
+import bisect
 import time
 import socket
 import string
 import struct
 import random
+import os
+import mmap
 import threading
 import multiprocessing
 import queue
 import logging
 import logging.config
-from collections import deque
+from collections import deque, OrderedDict
 from hashlib import md5
 import json
 import inspect
@@ -98,6 +103,8 @@ def dict_to_s(d, level="", res=None, suffix=", ", ljust=None):
 
 def dict_to_s_inner(d, level, res, suffix, ljust):
     dtype = DICT_TYPE
+    d = dict((k, v.to_dict() if isinstance(v, LatencyHistogram) else v)
+             for k, v in d.items())
     scalars = []
     complex = []
 
@@ -126,14 +133,14 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
         else:
             k = str(key)
         if ljust:
-            k = string.ljust(k, ljust)
+            k = k.ljust(ljust)
         x = d[key]
         if histo_max:
             histo_cur = histo_cur + x
         v = str(x)
         if histo_max:
-            v = string.rjust(v, 8) + " " + \
-                string.rjust("{0:.1%}".format(histo_cur / float(histo_sum)), 8) + " " + \
+            v = v.rjust(8) + " " + \
+                "{0:.1%}".format(histo_cur / float(histo_sum)).rjust(8) + " " + \
                 ("*" * int(math.ceil(50.0 * d[key] / histo_max)))
 
         res.append(level + k + ": " + v + suffix)
@@ -147,7 +154,88 @@ def dict_to_s_inner(d, level, res, suffix, ljust):
 
     return res
 
-# The histo dict is returned by add_timing_sample().
+# Latency histograms cover samples from 1 usec up to 10^HISTO_MAX_EXP secs.
+HISTO_MIN_EXP = -6
+HISTO_MAX_EXP = 4
+
+histo_bounds_cache = {}
+
+
+def histo_bounds(precision):
+    """
+    Lower bounds of the log-linear histogram bins with `precision`
+    significant digits, i.e. the values Store.histo_bucket() rounds to.
+    """
+    bounds = histo_bounds_cache.get(precision)
+    if bounds is None:
+        bounds = []
+        for exp in range(HISTO_MIN_EXP, HISTO_MAX_EXP):
+            for mantissa in range(10 ** (precision - 1), 10 ** precision):
+                bounds.append(float("%de%d" % (mantissa, exp - precision + 1)))
+        histo_bounds_cache[precision] = bounds
+    return bounds
+
+
+class LatencyHistogram(object):
+    """
+    Fixed size log-linear latency histogram.
+
+    A sample is counted in the bin with the largest lower bound <= sample,
+    found by bisecting the shared bounds of its precision. Samples below
+    the first bound go to the first bin and samples above the last bound to
+    the last one. Histograms of the same precision merge by adding counts,
+    so the histograms of several worker processes combine exactly.
+    """
+
+    def __init__(self, precision=2):
+        self.precision = precision
+        self.bounds = histo_bounds(precision)
+        self.counts = array.array('Q', [0]) * len(self.bounds)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return self.precision, self.counts, self.count
+
+    def __setstate__(self, state):
+        self.precision, self.counts, self.count = state
+        self.bounds = histo_bounds(self.precision)
+
+    def bucket(self, samp):
+        return max(bisect.bisect_right(self.bounds, samp) - 1, 0)
+
+    def add(self, samp, bucket=None):
+        if bucket is None:
+            bucket = self.bucket(samp)
+        self.counts[bucket] += 1
+        self.count += 1
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge histograms of precision %s and %s"
+                             % (self.precision, other.precision))
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        self.count += other.count
+
+    def reset(self):
+        self.counts = array.array('Q', [0]) * len(self.bounds)
+        self.count = 0
+
+    def to_dict(self):
+        """Returns the non-empty bins as a {lower bound: count} histo dict"""
+        histo = {}
+        for bound, n in zip(self.bounds, self.counts):
+            if n:
+                bin = round(bound, 6)
+                histo[bin] = histo.get(bin, 0) + n
+        return histo
+
+# The histo dict is LatencyHistogram.to_dict() of a latency- entry of cur.
 # The percentiles must be sorted, ascending, like [0.90, 0.99].
 
 
@@ -163,7 +251,7 @@ def histo_percentile(histo, percentiles):
         if not percentiles:
             return rv
         v_cur += histo[bin]
-        while percentiles and (v_cur // v_sum) >= percentiles[0]:
+        while percentiles and (v_cur / v_sum) >= percentiles[0]:
             rv.append((percentiles[0], bin))
             percentiles.pop(0)
     return rv
@@ -579,6 +667,7 @@ def next_cmd(cfg, cur, store):
         if cmd[0] == 's' and cfg.get('ratio-expirations', 0.0) * 100 > cur_sets % 100:
             expiration = cfg.get('expiration', 0)
 
+        key_num = slice_key_num(cfg, key_num)
         key_str = prepare_key(key_num, cfg.get('prefix', ''))
         if itm_gen:
             itm_val = store.gen_doc(key_num, key_str,
@@ -618,6 +707,7 @@ def next_cmd(cfg, cur, store):
                                          cur.get('cur-base', 0),
                                          cfg.get('random', 0),
                                          cur)
+            key_num = slice_key_num(cfg, key_num)
             key_str = prepare_key(key_num, cfg.get('prefix', ''))
 
             return cmd, key_num, key_str, itm_val, 0
@@ -678,6 +768,26 @@ def choose_key_num(num_items, ratio_hot, ratio_hot_choice,
     return int(retval) % num_items
 
 
+def slice_key_num(cfg, key_num):
+    """
+    Map a key number of a worker process to the key space shared by all
+    workers. Worker `key-slice` of `key-slices` owns the key numbers that
+    are congruent to it, so every worker generates its requests exactly
+    like a single mcsoda would for its share of the items.
+    """
+    slices = cfg.get('key-slices', 1)
+    if slices > 1 and key_num >= 0:
+        return key_num * slices + cfg.get('key-slice', 0)
+    return key_num
+
+
+def slice_share(total, slices, i):
+    """Number of 0 <= key_num < total that belong to slice i"""
+    if total <= 0:
+        return total
+    return type(total)(max(0, (total - i + slices - 1) // slices))
+
+
 def positive(x):
     if x > 0:
         return x
@@ -760,7 +870,8 @@ class Store(object):
 
         return gen_doc_string(key_num, key_str, min_value_size,
                               self.cfg['suffix'][min_value_size],
-                              json, cache=cache)
+                              json, cache=cache,
+                              doc_file=doc_files.get(self.cfg.get('doc-file')))
 
     def cmd_line_get(self, key_num, key_str):
         return key_str
@@ -782,18 +893,16 @@ class Store(object):
 
     def add_timing_sample(self, cmd, delta, prefix="latency-"):
         base = prefix + cmd
+        bucket = None
         for suffix in self.cfg.get("timing-suffixes", ["", "-recent"]):
             key = base + suffix
             histo = self.cur.get(key, None)
             if histo is None:
-                histo = {}
+                histo = LatencyHistogram(self.cfg.get("histo-precision", 2))
                 self.cur[key] = histo
-            try:
-                bucket = round(self.histo_bucket(delta), 6)
-                histo[bucket] = histo.get(bucket, 0) + 1
-            except TypeError as error:
-                self.save_error(error)
-                log.error(error)
+            if bucket is None:
+                bucket = histo.bucket(delta)
+            histo.add(delta, bucket)
 
     def histo_bucket(self, samp):
         hp = self.cfg.get("histo-precision", 2)
@@ -1051,9 +1160,9 @@ class StoreMemcachedBinary(Store):
             if key.startswith('latency-'):
                 histo = self.cur.get(key, None)
                 if histo:
-                    self.sc.latency_stats(key, histo, cur_time)
+                    self.sc.latency_stats(key, histo.to_dict(), cur_time)
                     if key.endswith('-recent'):
-                        self.cur[key] = {}
+                        histo.reset()
         self.sc.sample(self.cur)
 
     def cmd_append(self, cmd, key_num, key_str, data, expiration, grp):
@@ -1411,23 +1520,230 @@ def key_to_achievements(key_str):
             achievements.append(next)
     return achievements
 
-doc_cache = {}
+# Default memory budget of the doc cache, in bytes of doc bodies.
+DOC_CACHE_BYTES = 256 * 1024 * 1024
 
 
-def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
-                   cache=None, key_name="key", suffix_ex="", whitespace=True):
-    global doc_cache
+class DocCache(object):
+    """
+    LRU cache of rendered doc bodies keyed by key_num, bounded by the
+    total length of the cached bodies.
 
-    c = "{"
-    if not json:
-        c = "*"
+    Also counts the docs gen_doc_string() had to render and the time it
+    spent on them, whether or not they were cached.
+    """
 
-    d = None
-    if cache:
-        d = doc_cache.get(key_num, None)
+    def __init__(self, max_bytes=DOC_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.docs = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.gen_docs = 0
+        self.gen_secs = 0.0
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def full(self):
+        return self.bytes >= self.max_bytes
+
+    def get(self, key_num):
+        with self.lock:
+            d = self.docs.get(key_num, None)
+            if d is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.docs.move_to_end(key_num)
+            return d
+
+    def put(self, key_num, d):
+        with self.lock:
+            old = self.docs.pop(key_num, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.docs[key_num] = d
+            self.bytes += len(d)
+            self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.docs:
+            _, d = self.docs.popitem(last=False)
+            self.bytes -= len(d)
+            self.evictions += 1
+
+    def generated(self, secs):
+        self.gen_docs += 1
+        self.gen_secs += secs
 
-    if d is None:
-        d = """"%s":"%s",
+    def clear(self):
+        with self.lock:
+            self.docs.clear()
+            self.bytes = 0
+
+
+doc_cache = DocCache()
+
+
+class DocFile(object):
+    """
+    Memory-mapped file of pre-rendered doc bodies with one fixed size
+    record per key_num: a 2 byte length followed by the body. Bodies that
+    do not fit a record are stored with length DOC_FILE_MISSING and
+    rendered on demand.
+
+    The file starts with a JSON header of the item count, record size and
+    key prefix, so it is reused by later runs and shared by all worker
+    processes through the page cache.
+    """
+
+    HEADER_SIZE = 4096
+    VERSION = 1
+    MISSING = 0xffff
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, "rb")
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.read_header(self.mm)
+        self.items = header["items"]
+        self.record = header["record"]
+        self.prefix = header["prefix"]
+        self.hits = 0
+
+    @classmethod
+    def read_header(cls, buf):
+        try:
+            header = json.loads(bytes(buf[:cls.HEADER_SIZE]).rstrip(b"\0 "))
+        except ValueError:
+            return None
+        if not isinstance(header, dict) or header.get("version") != cls.VERSION:
+            return None
+        return header
+
+    @classmethod
+    def matches(cls, path, items, prefix):
+        """True if the file at path covers items keys of prefix"""
+        try:
+            with open(path, "rb") as f:
+                header = cls.read_header(f.read(cls.HEADER_SIZE))
+                size = os.fstat(f.fileno()).st_size
+        except (IOError, OSError):
+            return False
+        return header is not None and header["items"] >= items and \
+            header["prefix"] == prefix and \
+            size >= cls.HEADER_SIZE + header["items"] * header["record"]
+
+    @classmethod
+    def build(cls, path, items, prefix, workers=1):
+        """Render the docs of key_num 0 .. items - 1 into path, using
+        workers processes which each fill every workers-th record"""
+        # achievements is the only part of a body that varies much in length
+        sample = doc_body(items - 1, prepare_key(items - 1, prefix))
+        record = (len(sample) + 2 + 96 + 7) // 8 * 8
+
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            header = json.dumps({"version": cls.VERSION, "items": items,
+                                 "record": record, "prefix": prefix})
+            f.write(header.encode().ljust(cls.HEADER_SIZE, b"\0"))
+            f.truncate(cls.HEADER_SIZE + items * record)
+
+        if workers > 1:
+            procs = [multiprocessing.Process(target=cls.fill,
+                                             args=(tmp, items, record, prefix,
+                                                   i, workers))
+                     for i in range(workers)]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+            if any(proc.exitcode for proc in procs):
+                os.remove(tmp)
+                raise Exception("failed to build doc file %s" % path)
+        else:
+            cls.fill(tmp, items, record, prefix, 0, 1)
+        os.rename(tmp, path)
+
+    @classmethod
+    def fill(cls, path, items, record, prefix, first, step):
+        with open(path, "r+b") as f:
+            mm = mmap.mmap(f.fileno(), 0)
+            try:
+                for key_num in range(first, items, step):
+                    d = doc_body(key_num, prepare_key(key_num, prefix)).encode()
+                    offset = cls.HEADER_SIZE + key_num * record
+                    if len(d) + 2 > record:
+                        struct.pack_into("<H", mm, offset, cls.MISSING)
+                    else:
+                        struct.pack_into("<H", mm, offset, len(d))
+                        mm[offset + 2:offset + 2 + len(d)] = d
+                mm.flush()
+            finally:
+                mm.close()
+
+    def get(self, key_num):
+        if key_num < 0 or key_num >= self.items:
+            return None
+        offset = self.HEADER_SIZE + key_num * self.record
+        n = struct.unpack_from("<H", self.mm, offset)[0]
+        if n == self.MISSING:
+            return None
+        self.hits += 1
+        return self.mm[offset + 2:offset + 2 + n].decode()
+
+    def close(self):
+        self.mm.close()
+        self.fd.close()
+
+
+doc_files = {}
+
+
+def open_doc_file(cfg, workers=1):
+    """
+    Returns the DocFile named by cfg['doc-file'], building it first if it
+    does not cover cfg['max-items'] keys of cfg['prefix'], or None if
+    there is no doc-file.
+    """
+    path = cfg.get('doc-file', '')
+    if not path:
+        return None
+    doc_file = doc_files.get(path)
+    if doc_file is not None:
+        return doc_file
+
+    # worker processes use the file run_processes() built for all of them
+    items = 0
+    if cfg.get('key-slices', 1) <= 1:
+        items = max(cfg.get('max-items', 0), 0)
+    prefix = cfg.get('prefix', '')
+    if not DocFile.matches(path, items, prefix):
+        log.info("doc-file: rendering %s docs into %s" % (items, path))
+        build_start = time.time()
+        DocFile.build(path, items, prefix, workers)
+        log.info("doc-file: done (elapsed: %s)" % (time.time() - build_start))
+    doc_file = doc_files[path] = DocFile(path)
+    return doc_file
+
+
+def doc_stats():
+    """Counters of the doc cache and doc files, for run() to report"""
+    return {'doc-cache-hits': doc_cache.hits,
+            'doc-cache-misses': doc_cache.misses,
+            'doc-cache-evictions': doc_cache.evictions,
+            'doc-file-hits': sum(f.hits for f in list(doc_files.values())),
+            'doc-gen-docs': doc_cache.gen_docs,
+            'doc-gen-secs': doc_cache.gen_secs}
+
+
+def doc_body(key_num, key_str, key_name="key", whitespace=True):
+    d = """"%s":"%s",
  "key_num":%s,
  "name":"%s",
  "email":"%s",
@@ -1446,10 +1762,30 @@ def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
                           key_to_coins(key_str),
                           key_to_category(key_str),
                           key_to_achievements(key_str))
-        if not whitespace:
-            d = d.replace("\n ", "")
+    if not whitespace:
+        d = d.replace("\n ", "")
+    return d
+
+
+def gen_doc_string(key_num, key_str, min_value_size, suffix, json,
+                   cache=None, key_name="key", suffix_ex="", whitespace=True,
+                   doc_file=None):
+    c = "{"
+    if not json:
+        c = "*"
+
+    d = None
+    if doc_file is not None and key_name == "key" and whitespace:
+        d = doc_file.get(key_num)
+    if d is None and cache:
+        d = doc_cache.get(key_num)
+
+    if d is None:
+        gen_start = time.time()
+        d = doc_body(key_num, key_str, key_name, whitespace)
+        doc_cache.generated(time.time() - gen_start)
         if cache:
-            doc_cache[key_num] = d
+            doc_cache.put(key_num, d)
 
     return "%s%s%s%s" % (c, d, suffix_ex, suffix)
 
@@ -1470,6 +1806,14 @@ def final_report(cur, store, total_time):
     else:
         total_cmds = cur.get('cur-gets', 0) + cur.get('cur-sets', 0)
     log.info("ops/sec: %s" % (total_cmds / float(total_time)))
+    lookups = cur.get('doc-cache-hits', 0) + cur.get('doc-cache-misses', 0)
+    if lookups:
+        log.info("doc-cache hit rate: %.1f%%" %
+                 (100.0 * cur.get('doc-cache-hits', 0) / lookups))
+    if cur.get('doc-gen-docs', 0):
+        log.info("doc-gen: %s docs in %.3f secs, docs/sec: %s" %
+                 (cur['doc-gen-docs'], cur.get('doc-gen-secs', 0),
+                  int(cur['doc-gen-docs'] / max(cur.get('doc-gen-secs', 0), 1e-9))))
     if store.errors:
         log.warn("errors:\n%s", json.dumps(store.errors, indent=4))
 
@@ -1495,6 +1839,15 @@ def run(cfg, cur, protocol, host_port, user, pswd, stats_collector=None,
 
     ctl = ctl or {'run_ok': True}
 
+    doc_cache.resize(cfg.get('doc-cache-bytes', DOC_CACHE_BYTES))
+
+    if cfg.get('processes', 0) > 1:
+        open_doc_file(cfg, workers=cfg['processes'])
+        return run_processes(cfg, cur, protocol, host_port, user, pswd,
+                             stats_collector=stats_collector, ctl=ctl,
+                             heartbeat=heartbeat, why=why, bucket=bucket,
+                             backups=backups)
+
     threads = []
 
     for i in range(cfg.get('threads', 1)):
@@ -1516,19 +1869,29 @@ def run(cfg, cur, protocol, host_port, user, pswd, stats_collector=None,
 
     store.show_some_keys()
 
-    if cfg.get("doc-cache", 0) > 0 and cfg.get("doc-gen", 0) > 0:
+    doc_file = open_doc_file(cfg)
+    doc_stats_start = doc_stats()
+
+    if cfg.get("doc-cache", 0) > 0 and cfg.get("doc-gen", 0) > 0 and \
+            doc_file is None:
         min_value_size = cfg['min-value-size'][0]
         json = cfg.get('json', 1) > 0
         cache = cfg.get('doc-cache', 0)
         log.debug("doc-gen...")
         gen_start = time.time()
+        num_docs = 0
         for key_num in range(cfg.get("max-items", 0)):
+            if doc_cache.full():
+                log.info("doc-gen: doc cache is full after %s docs" % num_docs)
+                break
+            key_num = slice_key_num(cfg, key_num)
             key_str = prepare_key(key_num, cfg.get('prefix', ''))
             store.gen_doc(key_num, key_str, min_value_size, json, cache)
+            num_docs += 1
         gen_end = time.time()
         log.debug("doc-gen...done (elapsed: %s, docs/sec: %s)" %
                  (gen_end - gen_start,
-                  float(key_num) / (gen_end - gen_start)))
+                  float(num_docs) / max(gen_end - gen_start, 1e-9)))
 
     def stop_after(secs):
         time.sleep(secs)
@@ -1552,16 +1915,19 @@ def run(cfg, cur, protocol, host_port, user, pswd, stats_collector=None,
 
             while threads:
                 threads[0].join(1)
-                threads = [t for t in threads if t.isAlive()]
+                threads = [t for t in threads if t.is_alive()]
     except KeyboardInterrupt:
         log.warn("exiting because of KeyboardInterrupt")
         ctl['run_ok'] = False
 
     t_end = time.time()
 
+    for k, v in doc_stats().items():
+        cur[k] = cur.get(k, 0) + v - doc_stats_start[k]
+
     final_report(cur, store, total_time=t_end - t_start)
 
-    threads = [t for t in threads if t.isAlive()]
+    threads = [t for t in threads if t.is_alive()]
     heartbeat = 0
     while threads:
         threads[0].join(1)
@@ -1569,7 +1935,164 @@ def run(cfg, cur, protocol, host_port, user, pswd, stats_collector=None,
         if heartbeat >= 60:
             heartbeat = 0
             log.info("mcsoda is running with %s threads" % len(threads))
-        threads = [t for t in threads if t.isAlive()]
+        threads = [t for t in threads if t.is_alive()]
+
+    ctl['run_ok'] = False
+    if ctl.get('shutdown_event') is not None:
+        ctl['shutdown_event'].set()
+
+    log.info("%s stopped running." % why)
+    return cur, t_start, t_end
+
+
+def slice_cfg_cur(cfg, cur, slices, i):
+    """cfg and cur of worker process i, which owns key slice i of slices"""
+    slice_cfg = copy.copy(cfg)
+    slice_cfg['processes'] = 0
+    slice_cfg['key-slices'] = slices
+    slice_cfg['key-slice'] = i
+    for k in ['max-items', 'max-creates', 'max-ops', 'max-gets']:
+        if k in cfg:
+            slice_cfg[k] = slice_share(cfg[k], slices, i)
+    if cfg.get('max-ops-per-sec', 0) > 0:
+        slice_cfg['max-ops-per-sec'] = float(cfg['max-ops-per-sec']) / slices
+    slice_cfg['doc-cache-bytes'] = \
+        cfg.get('doc-cache-bytes', DOC_CACHE_BYTES) // slices
+
+    slice_cur = {}
+    for k, v in cur.items():
+        if k.startswith('cur-') and isinstance(v, (INT_TYPE, FLOAT_TYPE)):
+            slice_cur[k] = slice_share(v, slices, i)
+    return slice_cfg, slice_cur
+
+
+def run_slice(results, stop, i, cfg, cur, protocol, host_port, user, pswd,
+              heartbeat, why, bucket, backups):
+    """Entry point of a worker process, reports back (i, cur, errors)"""
+    ctl = {'run_ok': True}
+
+    # polls, as a process that exits while blocked in stop.wait() would
+    # make stop.set() in the parent wait for it forever
+    def stop_on_event():
+        while not stop.is_set():
+            time.sleep(0.5)
+        ctl['run_ok'] = False
+
+    t = threading.Thread(target=stop_on_event)
+    t.daemon = True
+    t.start()
+
+    stores = [PROTOCOL_STORE[protocol]() for _ in range(cfg.get('threads', 1))]
+    try:
+        run(cfg, cur, protocol, host_port, user, pswd, stores=stores, ctl=ctl,
+            heartbeat=heartbeat, why=why, bucket=bucket, backups=backups)
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        log.error("%s failed: %s" % (why, error))
+        stores[0].errors["[run_slice] %s" % error] = 1
+
+    errors = {}
+    for store in stores:
+        for k, v in store.errors.items():
+            errors[k] = errors.get(k, 0) + v
+    summary = {}
+    for k, v in cur.items():
+        if isinstance(v, LatencyHistogram) or \
+                (k.startswith(('cur-', 'doc-')) and
+                 isinstance(v, (INT_TYPE, FLOAT_TYPE))):
+            summary[k] = v
+    results.put((i, summary, errors))
+
+
+def run_processes(cfg, cur, protocol, host_port, user, pswd,
+                  stats_collector=None, ctl=None, heartbeat=0, why="",
+                  bucket="default", backups=None):
+    """
+    Run cfg['processes'] mcsoda worker processes, each one owning a slice of
+    the key space, and merge their counters, latency histograms and errors
+    into cur.
+
+    The stats collector only gets the merged latency histograms at the end,
+    as it lives in this process.
+    """
+    slices = cfg['processes']
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+
+    slice_curs = {}
+    procs = []
+    for i in range(slices):
+        slice_cfg, slice_cur = slice_cfg_cur(cfg, cur, slices, i)
+        slice_curs[i] = slice_cur
+        slice_why = "%s process-%s" % (why, i)
+        procs.append(multiprocessing.Process(
+            target=run_slice,
+            args=(results, stop, i, slice_cfg, dict(slice_cur), protocol,
+                  host_port, user, pswd, heartbeat, slice_why, bucket,
+                  backups)))
+
+    t_start = time.time()
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+
+    merged = {}
+    errors = {}
+    pending = set(range(slices))
+    while pending:
+        try:
+            if not ctl.get('run_ok', True) or \
+                    (ctl.get('shutdown_event') is not None and
+                     ctl['shutdown_event'].is_set()):
+                stop.set()
+            try:
+                i, summary, slice_errors = results.get(timeout=1)
+            except queue.Empty:
+                if not any(proc.is_alive() for proc in procs):
+                    log.error("%s: %s worker processes exited without results"
+                              % (why, len(pending)))
+                    break
+                continue
+        except KeyboardInterrupt:
+            log.warn("exiting because of KeyboardInterrupt")
+            stop.set()
+            continue
+
+        pending.discard(i)
+        for k, v in slice_errors.items():
+            errors[k] = errors.get(k, 0) + v
+        for k, v in summary.items():
+            if isinstance(v, LatencyHistogram):
+                if k not in merged:
+                    merged[k] = LatencyHistogram(v.precision)
+                merged[k].merge(v)
+            else:
+                merged[k] = merged.get(k, 0) + v - slice_curs[i].get(k, 0)
+
+    t_end = time.time()
+    stop.set()
+    for proc in procs:
+        proc.join(5)
+
+    for k, v in merged.items():
+        if isinstance(v, LatencyHistogram):
+            if isinstance(cur.get(k), LatencyHistogram):
+                cur[k].merge(v)
+            else:
+                cur[k] = v
+        else:
+            cur[k] = cur.get(k, 0) + v
+
+    store = Store()
+    store.errors = errors
+    final_report(cur, store, total_time=t_end - t_start)
+
+    if stats_collector:
+        for k in sorted(merged.keys()):
+            if isinstance(merged[k], LatencyHistogram) and merged[k]:
+                stats_collector.latency_stats(k, merged[k].to_dict(), t_end)
+        stats_collector.sample(cur)
 
     ctl['run_ok'] = False
     if ctl.get('shutdown_event') is not None:
@@ -1602,6 +2125,7 @@ def main(argv, cfg_defaults=None, cur_defaults=None, protocol=None, stores=None,
         "expiration":         (0,     "Expiration time parameter for SET's"),
         "exit-after-creates": (0,     "Exit after max-creates is reached."),
         "threads":            (1,     "Number of client worker threads to use."),
+        "processes":          (0,     "When >1, # of worker processes, each owning a key slice."),
         "batch":              (100,   "Batch/pipeline up this # of commands per server."),
         "json":               (1,     "Use JSON documents. 0 to generate binary documents."),
         "time":               (0,     "Stop after this many seconds if > 0."),
@@ -1609,8 +2133,10 @@ def main(argv, cfg_defaults=None, cur_defaults=None, protocol=None, stores=None,
         "report":             (40000, "Emit performance output after this many requests."),
         "histo-precision":    (1,     "Precision of histogram bins."),
         "vbuckets":           (0,     "When >0, vbucket hash in memcached-binary protocol."),
-        "doc-cache":          (1,     "When 1, cache docs; faster, but uses O(N) memory."),
+        "doc-cache":          (1,     "When 1, cache docs, up to doc-cache-bytes of them."),
         "doc-gen":            (1,     "When 1 and doc-cache, pre-generate docs at start."),
+        "doc-cache-bytes":    (DOC_CACHE_BYTES, "Max total size of the cached docs."),
+        "doc-file":           ("",    "Memory-mapped file of pre-rendered docs; built if needed."),
         "backoff-factor":     (2.0,   "Exponential backoff factor on ETMPFAIL errors."),
         "hot-shift":          (0,     "# of keys/sec that hot item subset should shift."),
         "random":             (0,     "When 1, use random keys for gets and updates."),
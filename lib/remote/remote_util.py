@@ -8,6 +8,8 @@ import time
 import logging
 import stat
 import json
+import atexit
+import threading
 import TestInput
 from subprocess import Popen, PIPE
 
@@ -62,6 +64,131 @@ except ImportError:
                                   "paramiko due to import error.",
                                   "ssh connections to remote machines will fail!\n"))
 
+
+# channels (exec or sftp) open at once on a pooled session, sshd refuses
+# more than MaxSessions of them, 10 by default
+SSH_MAX_CHANNELS_PER_SESSION = 8
+# seconds a thread waits for a channel of a busy session before it tries anyway
+SSH_CHANNEL_WAIT_TIMEOUT = 300
+
+
+class SSHChannelLimiter(object):
+    """ wraps the open_channel of a transport so that threads sharing it
+        wait for one of its channels to close rather than opening more than
+        max_channels at once and being refused by sshd """
+
+    def __init__(self, transport, max_channels=SSH_MAX_CHANNELS_PER_SESSION,
+                 wait_timeout=SSH_CHANNEL_WAIT_TIMEOUT):
+        self.max_channels = max_channels
+        self.wait_timeout = wait_timeout
+        self._open_channel = transport.open_channel
+        self._lock = threading.Lock()
+        self._channels = []
+        transport.open_channel = self.open_channel
+
+    def open_channel(self, *args, **kwargs):
+        deadline = time.time() + self.wait_timeout
+        # held while opening so that two threads can't both take the last slot
+        with self._lock:
+            while True:
+                self._channels = [channel for channel in self._channels if not channel.closed]
+                if len(self._channels) < self.max_channels:
+                    break
+                if time.time() > deadline:
+                    log.warn("{0} ssh channels still open after {1}s, opening one more"
+                             .format(len(self._channels), self.wait_timeout))
+                    break
+                time.sleep(0.05)
+            channel = self._open_channel(*args, **kwargs)
+            self._channels.append(channel)
+            return channel
+
+
+class SSHSessionPool(object):
+    """ keeps one authenticated ssh client per (ip, username, password, ssh key)
+        so that RemoteMachineShellConnection objects to the same node share the
+        transport for their exec and sftp channels instead of doing a new
+        handshake each. Sessions stay open until close_all() or exit, a
+        session whose transport went down is dropped on the next acquire.
+        Sessions are not shared with forked processes and at most
+        SSH_MAX_CHANNELS_PER_SESSION channels are open on one at a time. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = os.getpid()
+        self.reused = 0
+
+    def _check_pid(self):
+        # the transport threads do not survive a fork, a child has to open
+        # its own sessions and must not close the ones of its parent
+        if self._pid != os.getpid():
+            self._sessions = {}
+            self._pid = os.getpid()
+
+    def acquire(self, key):
+        with self._lock:
+            self._check_pid()
+            client = self._sessions.get(key)
+            if client is None:
+                return None
+            if not self.is_active(client):
+                del self._sessions[key]
+                client.close()
+                return None
+            self.reused += 1
+            return client
+
+    def add(self, key, client):
+        """ returns the client to use, which is the pooled one if another
+            thread connected to the same node in the meantime """
+        transport = client.get_transport()
+        if transport is not None:
+            transport.set_keepalive(30)
+            SSHChannelLimiter(transport)
+        with self._lock:
+            self._check_pid()
+            pooled = self._sessions.get(key)
+            if pooled is not None and self.is_active(pooled):
+                client.close()
+                return pooled
+            self._sessions[key] = client
+            return client
+
+    def evict(self, key, client):
+        with self._lock:
+            if self._sessions.get(key) is client:
+                del self._sessions[key]
+        client.close()
+
+    def close_all(self):
+        with self._lock:
+            self._check_pid()
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for client in sessions:
+            client.close()
+
+    @staticmethod
+    def is_active(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+SSH_SESSIONS = SSHSessionPool()
+atexit.register(SSH_SESSIONS.close_all)
+
+# RemoteMachineInfo per node ip, the os facts of a node do not change during
+# a run so they are only extracted once per process
+_remote_machine_info = {}
+
+
+def invalidate_remote_info(ip=None):
+    if ip is None:
+        _remote_machine_info.clear()
+    else:
+        _remote_machine_info.pop(ip, None)
+
 class RemoteMachineInfo(object):
     def __init__(self):
         self.type = ''
@@ -173,6 +300,7 @@ class RemoteMachineHelper(object):
 
 class RemoteMachineShellConnection:
     _ssh_client = None
+    _session_key = None
 
     def __init__(self, username='root',
                  pkey_location='',
@@ -223,46 +351,14 @@ class RemoteMachineShellConnection:
         elif self.username != "Administrator":
             self.use_sudo = False
             self.nonroot = True
-        self._ssh_client = paramiko.SSHClient()
+        self._session_key = None
         self.ip = serverInfo.ip
         self.remote = (self.ip != "localhost" and self.ip != "127.0.0.1")
         self.port = serverInfo.port
-        self._ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        msg = 'connecting to {0} with username:{1} '
-        log.info(msg.format(serverInfo.ip, serverInfo.ssh_username))
-        # added attempts for connection because of PID check failed.
-        # RNG must be re-initialized after fork() error
-        # That's a paramiko bug
-        max_attempts_connect = 2
-        attempt = 0
-        while True:
-            try:
-                if self.remote and serverInfo.ssh_key == '':
-                    self._ssh_client.connect(hostname=serverInfo.ip.replace('[', '').replace(']', ''),
-                                             username=serverInfo.ssh_username,
-                                             password=serverInfo.ssh_password)
-                elif self.remote:
-                    self._ssh_client.connect(hostname=serverInfo.ip.replace('[', '').replace(']', ''),
-                                             username=serverInfo.ssh_username,
-                                             key_filename=serverInfo.ssh_key)
-                break
-            except paramiko.AuthenticationException:
-                log.error("Authentication failed")
-                exit(1)
-            except paramiko.BadHostKeyException:
-                log.error("Invalid Host key")
-                exit(1)
-            except Exception as e:
-                if str(e).find('PID check failed. RNG must be re-initialized') != -1 and\
-                        attempt != max_attempts_connect:
-                    log.error("Can't establish SSH session to node {1} :\
-                              {0}. Will try again in 1 sec".format(e, self.ip))
-                    attempt += 1
-                    time.sleep(1)
-                else:
-                    log.error("Can't establish SSH session to node {1} :\
-                                                   {0}".format(e, self.ip))
-                    exit(1)
+        if self.remote:
+            self._ssh_client = self._ssh_connect(self.username)
+        else:
+            self._ssh_client = paramiko.SSHClient()
         log.info("Connected to {0}".format(serverInfo.ip))
         """ self.info.distribution_type.lower() == "ubuntu" """
         self.cmd_ext = ""
@@ -287,18 +383,40 @@ class RemoteMachineShellConnection:
         if self.info.distribution_type.lower() == "mac":
             log.info("This is Mac Server.  Skip re-connect to it as %s" % user)
             return
+        log.info("Connect to node: %s as user: %s" % (self.ip, user))
+        if self.remote and self.ssh_key == '':
+            self._ssh_client = self._ssh_connect(user)
+        log.info("Connected to {0} as {1}".format(self.ip, user))
+
+    def _ssh_connect(self, user):
+        """ returns an ssh client connected to this node as user, reusing
+            the pooled session if there is one """
+        self._session_key = (self.ip, user, self.password, self.ssh_key)
+        client = SSH_SESSIONS.acquire(self._session_key)
+        if client is not None:
+            return client
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        msg = 'connecting to {0} with username:{1} '
+        log.info(msg.format(self.ip, user))
+        # added attempts for connection because of PID check failed.
+        # RNG must be re-initialized after fork() error
+        # That's a paramiko bug
         max_attempts_connect = 2
         attempt = 0
         while True:
             try:
-                log.info("Connect to node: %s as user: %s" % (self.ip, user))
-                if self.remote and self.ssh_key == '':
-                    self._ssh_client.connect(hostname=self.ip.replace('[', '').replace(']', ''),
-                                             username=user,
-                                             password=self.password)
+                if self.ssh_key == '':
+                    client.connect(hostname=self.ip.replace('[', '').replace(']', ''),
+                                   username=user,
+                                   password=self.password)
+                else:
+                    client.connect(hostname=self.ip.replace('[', '').replace(']', ''),
+                                   username=user,
+                                   key_filename=self.ssh_key)
                 break
             except paramiko.AuthenticationException:
-                log.error("Authentication for root failed")
+                log.error("Authentication failed")
                 exit(1)
             except paramiko.BadHostKeyException:
                 log.error("Invalid Host key")
@@ -306,7 +424,7 @@ class RemoteMachineShellConnection:
             except Exception as e:
                 if str(e).find('PID check failed. RNG must be re-initialized') != -1 and\
                         attempt != max_attempts_connect:
-                    log.error("Can't establish SSH session to node {1} as root:\
+                    log.error("Can't establish SSH session to node {1} :\
                               {0}. Will try again in 1 sec".format(e, self.ip))
                     attempt += 1
                     time.sleep(1)
@@ -314,7 +432,7 @@ class RemoteMachineShellConnection:
                     log.error("Can't establish SSH session to node {1} :\
                                                    {0}".format(e, self.ip))
                     exit(1)
-        log.info("Connected to {0} as {1}".format(self.ip, user))
+        return SSH_SESSIONS.add(self._session_key, client)
 
     def sleep(self, timeout=1, message=""):
         log.info("{0}:sleep for {1} secs. {2} ...".format(self.ip, timeout, message))
@@ -3265,6 +3383,11 @@ class RemoteMachineShellConnection:
         output = []
         error = []
         temp = ''
+        if self.remote and self._session_key is not None and \
+                not SSH_SESSIONS.is_active(self._ssh_client):
+            # the pooled session went down, e.g. because the node rebooted
+            SSH_SESSIONS.evict(self._session_key, self._ssh_client)
+            self._ssh_client = self._ssh_connect(self._session_key[1])
         if self.remote and self.use_sudo or use_channel:
             channel = self._ssh_client.get_transport().open_session()
             channel.get_pty()
@@ -3334,7 +3457,9 @@ class RemoteMachineShellConnection:
                 self.log_command_output(o, r, debug=False)
 
     def disconnect(self):
-        self._ssh_client.close()
+        # pooled sessions stay open for the next connection to this node
+        if self._session_key is None:
+            self._ssh_client.close()
 
     def extract_remote_info(self):
         # initialize params
@@ -3349,6 +3474,10 @@ class RemoteMachineShellConnection:
         # use sftp to if certain types exists or not
         if getattr(self, "info", None) is not None and isinstance(self.info, RemoteMachineInfo):
             return self.info
+        info = _remote_machine_info.get(self.ip)
+        if info is not None:
+            self.info = info
+            return info
         mac_check_cmd = "sw_vers | grep ProductVersion | awk '{ print $2 }'"
         if self.remote:
             stdin, stdout, stderro = self._ssh_client.exec_command(mac_check_cmd)
@@ -3524,6 +3653,7 @@ class RemoteMachineShellConnection:
             info.hostname = self.get_hostname(win_info)
             info.domain = self.get_domain(win_info)
             self.info = info
+            _remote_machine_info[self.ip] = info
             return info
         else:
             # now run uname -m to get the architechtre type
@@ -3569,6 +3699,7 @@ class RemoteMachineShellConnection:
             info.hostname = self.get_hostname()
             info.domain = self.get_domain()
             self.info = info
+            _remote_machine_info[self.ip] = info
             return info
 
     def get_extended_windows_info(self):
@@ -4107,7 +4238,10 @@ class RemoteMachineShellConnection:
         self.log_command_output(output, error)
 
     def get_data_map_using_cbtransfer(self, buckets, data_path=None, userId="Administrator",
-                                      password="password", getReplica=False, mode="memory"):
+                                      password="password", getReplica=False, mode="memory",
+                                      parser=None):
+        """ parser, if given, is called with the open csv file of each bucket
+            and its result is returned instead of the list of lines """
         self.extract_remote_info()
         temp_path = "/tmp/"
         if self.info.type.lower() == 'windows':
@@ -4156,7 +4290,10 @@ class RemoteMachineShellConnection:
                 headerInfo = ""
                 with open(dest_path) as f:
                     headerInfo = f.readline()
-                    content = f.readlines()
+                    if parser is None:
+                        content = f.readlines()
+                    else:
+                        content = parser(f)
                 bucketMap[bucket.name] = content
                 os.remove(dest_path)
         return headerInfo, bucketMap
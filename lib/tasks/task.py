@@ -8,17 +8,24 @@ import copy
 import json
 import re
 import math
+import bisect
 import crc32
 import traceback
 import testconstants
 from http.client import IncompleteRead
+import threading
+import array
+import pickle
+import queue
+import collections
+import concurrent.futures
 from threading import Thread
 from memcacheConstants import ERR_NOT_FOUND, NotFoundError
+from membase.api import http_pool
 from membase.api.rest_client import RestConnection, Bucket, RestHelper
 from membase.api.exception import BucketCreationException
 from membase.helper.bucket_helper import BucketOperationHelper
 from memcached.helper.data_helper import KVStoreAwareSmartClient, MemcachedClientHelper
-from memcached.helper.kvstore import KVStore
 from couchbase_helper.document import DesignDocument, View
 from mc_bin_client import MemcachedError, MemcachedClient
 from tasks.future import Future
@@ -28,11 +35,13 @@ from membase.api.exception import N1QLQueryException, DropIndexException, Create
                                     ServerUnavailableException, BucketFlushFailed, CBRecoveryFailedException, BucketCompactionException, AutoFailoverException
 from remote.remote_util import RemoteMachineShellConnection, RemoteUtilHelper
 from couchbase_helper.documentgenerator import BatchedDocumentGenerator
+from couchbase_helper import view_results
 from TestInput import TestInputServer, TestInputSingleton
 from testconstants import MIN_KV_QUOTA, INDEX_QUOTA, FTS_QUOTA, COUCHBASE_FROM_4DOT6,\
                           THROUGHPUT_CONCURRENCY, ALLOW_HTP, CBAS_QUOTA, COUCHBASE_FROM_VERSION_4,\
                           CLUSTER_QUOTA_RATIO
-from multiprocessing import Process, Manager, Semaphore
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait as wait_connections
 import memcacheConstants
 from membase.api.exception import CBQError
 from deepdiff import DeepDiff
@@ -55,12 +64,16 @@ except Exception as e:
 # stacktracer.trace_start("trace.html",interval=30,auto=True) # Set auto flag to always update file!
 
 
-CONCURRENCY_LOCK = Semaphore(THROUGHPUT_CONCURRENCY)
 PENDING = 'PENDING'
 EXECUTING = 'EXECUTING'
 CHECKING = 'CHECKING'
 FINISHED = 'FINISHED'
 
+# fields of the metadata tuples VBucketAwareMemcached.getMetaMulti returns
+META_DATA_FIELDS = ('deleted', 'flags', 'expiration', 'seqno', 'cas')
+# keys whose metadata is read with one pipelined getMetaMulti
+META_DATA_BATCH_SIZE = 1000
+
 class Task(Future):
     def __init__(self, name):
         Future.__init__(self)
@@ -727,10 +740,8 @@ class GenericLoadingTask(Thread, Task):
         else:
             self.client = VBucketAwareMemcached(RestConnection(server), bucket, compression=compression)
         self.process_concurrency = THROUGHPUT_CONCURRENCY
-        # task queue's for synchronization
-        process_manager = Manager()
-        self.wait_queue = process_manager.Queue()
-        self.shared_kvstore_queue = process_manager.Queue()
+        self.deleted_keys_verified = 0
+        self.deleted_keys_time = 0
 
     def execute(self, task_manager):
         self.start()
@@ -941,18 +952,7 @@ class GenericLoadingTask(Thread, Task):
                 self.set_exception(error)
 
     def _process_values_for_create(self, key_val):
-        for key, value in list(key_val.items()):
-            try:
-                value_json = json.loads(value)
-                value_json['mutated'] = 0
-                value = json.dumps(value_json)
-            except ValueError:
-                index = random.choice(list(range(len(value))))
-                value = value[0:index] + random.choice(string.ascii_uppercase) + value[index + 1:]
-            except TypeError:
-                 value = json.dumps(value)
-            finally:
-                key_val[key] = value
+        process_values_for_create(key_val)
 
     def _process_values_for_update(self, partition_keys_dic, key_val):
         for partition, keys in list(partition_keys_dic.items()):
@@ -982,10 +982,56 @@ class GenericLoadingTask(Thread, Task):
             self.kv_store.release_lock(part)
 
     def _populate_kvstore_partition(self, partition, keys, key_val):
-        for key in keys:
-            if self.only_store_hash:
-                key_val[key] = str(crc32.crc32_hash(key_val[key]))
-            partition.set(key, key_val[key], self.exp, self.flag)
+        if self.only_store_hash:
+            hashes = crc32.hash_values([key_val[key] for key in keys])
+            for key, value_hash in zip(keys, hashes):
+                key_val[key] = str(value_hash)
+        partition.set_many([(key, key_val[key]) for key in keys], self.exp, self.flag)
+
+    def _check_deleted_keys(self, keys, bucket="default", collection=None):
+        """
+            verifies that a batch of keys the kv store has as deleted are not
+            on the server, with one pipelined getMetaMulti per server and the
+            partition locks taken once. A key still there is only an error if
+            the kv store doesn't have it as valid by now, the mismatches of a
+            batch are reported together.
+        """
+        if not hasattr(self.client, "getMetaMulti"):
+            for key in keys:
+                self._check_deleted_key(key, bucket, collection=collection)
+            return
+        start = time.time()
+        partition_keys_dic = self.kv_store.acquire_partitions(keys, bucket, collection=collection)
+        try:
+            keys_meta = self.client.getMetaMulti(keys, collection=collection)
+        except BaseException as error:
+            self.log.error("Get meta failed via memcached client. Error: %s" % str(error))
+            self.state = FINISHED
+            self.kv_store.release_partitions(list(partition_keys_dic.keys()))
+            self.set_exception(error)
+            return
+        not_deleted = []
+        for partition, part_keys in list(partition_keys_dic.items()):
+            for key in part_keys:
+                meta_data = keys_meta.get(key)
+                # missing, deleted or expired and not purged yet
+                if meta_data is None or meta_data[0] or 0 < meta_data[2] <= start:
+                    continue
+                if partition.get_valid(key) is None:
+                    not_deleted.append(key)
+        self.kv_store.release_partitions(list(partition_keys_dic.keys()))
+        self.deleted_keys_verified += len(keys)
+        self.deleted_keys_time += time.time() - start
+        if not_deleted:
+            self.state = FINISHED
+            self.set_exception(Exception('Not Deletes: {0} of {1} keys, first {2}'
+                                         .format(len(not_deleted), len(keys), not_deleted[:20])))
+
+    def _log_deleted_keys_rate(self):
+        if self.deleted_keys_verified:
+            self.log.info("{0} deleted items were verified in {1:.1f} sec, {2:.0f} per second".format(
+                self.deleted_keys_verified, self.deleted_keys_time,
+                self.deleted_keys_verified / max(self.deleted_keys_time, 0.001)))
 
 
 class LoadDocumentsTask(GenericLoadingTask):
@@ -1054,6 +1100,172 @@ class LoadDocumentsTask(GenericLoadingTask):
 
 
 
+def process_values_for_create(key_val):
+    for key, value in list(key_val.items()):
+        try:
+            value_json = json.loads(value)
+            value_json['mutated'] = 0
+            value = json.dumps(value_json)
+        except ValueError:
+            index = random.choice(list(range(len(value))))
+            value = value[0:index] + random.choice(string.ascii_uppercase) + value[index + 1:]
+        except TypeError:
+             value = json.dumps(value)
+        finally:
+            key_val[key] = value
+
+
+def _loader_client(job):
+    if CHECK_FLAG:
+        return VBucketAwareMemcached(RestConnection(job["server"]), job["bucket"])
+    return VBucketAwareMemcached(RestConnection(job["server"]), job["bucket"],
+                                 compression=job["compression"])
+
+
+def _run_loader_job(conn, job, clients):
+    client_key = (job["server"].ip, job["server"].port, str(job["bucket"]), job["compression"])
+    generator = job["generator"]
+    while generator.has_next():
+        key_value = generator.next_batch()
+        process_values_for_create(key_value)
+        for attempt in range(2):
+            if client_key not in clients:
+                clients[client_key] = _loader_client(job)
+            try:
+                clients[client_key].setMulti(job["exp"], job["flag"], key_value, job["pause"], job["timeout"],
+                                             parallel=False, collection=job["collection"])
+                break
+            except (MemcachedError, ServerUnavailableException, socket.error, EOFError, AttributeError,
+                    RuntimeError):
+                # the bucket may have been recreated since the client was built
+                del clients[client_key]
+                if attempt:
+                    raise
+        keys = list(key_value.keys())
+        if job["only_store_hash"]:
+            values = array.array('I', crc32.hash_values([key_value[key] for key in keys]))
+        else:
+            values = [key_value[key] for key in keys]
+        conn.send(("batch", keys, values))
+
+
+def _loader_worker(conn):
+    # the rest connections of the parent's threads must not be reused here
+    http_pool.POOL.reset()
+    clients = {}
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        error = None
+        try:
+            _run_loader_job(conn, job, clients)
+        except Exception as e:
+            traceback.print_exc()
+            error = "{0}: {1}".format(type(e).__name__, e)
+        conn.send(("done", error))
+
+
+class LoaderProcessPool(object):
+    """Long lived loader processes for the high throughput load mode
+
+    Every process keeps a client per server and bucket and loads the key
+    ranges (batched generators) it is sent. For every batch it sends back
+    the keys and the crc32 hashes of the values, so the parent fills its
+    KVStore while the load runs instead of merging whole pickled stores.
+    Tasks running at the same time share the processes."""
+
+    def __init__(self, processes=THROUGHPUT_CONCURRENCY):
+        self.processes = processes
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _start_worker(self):
+        conn, child_conn = Pipe()
+        process = Process(target=_loader_worker, args=(child_conn,))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def _start(self):
+        with self._lock:
+            if not self._started:
+                for _ in range(self.processes):
+                    self._idle.put(self._start_worker())
+                self._started = True
+
+    def run(self, jobs, on_batch):
+        """
+            runs the jobs on the loader processes and calls on_batch(keys,
+            values) in this thread for every batch they load
+
+            returns the errors of the failed jobs and the indexes of the jobs
+            which could not be sent to a process
+        """
+        self._start()
+        pending = list(range(len(jobs)))
+        busy = {}
+        errors = []
+        unsent = []
+        while pending or busy:
+            while pending:
+                try:
+                    worker = self._idle.get(block=not busy)
+                except queue.Empty:
+                    break
+                if not worker[0].is_alive():
+                    worker = self._start_worker()
+                index = pending.pop(0)
+                try:
+                    worker[1].send(jobs[index])
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    self._idle.put(worker)
+                    unsent.append(index)
+                    continue
+                busy[worker[1]] = worker
+            for conn in wait_connections(list(busy.keys())):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    errors.append("loader process {0} exited".format(busy[conn][0].pid))
+                    busy.pop(conn)
+                    self._idle.put(self._start_worker())
+                    continue
+                if message[0] == "batch":
+                    on_batch(message[1], message[2])
+                else:
+                    if message[1] is not None:
+                        errors.append(message[1])
+                    self._idle.put(busy.pop(conn))
+        return errors, unsent
+
+    def close(self):
+        """stops the idle loader processes, the next run() starts new ones"""
+        with self._lock:
+            workers = []
+            while True:
+                try:
+                    workers.append(self._idle.get(block=False))
+                except queue.Empty:
+                    break
+            self._started = False
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except (OSError, EOFError):
+                pass
+            process.join(5)
+            conn.close()
+
+
+LOADER_POOL = LoaderProcessPool()
+
+
 class LoadDocumentsGeneratorsTask(LoadDocumentsTask):
     def __init__(self, server, bucket, generators, kv_store, op_type, exp, flag=0, only_store_hash=True,
                  batch_size=1,pause_secs=1, timeout_secs=60, compression=True,collection=None):
@@ -1074,6 +1286,7 @@ class LoadDocumentsGeneratorsTask(LoadDocumentsTask):
         self.is_high_throughput_mode = False
         if ALLOW_HTP and not TestInputSingleton.input.param("disable_HTP", False):
             self.is_high_throughput_mode = self.op_type == "create" and \
+                not isinstance(bucket, list) and \
                 self.batch_size > 1 and \
                 len(self.generators) < self.process_concurrency
 
@@ -1101,7 +1314,12 @@ class LoadDocumentsGeneratorsTask(LoadDocumentsTask):
 
         # check if running in high throughput mode or normal
         if self.is_high_throughput_mode:
-            self.run_high_throughput_mode()
+            try:
+                self.run_high_throughput_mode()
+            except Exception as e:
+                self.state = FINISHED
+                self.set_exception(e)
+                return
         else:
             self.run_normal_throughput_mode()
 
@@ -1151,104 +1369,42 @@ class LoadDocumentsGeneratorsTask(LoadDocumentsTask):
               except Exception as e:
                 traceback.print_exc()
 
-
-        iterator = 0
-        all_processes = []
-        for generator in self.generators:
-
-            # only start processing when there resources available
-            CONCURRENCY_LOCK.acquire()
-
-            generator_process = Process(
-                target=self.run_generator,
-                args=(generator, iterator))
-            generator_process.start()
-            iterator += 1
-            all_processes.append(generator_process)
-
-            # add child process to wait queue
-            self.wait_queue.put(iterator)
-
-        # wait for all child processes to finish
-        self.wait_queue.join()
-
-        # merge kvstore partitions
-        while self.shared_kvstore_queue.empty() is False:
-
-            # get partitions created by child process
-            rv =  self.shared_kvstore_queue.get()
-            if rv["err"] is not None:
-                raise Exception(rv["err"])
-
-            # merge child partitions with parent
-            generator_partitions = rv["partitions"]
-            self.kv_store.merge_partitions(generator_partitions)
-
-            # terminate child process
-            iterator-=1
-            all_processes[iterator].terminate()
-
-    def run_generator(self, generator, iterator):
-
-        tmp_kv_store = KVStore()
-        rv = {"err": None, "partitions": None}
-
-        try:
-
-            if CHECK_FLAG:
-                client = VBucketAwareMemcached(
-                        RestConnection(self.server),
-                        self.bucket)
-            else:
-                client = VBucketAwareMemcached(
-                    RestConnection(self.server),
-                    self.bucket, compression=self.compression)
-            try:
-              if self.op_types:
-                self.op_type = self.op_types[iterator]
-              if self.buckets:
-                self.bucket = self.buckets[iterator]
-
-              while generator.has_next() and not self.done():
-
-                # generate
-                key_value = generator.next_batch()
-                # create
-                #self.log.info("-->run_generator:calling _care_batch_client...key_value={},client={}".format(key_value,client))
-                self._create_batch_client(key_value, client)
-
-                # cache
-                self.cache_items(tmp_kv_store, key_value)
-            except Exception as e:
-                traceback.print_exc()
-
-        except Exception as ex:
-            rv["err"] = ex
-        else:
-            rv["partitions"] = tmp_kv_store.get_partitions()
-        finally:
-            # share the kvstore from this generator
-            self.shared_kvstore_queue.put(rv)
-            self.wait_queue.task_done()
-            # release concurrency lock
-            CONCURRENCY_LOCK.release()
-
+        jobs = [{"server": self.server, "bucket": self.bucket, "compression": self.compression,
+                 "generator": generator, "exp": self.exp, "flag": self.flag,
+                 "pause": self.pause, "timeout": self.timeout, "collection": self.collection,
+                 "only_store_hash": self.only_store_hash}
+                for generator in self.generators]
+        start = time.time()
+        self.loaded = 0
+        errors, unsent = LOADER_POOL.run(jobs, self.cache_loaded_batch)
+        # generators which can't be pickled for the loader processes
+        for index in unsent:
+            self.generator = self.generators[index]
+            while self.has_next() and not self.done():
+                self.next()
+        if errors:
+            raise Exception(errors[0])
+        elapsed = time.time() - start
+        self.log.info("{0} items loaded by {1} loader processes in {2:.1f}s ({3:.0f} items/sec)"
+                      .format(self.loaded, LOADER_POOL.processes, elapsed,
+                              self.loaded / elapsed if elapsed else 0))
+
+    def cache_loaded_batch(self, keys, values):
+        """
+            adds a batch loaded by a loader process to the kv store, values
+            are the crc32 hashes of the values if only_store_hash is set
+        """
+        self.kv_store.set_many(dict(zip(keys, map(str, values))), self.exp, self.flag,
+                               self.bucket, self.collection)
+        self.loaded += len(keys)
 
     def cache_items(self, store, key_value):
         """
             unpacks keys,values and adds them to provided store
         """
-        for key, value in key_value.items():
-
-            if self.only_store_hash:
-                value = str(crc32.crc32_hash(value))
-
-            partition = store.partition(key, self.collection, self.bucket)
-            partition["partition"].set(
-            key,
-            value,
-            self.exp,
-            self.flag)
+        if self.only_store_hash:
+            key_value = dict(zip(key_value, map(str, crc32.hash_values(list(key_value.values())))))
+        store.set_many(key_value, self.exp, self.flag, self.bucket, self.collection)
 
 
 class ESLoadGeneratorTask(Task):
@@ -1286,10 +1442,14 @@ class ESLoadGeneratorTask(Task):
 class ESBulkLoadGeneratorTask(Task):
     """
         Class to load/update/delete documents into/from Elastic Search
+
+        Batches are built as NDJSON bodies in memory and up to max_in_flight
+        _bulk requests run at the same time while the next batches are
+        generated. The index is refreshed once all batches are loaded.
     """
 
     def __init__(self, es_instance, index_name, generator, op_type="create",
-                 batch=1000,collection=None):
+                 batch=1000,collection=None, max_in_flight=4):
         Task.__init__(self, "ES_loader_task")
         self.es_instance = es_instance
         self.index_name = index_name
@@ -1298,6 +1458,9 @@ class ESBulkLoadGeneratorTask(Task):
         self.op_type = op_type
         self.batch_size = batch
         self.collection=collection
+        self.max_in_flight = max_in_flight
+        self.loaded = 0
+        self.failed = 0
         self.log.info("Starting operation '%s' on Elastic Search ..." % op_type)
 
     def check(self, task_manager):
@@ -1305,45 +1468,109 @@ class ESBulkLoadGeneratorTask(Task):
         self.set_result(True)
 
     def execute(self, task_manager):
-        es_filename = "/tmp/es_bulk.txt"
-        es_bulk_docs = []
-        loaded = 0
-        batched = 0
-        for key, doc in self.generator:
-            doc = json.loads(doc)
-            es_doc = {
-                self.op_type: {
-                    "_index": self.index_name,
-                    "_type": doc['type'],
-                    "_id": key,
+        start = time.time()
+        in_flight = collections.deque()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            es_bulk_docs = []
+            batched = 0
+            for key, doc in self.generator:
+                doc = json.loads(doc)
+                es_doc = {
+                    self.op_type: {
+                        "_index": self.index_name,
+                        "_type": doc['type'],
+                        "_id": key,
+                    }
                 }
-            }
-            es_bulk_docs.append(json.dumps(es_doc))
-            if self.op_type == "create":
-                es_bulk_docs.append(json.dumps(doc))
-            elif self.op_type == "update":
-                doc['mutated'] += 1
-                es_bulk_docs.append(json.dumps({"doc": doc}))
-            batched += 1
-            if batched == self.batch_size or not self.generator.has_next():
-                es_file = open(es_filename, "wb")
-                for line in es_bulk_docs:
-                    es_file.write("{}\n".format(line).encode())
-                es_file.close()
-                self.es_instance.load_bulk_data(es_filename)
-                loaded += batched
-                self.log.info("{0} documents bulk loaded into ES".format(loaded))
-                self.es_instance.update_index(self.index_name)
-                batched = 0
+                es_bulk_docs.append(json.dumps(es_doc))
+                if self.op_type == "create":
+                    es_bulk_docs.append(json.dumps(doc))
+                elif self.op_type == "update":
+                    doc['mutated'] += 1
+                    es_bulk_docs.append(json.dumps({"doc": doc}))
+                batched += 1
+                if batched == self.batch_size or not self.generator.has_next():
+                    if len(in_flight) == self.max_in_flight:
+                        self._finish_batch(*in_flight.popleft())
+                    body = ("\n".join(es_bulk_docs) + "\n").encode()
+                    in_flight.append((batched, executor.submit(self.es_instance.load_bulk_body, body)))
+                    es_bulk_docs = []
+                    batched = 0
+            while in_flight:
+                self._finish_batch(*in_flight.popleft())
+            self.es_instance.update_index(self.index_name)
+        except Exception as e:
+            self.log.error(e)
+            self.set_exception(e)
+            self.state = FINISHED
+            return
+        finally:
+            executor.shutdown()
+        elapsed = time.time() - start
+        self.log.info("{0} documents bulk loaded into ES in {1:.1f}s ({2:.0f} docs/sec), {3} failed"
+                      .format(self.loaded, elapsed, self.loaded / elapsed if elapsed else 0,
+                              self.failed))
         indexed = self.es_instance.get_index_count(self.index_name)
         self.log.info("ES index count for '{0}': {1}".
                               format(self.index_name, indexed))
         self.state = FINISHED
         self.set_result(True)
 
+    def _finish_batch(self, batched, result):
+        status, errors = result.result()
+        if not status:
+            self.failed += batched
+            self.log.error("ES bulk request of {0} documents failed".format(batched))
+            return
+        self.loaded += batched - len(errors)
+        if errors:
+            self.failed += len(errors)
+            self.log.error("{0} of {1} documents failed in ES bulk request, first errors: {2}"
+                           .format(len(errors), batched, errors[:5]))
+        self.log.info("{0} documents bulk loaded into ES".format(self.loaded))
+
+
+class QueryLatencies(object):
+    """Thread safe latency samples (in seconds) per query engine"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, engine, latency):
+        with self._lock:
+            self.samples.setdefault(engine, []).append(latency)
+
+    def percentiles(self, engine, percents=(50, 90, 95, 99)):
+        with self._lock:
+            samples = sorted(self.samples.get(engine, []))
+        if not samples:
+            return {}
+        return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+                for p in percents}
+
+    def summary(self):
+        lines = []
+        for engine in sorted(self.samples):
+            percentiles = self.percentiles(engine)
+            lines.append("{0} latency over {1} queries: {2}".format(
+                engine, len(self.samples[engine]),
+                ", ".join("p{0} {1:.1f}ms".format(p, percentiles[p] * 1000)
+                          for p in sorted(percentiles))))
+        return lines
+
 
 class ESRunQueryCompare(Task):
-    def __init__(self, fts_index, es_instance, query_index, es_index_name=None, n1ql_executor=None):
+    """Runs an FTS query, the ES query and optionally a N1QL search query
+    and compares the doc ids they return
+
+    With an executor (concurrent.futures) the ES and N1QL queries are sent
+    while the FTS query runs, otherwise the queries run one by one. The
+    latency of every query is added to latencies if it is given."""
+
+    def __init__(self, fts_index, es_instance, query_index, es_index_name=None, n1ql_executor=None,
+                 executor=None, latencies=None):
         Task.__init__(self, "Query_runner_task")
         self.fts_index = fts_index
         self.fts_query = fts_index.fts_queries[query_index]
@@ -1356,6 +1583,8 @@ class ESRunQueryCompare(Task):
         self.passed = True
         self.es_index_name = es_index_name or "es_index"
         self.n1ql_executor = n1ql_executor
+        self.executor = executor
+        self.latencies = latencies
 
     def check(self, task_manager):
         self.state = FINISHED
@@ -1369,9 +1598,16 @@ class ESRunQueryCompare(Task):
                           "-------------- Query # %s -------------"
                           "---------------------------------------"
                           % str(self.query_index+1))
+            es_result = n1ql_result = None
+            if self.es and self.es_query:
+                es_result = self._submit("es", self.run_es_query, self.es_query)
+            if self.n1ql_executor:
+                n1ql_query = "select meta().id from default where type='emp' and search(default, " + str(
+                    json.dumps(self.fts_query)) + ")"
+                n1ql_result = self._submit("n1ql", self.n1ql_executor.run_n1ql_query, n1ql_query)
             try:
                 fts_hits, fts_doc_ids, fts_time, fts_status = \
-                    self.run_fts_query(self.fts_query)
+                    self._timed("fts", self.run_fts_query, self.fts_query)
                 self.log.info("Status: %s" %fts_status)
                 if fts_hits < 0:
                     self.passed = False
@@ -1400,8 +1636,8 @@ class ESRunQueryCompare(Task):
                 self.log.error("ERROR: FTS Query timed out (client timeout=70s)!")
                 self.passed = False
             es_hits = 0
-            if self.es and self.es_query:
-                es_hits, es_doc_ids, es_time = self.run_es_query(self.es_query)
+            if es_result:
+                es_hits, es_doc_ids, es_time = es_result()
                 self.log.info("ES hits for query: %s on %s is %s (took %sms)" % \
                               (json.dumps(self.es_query,  ensure_ascii=False),
                                self.es_index_name,
@@ -1433,10 +1669,8 @@ class ESRunQueryCompare(Task):
                 should_verify_n1ql = False
 
             if self.n1ql_executor and should_verify_n1ql:
-                n1ql_query = "select meta().id from default where type='emp' and search(default, " + str(
-                    json.dumps(self.fts_query)) + ")"
                 self.log.info("Running N1QL query: "+str(n1ql_query))
-                n1ql_result = self.n1ql_executor.run_n1ql_query(query=n1ql_query)
+                n1ql_result = n1ql_result()
                 if n1ql_result['status'] == 'success':
                     n1ql_hits = n1ql_result['metrics']['resultCount']
                     n1ql_doc_ids = []
@@ -1484,6 +1718,21 @@ class ESRunQueryCompare(Task):
             self.set_exception(e)
             self.state = FINISHED
 
+    def _timed(self, engine, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            if self.latencies is not None:
+                self.latencies.add(engine, time.time() - start)
+
+    def _submit(self, engine, func, *args):
+        """Starts func on the executor, returns a function giving its
+        result. Without an executor func only runs once that is called."""
+        if self.executor is None:
+            return lambda: self._timed(engine, func, *args)
+        return self.executor.submit(self._timed, engine, func, *args).result
+
     def run_fts_query(self, query):
         return self.fts_index.execute_query(query)
 
@@ -1533,7 +1782,7 @@ class BatchedLoadDocumentsTask(GenericLoadingTask):
         else:
             self.state = FINISHED
             self.set_exception(Exception("Bad operation type: %s" % self.op_type))
-        self.kv_store.release_partitions(list(partition_keys_dic.keys()), self.collection)
+        self.kv_store.release_partitions(list(partition_keys_dic.keys()))
 
     def _create_batch(self, partition_keys_dic, key_val):
         try:
@@ -1620,10 +1869,11 @@ class BatchedLoadDocumentsTask(GenericLoadingTask):
             self.kv_store.release_lock(part)
 
     def _populate_kvstore_partition(self, partition, keys, key_val):
-        for key in keys:
-            if self.only_store_hash:
-                key_val[key] = str(crc32.crc32_hash(key_val[key]))
-            partition.set(key, key_val[key], self.exp, self.flag)
+        if self.only_store_hash:
+            hashes = crc32.hash_values([key_val[key] for key in keys])
+            for key, value_hash in zip(keys, hashes):
+                key_val[key] = str(value_hash)
+        partition.set_many([(key, key_val[key]) for key in keys], self.exp, self.flag)
 
 
 
@@ -1743,14 +1993,19 @@ class ValidateDataTask(GenericLoadingTask):
         self.log.info("{0} items were verified in {1} sec.the average number of ops\
             - {2} per second ".format(self.itr, time.time() - self.start_time,
                 self.itr // (time.time() - self.start_time)).rstrip())
+        self._log_deleted_keys_rate()
         return False
 
     def __next__(self):
         if self.itr < self.num_valid_keys:
             self._check_valid_key(self.valid_keys[self.itr], self.bucket, self.collection)
+            self.itr += 1
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys], self.bucket, self.collection)
-        self.itr += 1
+            start = self.itr - self.num_valid_keys
+            end = min(start + META_DATA_BATCH_SIZE, self.max_verify - self.num_valid_keys)
+            keys = self.deleted_keys[start:end]
+            self._check_deleted_keys(keys, self.bucket, self.collection)
+            self.itr += len(keys)
 
     def _check_valid_key(self, key, bucket="default", collection=None):
         partition = self.kv_store.acquire_partition(key, bucket, collection=collection)
@@ -1839,14 +2094,19 @@ class ValidateDataWithActiveAndReplicaTask(GenericLoadingTask):
         self.log.info("{0} items were verified in {1} sec.the average number of ops\
             - {2} per second ".format(self.itr, time.time() - self.start_time,
                 self.itr // (time.time() - self.start_time)).rstrip())
+        self._log_deleted_keys_rate()
         return False
 
     def __next__(self):
         if self.itr < self.num_valid_keys:
             self._check_valid_key(self.valid_keys[self.itr], self.bucket, self.collection)
+            self.itr += 1
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys], self.bucket, self.collection)
-        self.itr += 1
+            start = self.itr - self.num_valid_keys
+            end = min(start + META_DATA_BATCH_SIZE, self.max_verify - self.num_valid_keys)
+            keys = self.deleted_keys[start:end]
+            self._check_deleted_keys(keys, self.bucket, self.collection)
+            self.itr += len(keys)
 
     def _check_valid_key(self, key,bucket, collection=None):
         partition = self.kv_store.acquire_partition(key, bucket, collection=collection)
@@ -1923,6 +2183,7 @@ class BatchedValidateDataTask(GenericLoadingTask):
             self.log.info("{0} items were verified in {1} sec.the average number of ops\
                 - {2} per second".format(self.itr, time.time() - self.start_time,
                 self.itr // (time.time() - self.start_time)).rstrip())
+            self._log_deleted_keys_rate()
         return has
 
     def __next__(self):
@@ -1931,8 +2192,10 @@ class BatchedValidateDataTask(GenericLoadingTask):
             self.itr += len(keys_batch)
             self._check_valid_keys(keys_batch, self.bucket, self.collection)
         else:
-            self._check_deleted_key(self.deleted_keys[self.itr - self.num_valid_keys], self.bucket, self.collection)
-            self.itr += 1
+            start = self.itr - self.num_valid_keys
+            keys_batch = self.deleted_keys[start:start + self.batch_size]
+            self.itr += len(keys_batch)
+            self._check_deleted_keys(keys_batch, self.bucket, self.collection)
 
     def _check_valid_keys(self, keys,bucket, collection=None):
         partition_keys_dic = self.kv_store.acquire_partitions(keys, bucket, collection=collection)
@@ -2005,7 +2268,7 @@ class BatchedValidateDataTask(GenericLoadingTask):
 
 class VerifyRevIdTask(GenericLoadingTask):
     def __init__(self, src_server, dest_server, bucket, src_kv_store, dest_kv_store, max_err_count=200000,
-                 max_verify=None, compression=True, collection=None):
+                 max_verify=None, compression=True, collection=None, batch_size=META_DATA_BATCH_SIZE):
         GenericLoadingTask.__init__(self, src_server, bucket, src_kv_store, compression=compression, collection=collection)
         from memcached.helper.data_helper import VBucketAwareMemcached as SmartClient
         self.collection=collection
@@ -2013,6 +2276,9 @@ class VerifyRevIdTask(GenericLoadingTask):
         self.client_dest = SmartClient(RestConnection(dest_server), bucket)
         self.src_valid_keys, self.src_deleted_keys = src_kv_store.key_set(bucket=self.bucket, collection=self.collection)
         self.dest_valid_keys, self.dest_del_keys = dest_kv_store.key_set(bucket=self.bucket, collection=self.collection)
+        self.src_deleted_set = set(self.src_deleted_keys)
+        self.dest_keys = set(self.dest_valid_keys)
+        self.dest_keys.update(self.dest_del_keys)
         self.num_valid_keys = len(self.src_valid_keys)
         self.num_deleted_keys = len(self.src_deleted_keys)
         self.keys_not_found = {self.client.rest.ip: [], self.client_dest.rest.ip: []}
@@ -2021,6 +2287,7 @@ class VerifyRevIdTask(GenericLoadingTask):
         else:
             self.max_verify = self.num_valid_keys + self.num_deleted_keys
         self.itr = 0
+        self.batch_size = batch_size
         self.not_matching_filter_keys = 0
         self.err_count = 0
         self.max_err_count = max_err_count
@@ -2055,46 +2322,60 @@ class VerifyRevIdTask(GenericLoadingTask):
         return False
 
     def __next__(self):
+        prev_itr = self.itr
         if self.itr < self.num_valid_keys:
-            self._check_key_revId(self.src_valid_keys[self.itr], collection=self.collection)
-        elif self.itr < (self.num_valid_keys + self.num_deleted_keys):
+            end = min(self.itr + self.batch_size, self.num_valid_keys, self.max_verify)
+            keys = self.src_valid_keys[self.itr:end]
+            self._check_keys_revId(keys, collection=self.collection)
+        else:
             # verify deleted/expired keys
-            self._check_key_revId(self.src_deleted_keys[self.itr - self.num_valid_keys],
-                                  ignore_meta_data=['expiration', 'cas'], collection=self.collection)
-        self.itr += 1
+            end = min(self.itr + self.batch_size, self.num_valid_keys + self.num_deleted_keys, self.max_verify)
+            keys = self.src_deleted_keys[self.itr - self.num_valid_keys:end - self.num_valid_keys]
+            self._check_keys_revId(keys, ignore_meta_data=['expiration', 'cas'], collection=self.collection)
+        self.itr += len(keys)
 
         # show progress of verification for every 50k items
-        if math.fmod(self.itr, 50000) == 0.0:
+        if self.itr // 50000 > prev_itr // 50000:
             self.log.info("{0} items have been verified".format(self.itr))
 
-
-    def __get_meta_data(self, client, key, collection=None):
+    def __get_meta_data(self, client, keys, collection=None):
         try:
-            mc = client.memcached(key)
-            meta_data = eval("{'deleted': %s, 'flags': %s, 'expiration': %s, 'seqno': %s, 'cas': %s}" % (mc.getMeta(key, collection=collection)))
-            return meta_data
+            return client.getMetaMulti(keys, collection=collection)
         except MemcachedError as error:
-            if error.status == ERR_NOT_FOUND:
-                # if a filter was specified, the key will not be found in
-                # target kv store if key did not match filter expression
-                if key not in self.src_deleted_keys and key in (self.dest_valid_keys+self.dest_del_keys):
-                    self.err_count += 1
-                    self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key, collection=collection)))
-                else:
-                    self.not_matching_filter_keys +=1
-            else:
-                self.state = FINISHED
-                self.set_exception(error)
+            self.state = FINISHED
+            self.set_exception(error)
         # catch and set all unexpected exceptions
         except Exception as e:
             self.state = FINISHED
             self.set_unexpected_exception(e)
 
-    def _check_key_revId(self, key, ignore_meta_data=[], collection=None):
-        src_meta_data = self.__get_meta_data(self.client_src, key, collection=collection)
-        dest_meta_data = self.__get_meta_data(self.client_dest, key, collection=collection)
-        if not src_meta_data or not dest_meta_data:
+    def __key_meta_data(self, client, key, keys_meta, collection=None):
+        meta_data = keys_meta.get(key)
+        if meta_data is not None:
+            return dict(zip(META_DATA_FIELDS, meta_data))
+        # if a filter was specified, the key will not be found in
+        # target kv store if key did not match filter expression
+        if key not in self.src_deleted_set and key in self.dest_keys:
+            self.err_count += 1
+            self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key, collection=collection)))
+        else:
+            self.not_matching_filter_keys +=1
+
+    def _check_keys_revId(self, keys, ignore_meta_data=[], collection=None):
+        # the source is read on another thread while the destination is read here
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            src_future = executor.submit(self.__get_meta_data, self.client_src, keys, collection)
+            dest_keys_meta = self.__get_meta_data(self.client_dest, keys, collection=collection)
+            src_keys_meta = src_future.result()
+        if src_keys_meta is None or dest_keys_meta is None:
             return
+        for key in keys:
+            src_meta_data = self.__key_meta_data(self.client_src, key, src_keys_meta, collection=collection)
+            dest_meta_data = self.__key_meta_data(self.client_dest, key, dest_keys_meta, collection=collection)
+            if src_meta_data and dest_meta_data:
+                self._check_key_revId(key, src_meta_data, dest_meta_data, ignore_meta_data)
+
+    def _check_key_revId(self, key, src_meta_data, dest_meta_data, ignore_meta_data=[]):
         prev_error_count = self.err_count
         err_msg = []
         # seqno number should never be zero
@@ -2127,16 +2408,19 @@ class VerifyRevIdTask(GenericLoadingTask):
             self.state = FINISHED
 
 class VerifyMetaDataTask(GenericLoadingTask):
-    def __init__(self, dest_server, bucket, kv_store, meta_data_store, max_err_count=100, compression=True, collection=None):
+    def __init__(self, dest_server, bucket, kv_store, meta_data_store, max_err_count=100, compression=True, collection=None,
+                 batch_size=META_DATA_BATCH_SIZE):
         GenericLoadingTask.__init__(self, dest_server, bucket, kv_store, compression=compression, collection=collection)
         from memcached.helper.data_helper import VBucketAwareMemcached as SmartClient
         self.collections=collection
         self.client = SmartClient(RestConnection(dest_server), bucket)
         self.valid_keys, self.deleted_keys = kv_store.key_set(bucket=self.bucket, collection=self.collection)
+        self.deleted_set = set(self.deleted_keys)
         self.num_valid_keys = len(self.valid_keys)
         self.num_deleted_keys = len(self.deleted_keys)
         self.keys_not_found = {self.client.rest.ip: [], self.client.rest.ip: []}
         self.itr = 0
+        self.batch_size = batch_size
         self.err_count = 0
         self.max_err_count = max_err_count
         self.meta_data_store = meta_data_store
@@ -2152,35 +2436,44 @@ class VerifyMetaDataTask(GenericLoadingTask):
         return False
 
     def __next__(self):
+        prev_itr = self.itr
         if self.itr < self.num_valid_keys:
-            self._check_key_meta_data(self.valid_keys[self.itr], self.collections)
-        elif self.itr < (self.num_valid_keys + self.num_deleted_keys):
+            keys = self.valid_keys[self.itr:min(self.itr + self.batch_size, self.num_valid_keys)]
+            self._check_keys_meta_data(keys, collection=self.collections)
+        else:
             # verify deleted/expired keys
-            self._check_key_meta_data(self.deleted_keys[self.itr - self.num_valid_keys],
-                                  ignore_meta_data=['expiration'], collection=self.collections)
-        self.itr += 1
+            start = self.itr - self.num_valid_keys
+            keys = self.deleted_keys[start:start + self.batch_size]
+            self._check_keys_meta_data(keys, ignore_meta_data=['expiration'], collection=self.collections)
+        self.itr += len(keys)
 
         # show progress of verification for every 50k items
-        if math.fmod(self.itr, 50000) == 0.0:
+        if self.itr // 50000 > prev_itr // 50000:
             self.log.info("{0} items have been verified".format(self.itr))
 
-    def __get_meta_data(self, client, key, collection=None):
+    def __get_meta_data(self, client, keys, collection=None):
         try:
-            mc = client.memcached(key)
-            meta_data = eval("{'deleted': %s, 'flags': %s, 'expiration': %s, 'seqno': %s, 'cas': %s}" % (mc.getMeta(key, collection=collection)))
-            return meta_data
+            keys_meta = client.getMetaMulti(keys, collection=collection)
         except MemcachedError as error:
-            if error.status == ERR_NOT_FOUND:
-                if key not in self.deleted_keys:
-                    self.err_count += 1
-                    self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key)))
-            else:
-                self.state = FINISHED
-                self.set_exception(error)
+            self.state = FINISHED
+            self.set_exception(error)
+            return None
+        for key in keys:
+            if key not in keys_meta and key not in self.deleted_set:
+                self.err_count += 1
+                self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key)))
+        return keys_meta
+
+    def _check_keys_meta_data(self, keys, ignore_meta_data=[], collection=None):
+        keys_meta = self.__get_meta_data(self.client, keys, collection=collection)
+        if keys_meta is None:
+            return
+        for key in keys:
+            if key in keys_meta:
+                self._check_key_meta_data(key, dict(zip(META_DATA_FIELDS, keys_meta[key])), ignore_meta_data)
 
-    def _check_key_meta_data(self, key, ignore_meta_data=[], collection=None):
+    def _check_key_meta_data(self, key, dest_meta_data, ignore_meta_data=[]):
         src_meta_data = self.meta_data_store[key]
-        dest_meta_data = self.__get_meta_data(self.client, key, collection=collection)
         if not src_meta_data or not dest_meta_data:
             return
         prev_error_count = self.err_count
@@ -2207,16 +2500,19 @@ class VerifyMetaDataTask(GenericLoadingTask):
             self.state = FINISHED
 
 class GetMetaDataTask(GenericLoadingTask):
-    def __init__(self, dest_server, bucket, kv_store, compression=True, collection=None):
+    def __init__(self, dest_server, bucket, kv_store, compression=True, collection=None,
+                 batch_size=META_DATA_BATCH_SIZE):
         GenericLoadingTask.__init__(self, dest_server, bucket, kv_store, compression=compression, collection=collection)
         from memcached.helper.data_helper import VBucketAwareMemcached as SmartClient
         self.collection=collection
         self.client = SmartClient(RestConnection(dest_server), bucket)
         self.valid_keys, self.deleted_keys = kv_store.key_set(bucket=self.bucket, collection=self.collection)
+        self.deleted_set = set(self.deleted_keys)
         self.num_valid_keys = len(self.valid_keys)
         self.num_deleted_keys = len(self.deleted_keys)
         self.keys_not_found = {self.client.rest.ip: [], self.client.rest.ip: []}
         self.itr = 0
+        self.batch_size = batch_size
         self.err_count = 0
         self.max_err_count = 100
         self.meta_data_store = {}
@@ -2233,24 +2529,31 @@ class GetMetaDataTask(GenericLoadingTask):
 
     def __next__(self):
         if self.itr < self.num_valid_keys:
-            self.meta_data_store[self.valid_keys[self.itr]] = self.__get_meta_data(self.client, self.valid_keys[self.itr], self.collection)
-        elif self.itr < (self.num_valid_keys + self.num_deleted_keys):
-            self.meta_data_store[self.deleted_keys[self.itr - self.num_valid_keys]] = self.__get_meta_data(self.client, self.deleted_keys[self.itr - self.num_valid_keys], collection=self.collection)
-        self.itr += 1
+            keys = self.valid_keys[self.itr:min(self.itr + self.batch_size, self.num_valid_keys)]
+        else:
+            start = self.itr - self.num_valid_keys
+            keys = self.deleted_keys[start:start + self.batch_size]
+        self.meta_data_store.update(self.__get_meta_data(self.client, keys, collection=self.collection))
+        self.itr += len(keys)
 
-    def __get_meta_data(self, client, key, collection=None):
+    def __get_meta_data(self, client, keys, collection=None):
+        """ returns the metadata dict of every key, None for the keys not found """
         try:
-            mc = client.memcached(key)
-            meta_data = eval("{'deleted': %s, 'flags': %s, 'expiration': %s, 'seqno': %s, 'cas': %s}" % (mc.getMeta(key, collection=collection)))
-            return meta_data
+            keys_meta = client.getMetaMulti(keys, collection=collection)
         except MemcachedError as error:
-            if error.status == ERR_NOT_FOUND:
-                if key not in self.deleted_keys:
+            self.state = FINISHED
+            self.set_exception(error)
+            return {}
+        meta_data = {}
+        for key in keys:
+            if key in keys_meta:
+                meta_data[key] = dict(zip(META_DATA_FIELDS, keys_meta[key]))
+            else:
+                meta_data[key] = None
+                if key not in self.deleted_set:
                     self.err_count += 1
                     self.keys_not_found[client.rest.ip].append(("key: %s" % key, "vbucket: %s" % client._get_vBucket_id(key)))
-            else:
-                self.state = FINISHED
-                self.set_exception(error)
+        return meta_data
 
     def get_meta_data_store(self):
         return self.meta_data_store
@@ -3564,6 +3867,8 @@ class GenerateExpectedViewResultsTask(Task):
                          (not 'reduce' in query))
         self.custom_red_fn = self.is_reduced and not self.view.red_func in ['_count', '_sum', '_stats']
         self.type_filter = None
+        self.with_values = False
+        self.rows = None
 
 
     def execute(self, task_manager):
@@ -3599,35 +3904,17 @@ class GenerateExpectedViewResultsTask(Task):
             emit_value = re.sub(r'\);.*', '', re.sub(r'.*emit\([ +]?\[*],[ +]?doc\.', '', self.view.map_func))
             if self.view.map_func.count("[") <= 1:
                 emit_value = re.sub(r'\);.*', '', re.sub(r'.*emit\([ +]?.*,[ +]?doc\.', '', self.view.map_func))
-        for doc_gen in self.doc_generators:
-
-            query_doc_gen = copy.deepcopy(doc_gen)
-            while query_doc_gen.has_next():
-
-                _id, val = next(query_doc_gen)
-                val = json.loads(val)
-
-                if isinstance(emit_key, list):
-                    val_emit_key = []
-                    for ek in emit_key:
-                        val_emit_key.append(val[ek])
-                else:
-                    val_emit_key = val[emit_key]
-                if self.type_filter:
-                    filter_expr = r'\A{0}.*'.format(self.type_filter["filter_expr"])
-                    if re.match(filter_expr, val[self.type_filter["filter_what"]]) is None:
-                        continue
-                if isinstance(val_emit_key, str):
-                    val_emit_key = val_emit_key.encode('utf-8')
-                if not self.is_reduced or self.view.red_func == "_count" or self.custom_red_fn:
-                    self.emitted_rows.append({'id' : _id, 'key' : val_emit_key})
-                else:
-                    val_emit_value = val[emit_value]
-                    self.emitted_rows.append({'value': val_emit_value, 'key': val_emit_key, 'id': _id, })
+        self.with_values = self.is_reduced and self.view.red_func != "_count" and not self.custom_red_fn
+        # rows sorted by (key, id), shared with other queries on the same view and docs
+        self.rows = view_results.emitted_rows(self.doc_generators, emit_key,
+                                              emit_value if self.with_values else None,
+                                              self.type_filter)
 
     def filter_emitted_rows(self):
 
         query = self.query
+        rows = self.rows
+        keys, ids = rows.keys, rows.ids
 
         # parse query flags
         descending_set = 'descending' in query and query['descending'] == "true"
@@ -3636,12 +3923,13 @@ class GenerateExpectedViewResultsTask(Task):
         inclusive_end_false = 'inclusive_end' in query and query['inclusive_end'] == "false"
         key_set = 'key' in query
 
+        if len(rows) == 0:
+            self.emitted_rows = []
+            return
 
-        # sort expected results to match view results
-        #self.log.info("-->emitted_rows={}".format(self.emitted_rows))
-        expected_rows = sorted(self.emitted_rows, key=(lambda x: (x['key'],x['id'])),reverse=descending_set)
-                               #cmp=GenerateExpectedViewResultsTask.cmp_result_rows,
-                               #reverse=descending_set)
+        # rows are selected by their index in the sorted columns, the
+        # selection stays a range as long as only key ranges are applied
+        selection = range(len(rows))
 
         # filter rows according to query flags
         if startkey_set:
@@ -3651,10 +3939,10 @@ class GenerateExpectedViewResultsTask(Task):
             if isinstance(start_key, str) and start_key.find('[') == 0:
                 start_key = start_key[1:-1].split(',')
                 start_key = [int(x) if x != 'null' else 0 for x in start_key]
+            if isinstance(start_key, str):
+                start_key = start_key.strip("\"")
         else:
-            start_key = expected_rows[0]['key']
-            if isinstance(start_key, str) and start_key.find('"') == 0:
-                start_key = start_key[1:-1]
+            start_key = keys[-1] if descending_set else keys[0]
         if endkey_set:
             end_key = query['endkey']
             if isinstance(end_key, str) and end_key.find('"') == 0:
@@ -3662,21 +3950,18 @@ class GenerateExpectedViewResultsTask(Task):
             if isinstance(end_key, str) and end_key.find('[') == 0:
                 end_key = end_key[1:-1].split(',')
                 end_key = [int(x) if x != 'null' else None for x in end_key]
+            if isinstance(end_key, str):
+                end_key = end_key.strip("\"")
         else:
-            end_key = expected_rows[-1]['key']
-            if isinstance(end_key, str) and end_key.find('"') == 0:
-                end_key = end_key[1:-1]
+            end_key = keys[0] if descending_set else keys[-1]
 
         if descending_set:
             start_key, end_key = end_key, start_key
 
         if startkey_set or endkey_set:
-            if isinstance(start_key, str):
-                start_key = start_key.strip("\"")
-            if isinstance(end_key, str):
-                end_key = end_key.strip("\"")
-            #self.log.info("-->start_key={},end_key={},expected_rows:{}".format(start_key,end_key,expected_rows))
-            expected_rows = [row for row in expected_rows if row['key'] >= start_key and row['key'] <= end_key]
+            lo = bisect.bisect_left(keys, start_key)
+            hi = bisect.bisect_right(keys, end_key)
+            selection = range(lo, max(lo, hi))
 
         if key_set:
             key_ = query['key']
@@ -3684,7 +3969,13 @@ class GenerateExpectedViewResultsTask(Task):
                 key_ = key_[1:-1].split(',')
                 key_ = [int(x) if x != 'null' else None for x in key_]
             start_key, end_key = key_, key_
-            expected_rows = [row for row in expected_rows if row['key'] == key_]
+            try:
+                lo = bisect.bisect_left(keys, key_, selection.start, selection.stop)
+                hi = bisect.bisect_right(keys, key_, lo, selection.stop)
+                selection = range(lo, hi)
+            except TypeError:
+                # key_ can not be ordered against the emitted keys
+                selection = [i for i in selection if keys[i] == key_]
 
 
         if descending_set:
@@ -3704,8 +3995,8 @@ class GenerateExpectedViewResultsTask(Task):
                     do_filter = True
 
                 if do_filter:
-                    expected_rows = \
-                        [row for row in expected_rows if row['id'] >= startkey_docid or row['key'] > start_key]
+                    selection = \
+                        [i for i in selection if ids[i] >= startkey_docid or keys[i] > start_key]
 
         if endkey_docid_set:
             if not endkey_set:
@@ -3721,36 +4012,37 @@ class GenerateExpectedViewResultsTask(Task):
                     do_filter = True
 
                 if do_filter:
-                    expected_rows = \
-                        [row for row in expected_rows if row['id'] <= endkey_docid or row['key'] < end_key]
+                    selection = \
+                        [i for i in selection if ids[i] <= endkey_docid or keys[i] < end_key]
 
 
         if inclusive_end_false:
             if endkey_set and endkey_docid_set:
                 # remove all keys that match endkey
-                expected_rows = [row for row in expected_rows if row['id'] < query['endkey_docid']  or row['key'] < end_key]
+                selection = [i for i in selection if ids[i] < query['endkey_docid'] or keys[i] < end_key]
             elif endkey_set:
-                expected_rows = [row for row in expected_rows if row['key'] != end_key]
+                selection = [i for i in selection if keys[i] != end_key]
+
+        if descending_set:
+            selection = selection[::-1]
 
+        expected_rows = None
         if self.is_reduced:
             groups = {}
             gr_level = None
             if not 'group' in query and\
                not 'group_level' in query:
-               if len(expected_rows) == 0:
-                   expected_rows = []
-                   self.emitted_rows = expected_rows
+               if len(selection) == 0:
+                   self.emitted_rows = []
                    return
                if self.view.red_func == '_count':
-                   groups[None] = len(expected_rows)
+                   groups[None] = len(selection)
                elif self.view.red_func == '_sum':
-                   groups[None] = 0
-                   groups[None] = math.fsum([row['value']
-                                               for row in expected_rows])
+                   groups[None] = math.fsum(rows.column(rows.values, selection))
                elif self.view.red_func == '_stats':
                    groups[None] = {}
-                   values = [row['value'] for row in expected_rows]
-                   groups[None]['count'] = len(expected_rows)
+                   values = rows.column(rows.values, selection)
+                   groups[None]['count'] = len(values)
                    groups[None]['sum'] = math.fsum(values)
                    groups[None]['max'] = max(values)
                    groups[None]['min'] = min(values)
@@ -3758,55 +4050,69 @@ class GenerateExpectedViewResultsTask(Task):
                elif self.custom_red_fn:
                    custom_action = re.sub(r'.*return[ +]', '', re.sub(r'.*return[ +]', '', self.view.red_func))
                    if custom_action.find('String') != -1:
-                       groups[None] = str(len(expected_rows))
+                       groups[None] = str(len(selection))
                    elif custom_action.find('-') != -1:
-                       groups[None] = -len(expected_rows)
+                       groups[None] = -len(selection)
             elif 'group' in query and query['group'] == 'true':
                 if not 'group_level' in query:
-                    gr_level = len(expected_rows) - 1
+                    gr_level = len(selection) - 1
             elif 'group_level' in query:
                 gr_level = int(query['group_level'])
             if gr_level is not None:
-                for row in expected_rows:
-                    key = str(row['key'][:gr_level])
+                values = rows.values
+                for i in selection:
+                    key = str(rows.row_key(i)[:gr_level])
                     if not key in groups:
                         if self.view.red_func == '_count':
                             groups[key] = 1
                         elif self.view.red_func == '_sum':
-                            groups[key] = row['value']
+                            groups[key] = values[i]
                         elif self.view.red_func == '_stats':
                             groups[key] = {}
                             groups[key]['count'] = 1
-                            groups[key]['sum'] = row['value']
-                            groups[key]['max'] = row['value']
-                            groups[key]['min'] = row['value']
-                            groups[key]['sumsqr'] = row['value'] ** 2
+                            groups[key]['sum'] = values[i]
+                            groups[key]['max'] = values[i]
+                            groups[key]['min'] = values[i]
+                            groups[key]['sumsqr'] = values[i] ** 2
                     else:
                         if self.view.red_func == '_count':
                            groups[key] += 1
                         elif self.view.red_func == '_sum':
-                            groups[key] += row['value']
+                            groups[key] += values[i]
                         elif self.view.red_func == '_stats':
                             groups[key]['count'] += 1
-                            groups[key]['sum'] += row['value']
-                            groups[key]['max'] = max(row['value'], groups[key]['max'])
-                            groups[key]['min'] = min(row['value'], groups[key]['min'])
-                            groups[key]['sumsqr'] += row['value'] ** 2
+                            groups[key]['sum'] += values[i]
+                            groups[key]['max'] = max(values[i], groups[key]['max'])
+                            groups[key]['min'] = min(values[i], groups[key]['min'])
+                            groups[key]['sumsqr'] += values[i] ** 2
             expected_rows = []
-            is_reduce_group=False
             for group, value in groups.items():
                 if isinstance(group, str) and group.find("[") == 0:
                     group = group[1:-1].split(",")
                     group = [int(k) for k in group]
                 expected_rows.append({"key" : group, "value" : value})
-                is_reduce_group=True
-            if not is_reduce_group: #sort only when not reduced to group
-                expected_rows = sorted(self.emitted_rows, key=(lambda x: (x['key'],x['id'])),reverse=descending_set)
-
-        if 'skip' in query:
-            expected_rows = expected_rows[(int(query['skip'])):]
-        if 'limit' in query:
-            expected_rows = expected_rows[:(int(query['limit']))]
+            if not expected_rows: #sort only when not reduced to group
+                expected_rows = None
+                selection = range(len(rows))
+                if descending_set:
+                    selection = selection[::-1]
+
+        if expected_rows is None:
+            # only build the rows that are left after skip and limit
+            if 'skip' in query:
+                selection = selection[(int(query['skip'])):]
+            if 'limit' in query:
+                selection = selection[:(int(query['limit']))]
+            if self.with_values:
+                expected_rows = [{'value': rows.values[i], 'key': rows.row_key(i), 'id': ids[i]}
+                                 for i in selection]
+            else:
+                expected_rows = [{'id': ids[i], 'key': rows.row_key(i)} for i in selection]
+        else:
+            if 'skip' in query:
+                expected_rows = expected_rows[(int(query['skip'])):]
+            if 'limit' in query:
+                expected_rows = expected_rows[:(int(query['limit']))]
 
         self.emitted_rows = expected_rows
 
@@ -1,51 +1,129 @@
 import time
-import queue
+import heapq
+import itertools
+import collections
 
-from threading import Thread
+from threading import Thread, Condition
 from tasks.task import Task
 
 class TaskManager(Thread):
-    def __init__(self, thread_name=None):
+    """Runs scheduled tasks by stepping them through Task.step()
+
+    Ready tasks are kept in a FIFO and sleeping tasks in a heap ordered by
+    wakeup time. The scheduler thread waits on a condition variable, so it
+    wakes up as soon as a task is scheduled and otherwise sleeps exactly
+    until the next wakeup time.
+
+    With num_workers > 1 the manager also starts num_workers - 1 helper
+    threads which step ready tasks concurrently. A task is only ever queued
+    once, so its own steps never overlap, but tasks scheduled on the same
+    manager may run at the same time.
+    """
+
+    def __init__(self, thread_name=None, num_workers=1):
         Thread.__init__(self)
-        self.readyq = queue.Queue()
-        self.sleepq = queue.Queue()
         self.running = True
+        self.num_workers = max(1, num_workers)
+        self._cond = Condition()
+        self._readyq = collections.deque()
+        self._sleepq = []
+        self._seq = itertools.count()
+        self._workers = []
+        self._busy = 0
+        self._steps = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._step_time_total = 0.0
         if thread_name is not None:
             self.name = thread_name
 
     def schedule(self, task, sleep_time=0):
         if not isinstance(task, Task):
             raise TypeError("Tried to schedule somthing that's not a task")
-        if sleep_time <= 0:
-            self.readyq.put(task)
-        else:
-            wakeup_time = time.time() + sleep_time
-            self.sleepq.put({'task': task, 'time': wakeup_time})
+        now = time.time()
+        with self._cond:
+            if sleep_time <= 0:
+                self._readyq.append((now, task))
+            else:
+                heapq.heappush(self._sleepq, (now + sleep_time, next(self._seq), task))
+            self._cond.notify()
 
     def run(self):
-        while (self.running == True or self.readyq.empty() != True or self.sleepq.empty() != True):
-            if self.readyq.empty():
-                time.sleep(1)
-            else:
-                task = self.readyq.get()
-                task.step(self)
-            for i in range(self.sleepq.qsize()):
-                s_task = self.sleepq.get()
-                if time.time() >= s_task['time']:
-                    self.readyq.put(s_task['task'])
+        for i in range(1, self.num_workers):
+            worker = Thread(target=self._work, name="{0}_worker_{1}".format(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._work()
+        for worker in self._workers:
+            worker.join()
+
+    def _next_task(self):
+        """Blocks until a task is due and returns it with its due time
+
+        Returns (None, None) once the manager is shut down and there is no
+        work left."""
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._sleepq and self._sleepq[0][0] <= now:
+                    wakeup_time, _, task = heapq.heappop(self._sleepq)
+                    self._readyq.append((wakeup_time, task))
+                if self._readyq:
+                    self._busy += 1
+                    return self._readyq.popleft()
+                if not self.running and not self._sleepq and not self._busy:
+                    # wake up the other workers so they can exit as well
+                    self._cond.notify_all()
+                    return None, None
+                if self._sleepq:
+                    self._cond.wait(self._sleepq[0][0] - now)
                 else:
-                    self.sleepq.put(s_task)
+                    self._cond.wait()
+
+    def _work(self):
+        while True:
+            due_time, task = self._next_task()
+            if task is None:
+                return
+            start = time.time()
+            try:
+                task.step(self)
+            finally:
+                end = time.time()
+                with self._cond:
+                    self._busy -= 1
+                    self._steps += 1
+                    latency = max(0.0, start - due_time)
+                    self._latency_total += latency
+                    self._latency_max = max(self._latency_max, latency)
+                    self._step_time_total += end - start
+                    self._cond.notify_all()
+
+    def stats(self):
+        """Returns queue depths and task latency counters
+
+        latency is the time between a task becoming due and its step
+        starting to run."""
+        with self._cond:
+            steps = self._steps
+            return {"ready": len(self._readyq),
+                    "sleeping": len(self._sleepq),
+                    "running": self._busy,
+                    "steps": steps,
+                    "avg_latency": self._latency_total / steps if steps else 0.0,
+                    "max_latency": self._latency_max,
+                    "avg_step_time": self._step_time_total / steps if steps else 0.0}
 
     def shutdown(self, force=False):
-        self.running = False
+        with self._cond:
+            self.running = False
+            if force:
+                tasks = [task for _, _, task in self._sleepq]
+                tasks.extend(task for _, task in self._readyq)
+                self._sleepq = []
+                self._readyq.clear()
+            self._cond.notify_all()
         if force:
-            while not self.sleepq.empty():
-                task = self.sleepq.get()['task']
+            for task in tasks:
                 task.cancel()
-                self.readyq.put(task)
-            while not self.readyq.empty():
-                try:
-                    task = self.readyq.get()
-                    task.cancel()
-                except Exception as ex:
-                    raise ex
\ No newline at end of file
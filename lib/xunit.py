@@ -63,6 +63,17 @@ class XUnitTestResult(object):
             suite.add_test(name, time, errorType, errorMessage, status, params=params)
             self.suites.append(suite)
 
+    # add all the tests of another XUnitTestResult, e.g. the one of a
+    # parallel testrunner worker, to this one
+    def merge(self, other):
+        for suite in other.suites:
+            for test in suite.tests:
+                if test.error:
+                    self.add_test(test.name, test.time, test.error.type,
+                                  test.error.message, status='fail', params=test.params)
+                else:
+                    self.add_test(test.name, test.time, params=test.params)
+
     def to_xml(self, suite):
         doc = xml.dom.minidom.Document()
         testsuite = doc.createElement('testsuite')
@@ -7,6 +7,7 @@ from lib.remote.remote_util import RemoteMachineShellConnection
 from .newtuq import QueryTests
 from couchbase_helper.cluster import Cluster
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_compare import compare_results
 from couchbase_helper.query_definitions import SQLDefinitionGenerator
 from membase.api.rest_client import RestConnection
 from deepdiff import DeepDiff
@@ -575,15 +576,7 @@ class BaseSecondaryIndexingTests(QueryTests):
         return scan_vectors
 
     def check_missing_and_extra(self, actual, expected):
-        missing = []
-        extra = []
-        for item in actual:
-            if not (item in expected):
-                 extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return compare_results(actual, expected, limit=None)
 
     def _verify_results(self, actual_result, expected_result, missing_count = 1, extra_count = 1):
         actual_result = self._gen_dict(actual_result)
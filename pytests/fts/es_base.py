@@ -1,6 +1,7 @@
 import httplib2
 import json
 from tasks.taskmanager import TaskManager
+from membase.api.http_pool import POOL as HTTP_POOL
 from tasks.task import *
 from remote.remote_util import RemoteMachineShellConnection, RemoteUtilHelper
 import time
@@ -193,10 +194,8 @@ class ElasticSearchBase(object):
             headers = {'Content-Type': 'application/json',
                        'Accept': '*/*'}
         try:
-            response, content = httplib2.Http(timeout=timeout).request(api,
-                                                                       method,
-                                                                       params,
-                                                                       headers)
+            response, content = HTTP_POOL.request(api, method, params, headers,
+                                                  timeout=timeout)
             if response['status'] in ['200', '201', '202']:
                 return True, content, response
             else:
@@ -433,16 +432,36 @@ class ElasticSearchBase(object):
         { "field1" : "value1" , "field2" : "value2"}
         """
         try:
-            import os
-            url = self.__connection_url + "/_bulk"
             data = open(filename, "rb").read()
-            status, content, _ = self._http_request(url,
-                                                    'POST',
-                                                    data)
+            status, _ = self.load_bulk_body(data)
             return status
         except Exception as e:
             raise e
 
+    def load_bulk_body(self, body):
+        """
+        Bulk load to ES from an in-memory NDJSON body, see load_bulk_data
+        :return: request status and the failed items of the bulk response,
+                 as (operation, _id, status, error) tuples
+        """
+        url = self.__connection_url + "/_bulk"
+        status, content, _ = self._http_request(
+            url,
+            'POST',
+            body,
+            headers={'Content-Type': 'application/x-ndjson',
+                     'Accept': '*/*'})
+        errors = []
+        if status:
+            result = json.loads(content)
+            if result.get('errors'):
+                for item in result['items']:
+                    for op, info in item.items():
+                        if 'error' in info:
+                            errors.append((op, info.get('_id'), info.get('status'),
+                                           info['error']))
+        return status, errors
+
     def load_data(self, index_name, document_json, doc_type, doc_id):
         """
         index_name : name of index into which the doc is loaded
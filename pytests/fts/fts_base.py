@@ -2657,6 +2657,19 @@ class CouchbaseCluster:
                                                             n1ql_executor=n1ql_executor)
         return task
 
+    def run_fts_queries_compare(self, fts_index, es, query_indexes, es_index_name=None,
+                                n1ql_executor=None, concurrency=1):
+        """
+        Runs the queries against FTS and ES, concurrency queries at a time,
+        and compares the results. Returns the finished tasks
+        """
+        return self.__clusterop.run_fts_queries_compare(fts_index=fts_index,
+                                                        es_instance=es,
+                                                        query_indexes=query_indexes,
+                                                        es_index_name=es_index_name,
+                                                        n1ql_executor=n1ql_executor,
+                                                        concurrency=concurrency)
+
     def run_expiry_pager(self, val=10):
         """Run expiry pager process and set interval to 10 seconds
         and wait for 10 seconds.
@@ -4209,13 +4222,23 @@ class FTSBaseTest(unittest.TestCase):
         tasks = []
         fail_count = 0
         failed_queries = []
-        for count in range(0, len(index.fts_queries)):
-            tasks.append(self._cb_cluster.async_run_fts_query_compare(
+        concurrency = self._input.param("query_concurrency", 1)
+        if concurrency > 1:
+            tasks = self._cb_cluster.run_fts_queries_compare(
                 fts_index=index,
                 es=self.es,
+                query_indexes=list(range(0, len(index.fts_queries))),
                 es_index_name=es_index_name,
-                query_index=count,
-                n1ql_executor=n1ql_executor))
+                n1ql_executor=n1ql_executor,
+                concurrency=concurrency)
+        else:
+            for count in range(0, len(index.fts_queries)):
+                tasks.append(self._cb_cluster.async_run_fts_query_compare(
+                    fts_index=index,
+                    es=self.es,
+                    es_index_name=es_index_name,
+                    query_index=count,
+                    n1ql_executor=n1ql_executor))
 
         num_queries = len(tasks)
 
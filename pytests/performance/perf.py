@@ -652,7 +652,8 @@ class PerfBase(unittest.TestCase):
         bucket = self.param("bucket", "default")
         sc.start(servers, bucket, process_names, stats_spec, client_id,
                  collect_server_stats=collect_server_stats, ddoc=ddoc,
-                 clusters=clusters)
+                 clusters=clusters,
+                 remote_sampler=self.parami("stats_remote_sampler", 1) == 1)
         test_params['testrunner'] = self._get_src_version()
         self.test_params = test_params
         self.sc = sc
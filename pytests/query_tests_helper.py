@@ -37,10 +37,12 @@ class QueryHelperTests(BaseTestCase):
         self.expiry_ops_per = self.input.param("expiry_ops_per", 0)
         self.delete_ops_per = self.input.param("delete_ops_per", 0)
         self.update_ops_per = self.input.param("update_ops_per", 0)
+        self.cache_expected_results = self.input.param("cache_expected_results", False)
         self.gens_load = self.generate_docs(self.docs_per_day)
         self.full_docs_list = self.generate_full_docs_list(self.gens_load)
         self.gen_results = TuqGenerators(self.log,
-                                         full_set=self.full_docs_list)
+                                         full_set=self.full_docs_list,
+                                         cache_results=self.cache_expected_results)
         if not self.skip_init_check_cbserver:   # for upgrade tests
             self.n1ql_server = self.get_nodes_from_services_map(
                 service_type="n1ql")
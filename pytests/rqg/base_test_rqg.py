@@ -18,6 +18,7 @@ from os import listdir
 from os.path import isfile, join
 import traceback
 from .rqg_postgres_client import RQGPostgresClient
+from .rqg_sql_pool import RQGClientPool, SQLResultCache
 
 class BaseRQGTests(BaseTestCase):
     def setUp(self):
@@ -25,6 +26,10 @@ class BaseRQGTests(BaseTestCase):
             super(BaseRQGTests, self).setUp()
             self.log.info("==============  RQG Setup Has Started ==============")
             self.client_map = {}
+            self.sql_client_pool = RQGClientPool(self._new_sql_client)
+            self.sql_result_cache = None
+            if self.input.param("sql_result_cache", True):
+                self.sql_result_cache = SQLResultCache()
             self.check_covering_index = self.input.param("check_covering_index", True)
             self.skip_setup_cleanup = True
             self.crud_ops = self.input.param("crud_ops", False)
@@ -122,6 +127,8 @@ class BaseRQGTests(BaseTestCase):
             super(BaseRQGTests, self).tearDown()
             self.log.info("==============  RQG BasTestCase Teardown Has Completed ==============")
             self.log.info("==============  RQG Teardown Has Started ==============")
+            if hasattr(self, 'sql_client_pool'):
+                self.sql_client_pool.close()
             if hasattr(self, 'reset_database'):
                 if self.teardown_mysql:
                     client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
@@ -544,15 +551,17 @@ class BaseRQGTests(BaseTestCase):
         self.log.info("N1QL :: {0}".format(n1ql_query))
 
         crud_ops_run_result = None
-        client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
+        client = self.sql_client_pool.get()
         try:
             self.n1ql_helper.run_cbq_query(n1ql_query, self.n1ql_server)
             client._insert_execute_query(query=sql_query)
+            self.sql_client_pool.put(client)
         except Exception as ex:
             self.log.info(ex)
             crud_ops_run_result = {"success": False, "result": str(ex)}
-            client._close_connection()
-        client._close_connection()
+            self.sql_client_pool.put(client, discard=True)
+        if self.sql_result_cache is not None:
+            self.sql_result_cache.invalidate()
         if crud_ops_run_result is None:
             query_index_run = self._run_queries_and_verify_crud(n1ql_query=verification_query, sql_query=verification_query, expected_result=None, table_name=table_name)
         else:
@@ -610,28 +619,17 @@ class BaseRQGTests(BaseTestCase):
             for keyword in list(failure_reason_map.keys()):
                 summary += keyword+" :: " + str((failure_reason_map[keyword]*100)/total)+"%\n "
         self.log.info(" Total Queries Run = {0}, Pass = {1}, Fail = {2}, Pass Percentage = {3} %".format(total, pass_case, fail_case, ((pass_case*100)/total)))
+        if self.sql_result_cache is not None:
+            summary += "\n " + self.sql_result_cache.summary()
+            self.log.info(self.sql_result_cache.summary())
         result = self._generate_result(failure_map)
         return success, summary, result
 
     def _gen_expected_result(self, sql="", test=49):
         sql_result = []
         try:
-            client = None
-            if self.use_mysql:
-                client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
-            elif self.use_postgres:
-                client = RQGPostgresClient()
-
-            if test == 51:
-                columns = []
-                rows = []
-            else:
-                columns, rows = client._execute_query(query=sql)
-            if self.aggregate_pushdown:
-                sql_result = client._gen_json_from_results_repeated_columns(columns, rows)
-            else:
-                sql_result = client._gen_json_from_results(columns, rows)
-            client._close_connection()
+            if test != 51:
+                sql_result = self._run_sql_query(sql, repeated_columns=bool(self.aggregate_pushdown))
         except Exception as ex:
             self.log.info(ex)
             traceback.print_exc()
@@ -666,19 +664,8 @@ class BaseRQGTests(BaseTestCase):
 
             # Run SQL Query
             sql_result = expected_result
-            client = None
-            if self.use_mysql:
-                client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
-            elif self.use_postgres:
-                client = RQGPostgresClient()
-
             if expected_result is None:
-                columns, rows = client._execute_query(query=sql_query)
-                if self.aggregate_pushdown:
-                    sql_result = client._gen_json_from_results_repeated_columns(columns, rows)
-                else:
-                    sql_result = client._gen_json_from_results(columns, rows)
-            client._close_connection()
+                sql_result = self._run_sql_query(sql_query, repeated_columns=bool(self.aggregate_pushdown))
             self.log.info(" result from n1ql query returns {0} items".format(len(n1ql_result)))
             self.log.info(" result from sql query returns {0} items".format(len(sql_result)))
 
@@ -702,6 +689,41 @@ class BaseRQGTests(BaseTestCase):
             traceback.print_exc()
             return {"success": False, "result": str(ex)}
 
+    def _new_sql_client(self):
+        if self.use_mysql:
+            client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
+            # pooled connections are reused, a read must not keep the
+            # snapshot of an open transaction alive until the next query
+            client.mysql_connector_client.autocommit = True
+            return client
+        elif self.use_postgres:
+            return RQGPostgresClient()
+        return None
+
+    def _run_sql_query(self, sql_query, repeated_columns=False):
+        """Runs sql_query on a pooled client and returns its rows as json,
+        results are cached until the crud workers change the tables"""
+        cache = self.sql_result_cache
+        if cache is not None:
+            sql_result = cache.get(sql_query, repeated_columns)
+            if sql_result is not None:
+                return sql_result
+            version = cache.version
+        client = self.sql_client_pool.get()
+        try:
+            columns, rows = client._execute_query(query=sql_query)
+            if repeated_columns:
+                sql_result = client._gen_json_from_results_repeated_columns(columns, rows)
+            else:
+                sql_result = client._gen_json_from_results(columns, rows)
+        except Exception:
+            self.sql_client_pool.put(client, discard=True)
+            raise
+        self.sql_client_pool.put(client)
+        if cache is not None:
+            cache.put(sql_query, version, sql_result, repeated_columns)
+        return sql_result
+
     def _run_queries_and_verify_crud(self, n1ql_query=None, sql_query=None, expected_result=None, table_name=None):
         self.log.info(" SQL QUERY :: {0}".format(sql_query))
         self.log.info(" N1QL QUERY :: {0}".format(n1ql_query))
@@ -717,11 +739,8 @@ class BaseRQGTests(BaseTestCase):
             n1ql_result = actual_result["results"]
             # Run SQL Query
             sql_result = expected_result
-            client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
             if expected_result is None:
-                columns, rows = client._execute_query(query=sql_query)
-                sql_result = client._gen_json_from_results(columns, rows)
-            client._close_connection()
+                sql_result = self._run_sql_query(sql_query)
             self.log.info(" result from n1ql query returns {0} items".format(len(n1ql_result)))
             self.log.info(" result from sql query returns {0} items".format(len(sql_result)))
 
@@ -2,8 +2,6 @@ from .base_test_rqg import BaseRQGTests
 from .new_rqg_mysql_client import RQGMySQLClientNew
 from .new_rqg_query_helper import RQGQueryHelperNew
 import threading
-from .rqg_mysql_client import RQGMySQLClient
-from .rqg_postgres_client import RQGPostgresClient
 import traceback
 from deepdiff import DeepDiff
 
@@ -290,20 +288,8 @@ class RQGTestsNew(BaseRQGTests):
 
             # Run SQL Query
             sql_result = expected_result
-
-            client = None
-            if self.use_mysql:
-                client = RQGMySQLClient(database=self.database, host=self.mysql_url, user_id=self.user_id, password=self.password)
-            elif self.use_postgres:
-                client = RQGPostgresClient()
-
             if expected_result is None:
-                columns, rows = client._execute_query(query=sql_query)
-                if self.aggregate_pushdown:
-                    sql_result = client._gen_json_from_results_repeated_columns(columns, rows)
-                else:
-                    sql_result = client._gen_json_from_results(columns, rows)
-            client._close_connection()
+                sql_result = self._run_sql_query(sql_query, repeated_columns=bool(self.aggregate_pushdown))
             self.log.info(" result from n1ql query returns {0} items".format(len(n1ql_result)))
             self.log.info(" result from sql query returns {0} items".format(len(sql_result)))
 
@@ -0,0 +1,119 @@
+"""
+Shared sql clients and expected result cache for the RQG query workers
+"""
+import re
+import threading
+from collections import OrderedDict
+
+# idle connections kept around, one per concurrently running test is enough
+DEFAULT_MAX_IDLE = 32
+# sql results kept by SQLResultCache
+DEFAULT_MAX_ENTRIES = 2000
+
+# quoted literals are kept as they are when sql is normalized
+QUOTED_RE = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class RQGClientPool(object):
+    """Thread safe pool of sql clients
+
+    factory creates a connected client. A client is used by one thread
+    between get() and put(), clients which failed a query should be given
+    back with discard=True so the connection is closed instead of reused."""
+
+    def __init__(self, factory, max_idle=DEFAULT_MAX_IDLE):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.created = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.created += 1
+        return self.factory()
+
+    def put(self, client, discard=False):
+        if not discard:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(client)
+                    return
+        self._close(client)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            self._close(client)
+
+    def _close(self, client):
+        try:
+            if hasattr(client, "_close_connection"):
+                client._close_connection()
+            else:
+                client.connection.close()
+        except Exception:
+            pass
+
+
+class SQLResultCache(object):
+    """Results of sql queries keyed by normalized sql and dataset version
+
+    The workers which change the tables call invalidate(), which starts a
+    new dataset version. Rows are kept as tuples in the column order of the
+    result and every get() builds new dicts, so callers can change them."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize(self, sql):
+        parts = QUOTED_RE.split(sql.strip())
+        # odd parts are the quoted literals
+        parts[::2] = [WHITESPACE_RE.sub(" ", part) for part in parts[::2]]
+        return "".join(parts)
+
+    def get(self, sql, repeated_columns=False):
+        key = (self.normalize(sql), repeated_columns)
+        with self._lock:
+            entry = self._entries.get((self.version,) + key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((self.version,) + key)
+            self.hits += 1
+        columns, rows = entry
+        return [dict(zip(columns, row)) for row in rows]
+
+    def put(self, sql, version, sql_result, repeated_columns=False):
+        """version is the dataset version the query ran against"""
+        columns = tuple(sql_result[0].keys()) if sql_result else ()
+        rows = [tuple(row.values()) for row in sql_result]
+        key = (version, self.normalize(sql), repeated_columns)
+        with self._lock:
+            if version != self.version:
+                # the tables changed while the query ran
+                return
+            self._entries[key] = (columns, rows)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return "SQL result cache: hits = {0}, misses = {1}, hit rate = {2:.1f} %, invalidations = {3}".format(
+            self.hits, self.misses, (self.hits * 100.0 / lookups) if lookups else 0.0, self.invalidations)
@@ -7,6 +7,7 @@ import os
 import testconstants
 import time
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_compare import compare_results
 from couchbase_helper.tuq_generators import JsonGenerator
 from remote.remote_util import RemoteMachineShellConnection
 from basetestcase import BaseTestCase
@@ -447,15 +448,7 @@ class QueryTests(BaseTestCase):
                                  expected_result[:100], expected_result[-100:]))
 
     def check_missing_and_extra(self, actual, expected):
-        missing = []
-        extra = []
-        for item in actual:
-            if not (item in expected):
-                 extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return compare_results(actual, expected, limit=None)
 
     def sort_nested_list(self, result):
         actual_result = []
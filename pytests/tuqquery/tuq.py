@@ -19,6 +19,7 @@ from membase.api.rest_client import RestConnection
 from security.rbac_base import RbacBase
 # from sdk_client import SDKClient
 from couchbase_helper.tuq_generators import TuqGenerators
+from couchbase_helper.result_compare import compare_results
 #from xdcr.upgradeXDCR import UpgradeTests
 from couchbase_helper.documentgenerator import JSONNonDocGenerator
 from couchbase.cluster import Cluster
@@ -1223,9 +1224,9 @@ class QueryTests(BaseTestCase):
         if self.max_verify is not None:
             actual_result = actual_result[:self.max_verify]
             expected_result = expected_result[:self.max_verify]
-        diffs = DeepDiff(actual_result, expected_result, ignore_order=True)
-        if diffs:
-            self.assertTrue(False, diffs)
+        missing, extra = compare_results(actual_result, expected_result, sort_lists=True)
+        if missing or extra:
+            self.assertTrue(False, "Results are incorrect. Missing items: %s.\n Extra items: %s" % (missing, extra))
 
     def _verify_results_old(self, actual_result, expected_result):
         if self.max_verify is not None:
@@ -1269,14 +1270,7 @@ class QueryTests(BaseTestCase):
         return True
 
     def check_missing_and_extra(self, actual, expected):
-        missing, extra = [], []
-        for item in actual:
-            if not (item in expected):
-                 extra.append(item)
-        for item in expected:
-            if not (item in actual):
-                missing.append(item)
-        return missing, extra
+        return compare_results(actual, expected, limit=None)
 
     def sort_nested_list(self, result, key=None):
         actual_result = []
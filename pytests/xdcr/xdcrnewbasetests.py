@@ -3374,65 +3374,22 @@ class XDCRNewBaseTest(unittest.TestCase):
         """ Will merge kv_src_bucket keys that match the filter_expression
             if any into kv_dest_bucket.
         """
-        valid_keys_src, deleted_keys_src = kv_src_bucket[
-            kvs_num].key_set()
-        valid_keys_dest, deleted_keys_dest = kv_dest_bucket[
-            kvs_num].key_set()
-
-        self.log.info("src_kvstore has %s valid and %s deleted keys"
-                      % (len(valid_keys_src), len(deleted_keys_src)))
-        self.log.info("dest kvstore has %s valid and %s deleted keys"
-                      % (len(valid_keys_dest), len(deleted_keys_dest)))
+        kv_src, kv_dest = kv_src_bucket[kvs_num], kv_dest_bucket[kvs_num]
+        self.log.info("src_kvstore has %s valid keys, dest kvstore has %s valid keys"
+                      % (len(kv_src), len(kv_dest)))
 
+        # In case of lww, keys whose source timestamp is lower than the
+        # destination's are not merged.
+        merged = kv_dest.merge_from(kv_src, key_filter=filter_exp or None, lww=self.__lww)
         if filter_exp:
-            # If key based adv filter
-            if "META().id" in filter_exp:
-                filter_exp = filter_exp.split('\'')[1]
-
-            filtered_src_keys = [key for key in valid_keys_src if re.search(str(filter_exp), key) is not None]
-            valid_keys_src = filtered_src_keys
             self.log.info(
                 "{0} keys matched the filter expression {1}".format(
-                    len(valid_keys_src),
+                    merged["matched"],
                     filter_exp))
-
-        for key in valid_keys_src:
-            # replace/add the values for each key in src kvs
-            if key not in deleted_keys_dest:
-                partition1 = kv_src_bucket[kvs_num].acquire_partition(key)
-                partition2 = kv_dest_bucket[kvs_num].acquire_partition(key)
-                # In case of lww, if source's key timestamp is lower than
-                # destination than no need to set.
-                if self.__lww and partition1.get_timestamp(
-                        key) < partition2.get_timestamp(key):
-                    continue
-                key_add = partition1.get_key(key)
-                partition2.set(
-                    key,
-                    key_add["value"],
-                    key_add["expires"],
-                    key_add["flag"])
-                kv_src_bucket[kvs_num].release_partition(key)
-                kv_dest_bucket[kvs_num].release_partition(key)
-
-        for key in deleted_keys_src:
-            if key not in deleted_keys_dest:
-                partition1 = kv_src_bucket[kvs_num].acquire_partition(key)
-                partition2 = kv_dest_bucket[kvs_num].acquire_partition(key)
-                # In case of lww, if source's key timestamp is lower than
-                # destination than no need to delete.
-                if self.__lww and partition1.get_timestamp(
-                        key) < partition2.get_timestamp(key):
-                    continue
-                partition2.delete(key)
-                kv_src_bucket[kvs_num].release_partition(key)
-                kv_dest_bucket[kvs_num].release_partition(key)
-
-        valid_keys_dest, deleted_keys_dest = kv_dest_bucket[
-            kvs_num].key_set()
+        self.log.info("Merged {0} keys set and {1} keys deleted, {2} skipped by lww"
+                      .format(merged["set"], merged["deleted"], merged["skipped"]))
         self.log.info("After merging: destination bucket's kv_store now has {0}"
-                      " valid keys and {1} deleted keys".
-                      format(len(valid_keys_dest), len(deleted_keys_dest)))
+                      " valid keys".format(len(kv_dest)))
 
     def __merge_all_buckets(self):
         """Merge bucket data between source and destination bucket
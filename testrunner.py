@@ -4,9 +4,11 @@ import base64
 import gzip
 from http.client import BadStatusLine
 import os
+import queue
 import urllib.request, urllib.error, urllib.parse
 import sys
 import threading
+import multiprocessing
 from os.path import basename, splitext
 from multiprocessing import Process
 from pprint import pprint
@@ -22,6 +24,7 @@ import unittest
 import logging.config
 from threading import Thread, Event
 from xunit import XUnitTestResult
+from membase.api.rest_client import bootstrap_cache_stats
 from TestInput import TestInputParser, TestInputSingleton
 from optparse import OptionParser, OptionGroup
 from scripts.collect_server_info import cbcollectRunner, couch_dbinfo_Runner
@@ -65,6 +68,9 @@ def parse_args(argv):
                       help="NO-OP - emit test names, but don't actually run them e.g -n true")
     parser.add_option("-l", "--log-level",
                       dest="loglevel", default="INFO", help="e.g -l info,warning,error")
+    parser.add_option("-j", "--parallel", dest="parallel", type="int", default=None,
+                      help="Number of worker processes, each one running tests on its own "
+                           "slice of the [servers], e.g -j 2")
     options, args = parser.parse_args()
 
     tests = []
@@ -308,47 +314,20 @@ class StoppableThreadWithResult(Thread):
         Thread.join(self, timeout=None)
         return self._return
 
-def main():
+def run_tests(names, runtime_test_params, root_log_dir, str_time, xunit,
+              options, arg_i, arg_p, stop_event=None):
+    """Run the test cases one after another against TestInputSingleton.input.
 
+    suite_setUp of the first case's module runs before the first case and
+    suite_tearDown of the last case's module after the last one. Logs of case
+    N go to root_log_dir/test_N and the xunit report is rewritten after every
+    case. Returns the list of per-case result dicts.
+    """
     BEFORE_SUITE = "suite_setUp"
     AFTER_SUITE = "suite_tearDown"
-    names, runtime_test_params, arg_i, arg_p, options = parse_args(sys.argv)
-    # get params from command line
-    TestInputSingleton.input = TestInputParser.get_test_input(sys.argv)
-    # ensure command line params get higher priority
-    runtime_test_params.update(TestInputSingleton.input.test_params)
-    TestInputSingleton.input.test_params = runtime_test_params
-    print("Global Test input params:")
-    pprint(TestInputSingleton.input.test_params)
-
-    xunit = XUnitTestResult()
-    # Create root logs directory
-    abs_path = os.path.dirname(os.path.abspath(sys.argv[0]))
-    # Create testrunner logs subdirectory
-    str_time = time.strftime("%y-%b-%d_%H-%M-%S", time.localtime())
-    root_log_dir = os.path.join(abs_path, "logs{0}testrunner-{1}".format(os.sep, str_time))
-    if not os.path.exists(root_log_dir):
-        os.makedirs(root_log_dir)
-
     results = []
     case_number = 1
-    if "GROUP" in runtime_test_params:
-        print("Only cases in GROUPs '{0}' will be executed".format(runtime_test_params["GROUP"]))
-    if "EXCLUDE_GROUP" in runtime_test_params:
-        print("Cases from GROUPs '{0}' will be excluded".format(runtime_test_params["EXCLUDE_GROUP"]))
-
-    if TestInputSingleton.input.param("get-delays", False):
-        # start measure_sched_delays on all servers
-        sd = SchedDelays(TestInputSingleton.input.servers)
-        sd.start_measure_sched_delays()
-
-    if TestInputSingleton.input.param("hanging_threads", False):
-       print("--> hanging_threads: start monitoring...")
-       from hanging_threads import start_monitoring
-       hanging_threads_frozen_time = int(TestInputSingleton.input.param("hanging_threads", 120))
-       hanging_threads_test_interval = int(TestInputSingleton.input.param("test_interval", 1000))
-       monitoring_thread = start_monitoring(seconds_frozen=hanging_threads_frozen_time, test_interval=hanging_threads_test_interval) 
-
+    name = None
     for name in names:
         start_time = time.time()
         argument_split = [a.strip() for a in re.split("[,]?([^,=]+)=", name)[1:]]
@@ -455,6 +434,10 @@ def main():
                 print ("========TEST WAS STOPPED DUE TO  TIMEOUT=========")
                 result.errors = [(name, "Test was stopped due to timeout")]
         time_taken = time.time() - start_time
+        bootstrap_stats = bootstrap_cache_stats(reset=True)
+        if bootstrap_stats["saved"]:
+            print("RestConnection nodes/self bootstraps: {0} fetched, {1} saved by cache"
+                  .format(bootstrap_stats["fetched"], bootstrap_stats["saved"]))
 
         # Concat params to test name
         # To make tests more readable
@@ -473,6 +456,7 @@ def main():
             if "get-logs-cluster-run" in TestInputSingleton.input.test_params:
                 if TestInputSingleton.input.param("get-logs-cluster-run", True):
                     # Generate path to ns_server directory
+                    abs_path = os.path.dirname(os.path.abspath(sys.argv[0]))
                     ns_server_path = os.path.normpath(abs_path + os.sep + os.pardir + os.sep + "ns_server")
                     get_logs_cluster_run(TestInputSingleton.input, logs_folder, ns_server_path)
 
@@ -507,8 +491,12 @@ def main():
         if (result.failures or result.errors) and \
                 TestInputSingleton.input.param("stop-on-failure", False):
             print("test fails, all of the following tests will be skipped!!!")
+            if stop_event is not None:
+                stop_event.set()
             break
 
+    if name is None:
+        return results
     after_suite_name = "%s.%s" % (name[:name.rfind('.')], AFTER_SUITE)
     try:
         print("Run after suite setup for %s" % name)
@@ -516,6 +504,170 @@ def main():
         result = unittest.TextTestRunner(verbosity=2).run(suite)
     except AttributeError as ex:
         pass
+    return results
+
+
+def split_servers(servers, slices):
+    """Split the servers into `slices` disjoint, contiguous slices.
+
+    The first servers of the list are spread over the first slices when the
+    servers can not be divided evenly.
+    """
+    if len(servers) < slices:
+        sys.exit("cannot run {0} parallel workers on {1} servers"
+                 .format(slices, len(servers)))
+    size, extra = divmod(len(servers), slices)
+    server_slices = []
+    start = 0
+    for i in range(slices):
+        end = start + size + (1 if i < extra else 0)
+        server_slices.append(servers[start:end])
+        start = end
+    return server_slices
+
+
+def _queued_names(name_queue, stop_event):
+    # names are followed by one None sentinel per worker
+    while not stop_event.is_set():
+        name = name_queue.get()
+        if name is None:
+            return
+        yield name
+
+
+def run_worker(worker_id, test_input, servers, name_queue, result_queue,
+               stop_event, runtime_test_params, root_log_dir, str_time,
+               options, arg_i, arg_p):
+    """Body of a parallel worker process.
+
+    The worker owns `servers` for the whole run, keeps its own logs folder
+    and case numbering and pulls case names off the shared queue until it is
+    drained. Its xunit result and case results are sent back to the parent.
+    """
+    TestInputSingleton.input = test_input
+    TestInputSingleton.input.servers = servers
+    runtime_test_params = dict(runtime_test_params)
+    runtime_test_params["num_nodes"] = len(servers)
+    runtime_test_params["worker_id"] = worker_id
+    worker_log_dir = os.path.join(root_log_dir, "worker_%s" % worker_id)
+    if not os.path.exists(worker_log_dir):
+        os.makedirs(worker_log_dir)
+    print("worker {0} runs on servers {1}".format(worker_id, servers))
+    xunit = XUnitTestResult()
+    results = []
+    try:
+        results = run_tests(_queued_names(name_queue, stop_event), runtime_test_params,
+                            worker_log_dir, str_time, xunit, options, arg_i, arg_p,
+                            stop_event=stop_event)
+    finally:
+        result_queue.put((worker_id, xunit, results))
+
+
+def run_tests_parallel(names, runtime_test_params, root_log_dir, str_time, xunit,
+                       options, arg_i, arg_p, parallel):
+    """Run the test cases on `parallel` worker processes.
+
+    Servers are split into disjoint slices, one per worker, and cases are
+    handed out to whichever worker is free. The workers' xunit results are
+    merged into `xunit` and written once into root_log_dir.
+    """
+    if TestInputSingleton.input.clusters:
+        sys.exit("parallel mode supports the [servers] section only, "
+                 "not [cluster] sections")
+    server_slices = split_servers(TestInputSingleton.input.servers, parallel)
+    name_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    for name in names:
+        name_queue.put(name)
+    for _ in range(parallel):
+        name_queue.put(None)
+    # unconsumed names must not block our exit after a stop-on-failure
+    name_queue.cancel_join_thread()
+
+    workers = []
+    for worker_id, servers in enumerate(server_slices):
+        worker = Process(target=run_worker, name="worker_%s" % worker_id,
+                         args=(worker_id, TestInputSingleton.input, servers,
+                               name_queue, result_queue, stop_event,
+                               runtime_test_params, root_log_dir, str_time,
+                               options, arg_i, arg_p))
+        worker.start()
+        workers.append(worker)
+
+    worker_results = []
+    while len(worker_results) < len(workers):
+        try:
+            worker_results.append(result_queue.get(timeout=5))
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                # pick up whatever is still in flight and give up on the rest
+                try:
+                    while len(worker_results) < len(workers):
+                        worker_results.append(result_queue.get(timeout=5))
+                except queue.Empty:
+                    pass
+                break
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            print("worker {0} exited with code {1}".format(worker.name, worker.exitcode))
+
+    results = []
+    for worker_id, worker_xunit, worker_case_results in sorted(worker_results, key=lambda r: r[0]):
+        xunit.merge(worker_xunit)
+        results.extend(worker_case_results)
+    xunit.write("{0}{2}report-{1}".format(root_log_dir, str_time, os.sep))
+    xunit.print_summary()
+    print("testrunner logs, diags and results are available under {0}".format(root_log_dir))
+    return results
+
+
+def main():
+
+    names, runtime_test_params, arg_i, arg_p, options = parse_args(sys.argv)
+    # get params from command line
+    TestInputSingleton.input = TestInputParser.get_test_input(sys.argv)
+    # ensure command line params get higher priority
+    runtime_test_params.update(TestInputSingleton.input.test_params)
+    TestInputSingleton.input.test_params = runtime_test_params
+    print("Global Test input params:")
+    pprint(TestInputSingleton.input.test_params)
+
+    xunit = XUnitTestResult()
+    # Create root logs directory
+    abs_path = os.path.dirname(os.path.abspath(sys.argv[0]))
+    # Create testrunner logs subdirectory
+    str_time = time.strftime("%y-%b-%d_%H-%M-%S", time.localtime())
+    root_log_dir = os.path.join(abs_path, "logs{0}testrunner-{1}".format(os.sep, str_time))
+    if not os.path.exists(root_log_dir):
+        os.makedirs(root_log_dir)
+
+    if "GROUP" in runtime_test_params:
+        print("Only cases in GROUPs '{0}' will be executed".format(runtime_test_params["GROUP"]))
+    if "EXCLUDE_GROUP" in runtime_test_params:
+        print("Cases from GROUPs '{0}' will be excluded".format(runtime_test_params["EXCLUDE_GROUP"]))
+
+    if TestInputSingleton.input.param("get-delays", False):
+        # start measure_sched_delays on all servers
+        sd = SchedDelays(TestInputSingleton.input.servers)
+        sd.start_measure_sched_delays()
+
+    if TestInputSingleton.input.param("hanging_threads", False):
+       print("--> hanging_threads: start monitoring...")
+       from hanging_threads import start_monitoring
+       hanging_threads_frozen_time = int(TestInputSingleton.input.param("hanging_threads", 120))
+       hanging_threads_test_interval = int(TestInputSingleton.input.param("test_interval", 1000))
+       monitoring_thread = start_monitoring(seconds_frozen=hanging_threads_frozen_time, test_interval=hanging_threads_test_interval) 
+
+    parallel = options.parallel or TestInputSingleton.input.param("parallel", 1)
+    if parallel > 1:
+        results = run_tests_parallel(names, runtime_test_params, root_log_dir, str_time,
+                                     xunit, options, arg_i, arg_p, parallel)
+    else:
+        results = run_tests(names, runtime_test_params, root_log_dir, str_time,
+                            xunit, options, arg_i, arg_p)
+
     if "makefile" in TestInputSingleton.input.test_params:
         # print out fail for those tests which failed and do sys.exit() error code
         fail_count = 0
@@ -0,0 +1,35 @@
+"""Micro-benchmark of the crc32 helpers against the old python loop.
+
+    python unittests/crc32_bench.py [num_values] [value_size]
+"""
+import sys
+import timeit
+
+sys.path.append("lib")
+
+import crc32
+
+
+def main():
+    num_values = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    value_size = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    values = ['{"name": "employee-%d", "body": "%s"}' % (i, "x" * value_size)
+              for i in range(num_values)]
+    keys = ["key-%d" % i for i in range(num_values)]
+
+    assert [crc32._crc32_hash_py(v) for v in values] == crc32.hash_values(values)
+
+    timings = [("python loop", lambda: [crc32._crc32_hash_py(v) for v in values]),
+               ("crc32_hash", lambda: [crc32.crc32_hash(v) for v in values]),
+               ("hash_values", lambda: crc32.hash_values(values)),
+               ("vbuckets_for", lambda: crc32.vbuckets_for(keys, 1024))]
+    baseline = None
+    for name, fn in timings:
+        elapsed = min(timeit.repeat(fn, number=1, repeat=3))
+        baseline = baseline or elapsed
+        print("{0:<14} {1:>10.0f} values/sec  x{2:.1f}".format(
+            name, num_values / elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Throughput of the task layer load and verify paths against the bundled
+lib/mc_bin_server.py.
+
+Times the document generators, KVStore and the loading and validation
+tasks (LoadDocumentsGeneratorsTask with single sets, batches and the high
+throughput mode, BatchedLoadDocumentsTask, ValidateDataTask and
+BatchedValidateDataTask) on localhost. The tasks build their clients from a
+RestConnection of the cluster, the bench swaps those for a plain
+MemcachedClient talking to the local server.
+
+Every case runs in a process of its own. The fastest of --repeat runs
+gives docs/sec, cpu time per doc (of the case and its loader processes,
+not of the server) and peak rss, the peak of the memory allocated by
+python is measured in one more run with tracemalloc on. Results are
+compared with the baseline file, a case whose docs/sec dropped or whose
+cpu per doc grew by more than the tolerance is flagged and the exit
+status is 1. Baselines are per machine, --save-baseline rewrites it.
+
+    python unittests/loader_bench.py [--items N] [--batch-size N] [--repeat 3] [--tolerance 0.25]
+                                     [--baseline file] [--save-baseline] [case ...]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.append("lib")
+sys.path.append(".")
+
+import crc32
+from mc_bin_client import MemcachedClient
+from TestInput import TestInput, TestInputServer, TestInputSingleton
+from couchbase_helper.documentgenerator import DocumentGenerator, BlobGenerator, JsonDocGenerator
+from memcached.helper.kvstore import KVStore
+from tasks import task
+
+PORT = 11312
+BUCKET = "default"
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loader_bench_baseline.json")
+
+
+class LocalClient(MemcachedClient):
+    """MemcachedClient with the VBucketAwareMemcached signatures the loading
+    tasks call, every vbucket lives on the local test server"""
+
+    def __init__(self, rest=None, bucket=None, compression=True):
+        MemcachedClient.__init__(self, "127.0.0.1", PORT)
+        self.vbucket_count = 1
+
+    def setMulti(self, exp, flags, key_val_dic, pause_sec=1, timeout_sec=5, parallel=False, collection=None):
+        return MemcachedClient.setMulti(self, exp, flags, key_val_dic, collection=collection)
+
+    def getMulti(self, keys_lst, pause_sec=1, timeout_sec=5, parallel=True, collection=None):
+        return MemcachedClient.getMulti(self, keys_lst, collection=collection)
+
+
+def use_local_server():
+    task.RestConnection = lambda server: server
+    task.VBucketAwareMemcached = LocalClient
+    TestInputSingleton.input = TestInput()
+
+
+def start_server(port):
+    server = subprocess.Popen([sys.executable, "-W", "ignore", "mc_bin_server.py", str(port)],
+                              cwd="lib", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception("mc_bin_server did not start on port {0}".format(port))
+
+
+def local_server():
+    server = TestInputServer()
+    server.ip = "127.0.0.1"
+    server.port = PORT
+    return server
+
+
+def document_generator(items, prefix="bench"):
+    template = '{{ "age": {0}, "first_name": "{1}", "body": "{2}" }}'
+    return DocumentGenerator(prefix, template, list(range(100)), ["james", "sharon", "dave"],
+                             ["b" * 200], start=0, end=items)
+
+
+def drain(generator):
+    count = 0
+    while generator.has_next():
+        next(generator)
+        count += 1
+    return count
+
+
+def run_task(_task):
+    # the tasks are threads, running them here keeps the measurement in one thread
+    _task.run()
+    _task.result()
+
+
+def load(items, batch_size, prefix="bench"):
+    kv_store = KVStore()
+    run_task(task.BatchedLoadDocumentsTask(local_server(), BUCKET, document_generator(items, prefix),
+                                           kv_store, "create", 0, batch_size=batch_size))
+    return kv_store
+
+
+# every case takes (items, batch_size), does its setup and returns a
+# callable which runs the measured part and returns the number of docs
+def case_document_generator(items, batch_size):
+    return lambda: drain(document_generator(items))
+
+
+def case_blob_generator(items, batch_size):
+    return lambda: drain(BlobGenerator("bench", "bench-", 256, end=items))
+
+
+def case_json_doc_generator(items, batch_size):
+    return lambda: drain(JsonDocGenerator("bench", start=0, end=items))
+
+
+def case_kvstore(items, batch_size):
+    batches = []
+    for start in range(0, items, batch_size):
+        keys = ["bench{0}".format(i) for i in range(start, min(start + batch_size, items))]
+        batches.append(dict(zip(keys, map(str, crc32.hash_values(keys)))))
+
+    def run():
+        kv_store = KVStore()
+        for batch in batches:
+            kv_store.set_many(batch, bucket=BUCKET)
+        valid, deleted = kv_store.key_set(bucket=BUCKET)
+        return len(valid) + len(deleted)
+    return run
+
+
+def _load_generators_task(items, batch_size, high_throughput):
+    TestInputSingleton.input.test_params["disable_HTP"] = str(not high_throughput)
+    _task = task.LoadDocumentsGeneratorsTask(local_server(), BUCKET, [document_generator(items)], KVStore(),
+                                             "create", 0, batch_size=batch_size)
+    if _task.is_high_throughput_mode != high_throughput:
+        raise Exception("high throughput mode is {0}".format(_task.is_high_throughput_mode))
+    return _task
+
+
+def case_load_single(items, batch_size):
+    # one round trip per doc, a tenth of the docs keeps it short
+    _task = _load_generators_task(items // 10, 1, False)
+    return lambda: run_task(_task) or items // 10
+
+
+def case_load_batched(items, batch_size):
+    _task = _load_generators_task(items, batch_size, False)
+    return lambda: run_task(_task) or items
+
+
+def case_load_high_throughput(items, batch_size):
+    # the loader processes live as long as the test, a first small load
+    # starts them and builds their clients so that only the load is timed
+    run_task(_load_generators_task(batch_size * task.LOADER_POOL.processes, batch_size, True))
+    _task = _load_generators_task(items, batch_size, True)
+
+    def run():
+        run_task(_task)
+        # the loader processes are waited for so their cpu time is accounted
+        task.LOADER_POOL.close()
+        return items
+    return run
+
+
+def case_batched_load(items, batch_size):
+    _task = task.BatchedLoadDocumentsTask(local_server(), BUCKET, document_generator(items), KVStore(),
+                                          "create", 0, batch_size=batch_size)
+    return lambda: run_task(_task) or items
+
+
+def case_validate(items, batch_size):
+    kv_store = load(items // 10, batch_size, "validate")
+    _task = task.ValidateDataTask(local_server(), BUCKET, kv_store)
+    return lambda: run_task(_task) or items // 10
+
+
+def case_batched_validate(items, batch_size):
+    kv_store = load(items, batch_size, "batched_validate")
+    _task = task.BatchedValidateDataTask(local_server(), BUCKET, kv_store, batch_size=batch_size)
+    return lambda: run_task(_task) or items
+
+
+CASES = [("DocumentGenerator", case_document_generator),
+         ("BlobGenerator", case_blob_generator),
+         ("JsonDocGenerator", case_json_doc_generator),
+         ("KVStore.set_many", case_kvstore),
+         ("load/single", case_load_single),
+         ("load/batched", case_load_batched),
+         ("load/high_throughput", case_load_high_throughput),
+         ("BatchedLoadDocumentsTask", case_batched_load),
+         ("ValidateDataTask", case_validate),
+         ("BatchedValidateDataTask", case_batched_validate)]
+
+
+def cpu_time():
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def run_case(case, items, batch_size, trace, conn):
+    try:
+        use_local_server()
+        logging.getLogger().setLevel(logging.WARNING)
+        run = case(items, batch_size)
+        if trace:
+            tracemalloc.start()
+        cpu, start = cpu_time(), time.time()
+        docs = run()
+        elapsed, cpu = time.time() - start, cpu_time() - cpu
+        result = {"docs": docs, "elapsed": elapsed, "cpu": cpu,
+                  "peak_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)}
+        if trace:
+            result["alloc_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        conn.send(result)
+    except Exception as e:
+        conn.send({"error": "{0}: {1}".format(type(e).__name__, e)})
+
+
+def measure(case, items, batch_size, trace=False):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    # not a daemon, the high throughput case starts loader processes
+    process = multiprocessing.Process(target=run_case, args=(case, items, batch_size, trace, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    if "error" in result:
+        raise Exception(result["error"])
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """returns the regressions of result against the baseline entry"""
+    if not baseline:
+        return []
+    regressions = []
+    if result["docs_per_sec"] < baseline["docs_per_sec"] * (1 - tolerance):
+        regressions.append("docs/sec {0:.0f} < {1:.0f}".format(result["docs_per_sec"], baseline["docs_per_sec"]))
+    if result["cpu_us_per_doc"] > baseline["cpu_us_per_doc"] * (1 + tolerance):
+        regressions.append("cpu/doc {0:.1f}us > {1:.1f}us".format(result["cpu_us_per_doc"],
+                                                                 baseline["cpu_us_per_doc"]))
+    return regressions
+
+
+def report(name, result, regressions):
+    print("{0:<26} {1:>7} docs {2:>10.0f} docs/sec {3:>8.1f} us cpu/doc {4:>8} KB rss {5:>8} KB alloc  {6}".format(
+        name, result["docs"], result["docs_per_sec"], result["cpu_us_per_doc"], result["peak_rss_kb"],
+        result["alloc_peak_kb"], "SLOWER: " + ", ".join(regressions) if regressions else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="task layer load throughput benchmark")
+    parser.add_argument("cases", nargs="*", help="cases to run, all by default: {0}".format(
+        ", ".join(name for name, _ in CASES)))
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest one counts")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a case may be slower than the baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write the results to the baseline file instead of comparing")
+    args = parser.parse_args()
+    cases = [(name, case) for name, case in CASES if not args.cases or name in args.cases]
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get("items"), baseline.get("batch_size")) != (args.items, args.batch_size):
+            print("baseline was taken with {0} items in batches of {1}, rates may not be comparable".format(
+                baseline.get("items"), baseline.get("batch_size")))
+
+    server = start_server(PORT)
+    results = {}
+    slower = []
+    try:
+        for name, case in cases:
+            result = min((measure(case, args.items, args.batch_size) for _ in range(args.repeat)),
+                         key=lambda r: r["elapsed"] / r["docs"])
+            result["alloc_peak_kb"] = measure(case, args.items, args.batch_size, trace=True)["alloc_peak_kb"]
+            result["docs_per_sec"] = result["docs"] / result["elapsed"]
+            result["cpu_us_per_doc"] = result["cpu"] * 1000000 / result["docs"]
+            regressions = compare(result, baseline.get("cases", {}).get(name), args.tolerance)
+            report(name, result, regressions)
+            if regressions:
+                slower.append(name)
+            results[name] = dict((k, round(result[k], 1)) for k in
+                                 ("docs_per_sec", "cpu_us_per_doc", "peak_rss_kb", "alloc_peak_kb"))
+    finally:
+        server.kill()
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"items": args.items, "batch_size": args.batch_size, "cases": results},
+                      f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("baseline written to {0}".format(args.baseline))
+    elif slower:
+        print("{0} of {1} cases are slower than the baseline".format(len(slower), len(cases)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Packets/sec of MemcachedClient against the bundled lib/mc_bin_server.py.
+
+Starts the test server on localhost, then times single set/get round trips
+and pipelined setMulti/getMulti batches.
+
+    python unittests/mc_pipeline_bench.py [num_items] [batch_size] [value_size]
+"""
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.append("lib")
+
+from mc_bin_client import MemcachedClient
+
+
+def start_server(port):
+    server = subprocess.Popen([sys.executable, "-W", "ignore", "mc_bin_server.py", str(port)],
+                              cwd="lib", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception("mc_bin_server did not start on port {0}".format(port))
+
+
+def report(name, packets, elapsed):
+    print("{0:<22} {1:>8} packets in {2:6.2f}s  {3:>10.0f} packets/sec".format(
+        name, packets, elapsed, packets / elapsed))
+
+
+def main():
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    value_size = int(sys.argv[3]) if len(sys.argv) > 3 else 256
+    port = 11311
+    server = start_server(port)
+    try:
+        client = MemcachedClient("127.0.0.1", port)
+        client.vbucket_count = 1
+        value = "v" * value_size
+        keys = ["key-%d" % i for i in range(num_items)]
+
+        start = time.time()
+        for key in keys[:num_items // 10]:
+            client.set(key, 0, 0, value)
+        report("set", num_items // 10, time.time() - start)
+
+        start = time.time()
+        for key in keys[:num_items // 10]:
+            client.get(key)
+        report("get", num_items // 10, time.time() - start)
+
+        start = time.time()
+        for i in range(0, num_items, batch_size):
+            client.setMulti(0, 0, dict((key, value) for key in keys[i:i + batch_size]))
+        report("setMulti/%d" % batch_size, num_items, time.time() - start)
+
+        start = time.time()
+        for i in range(0, num_items, batch_size):
+            client.getMulti(keys[i:i + batch_size])
+        report("getMulti/%d" % batch_size, num_items, time.time() - start)
+        client.close()
+    finally:
+        server.kill()
+
+
+if __name__ == "__main__":
+    main()